@@ -0,0 +1,149 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+import simpleperf
+
+# Benchmarks simpleperf itself: runs a server and a client in this process over loopback, sweeps the message size,
+# receive buffer size, number of parallel streams and server engine, and records the throughput and the CPU time per
+# GB of each configuration. The results are compared with a baseline JSON file, and the run fails if a configuration
+# got slower or more expensive than the tolerance allows.
+
+# The configuration every sweep starts from. Each sweep changes one parameter and keeps the others at these values.
+DEFAULT_CONFIG = {'message_size': 1000, 'recv_buffer': simpleperf.RECV_BUFFER, 'parallel': 1, 'engine': "thread"}
+
+# The values each parameter is swept over.
+SWEEPS = {'message_size': [1000, 8000, 64000],
+          'recv_buffer': [64 * 1000, 256 * 1000, 1000 * 1000],
+          'parallel': [1, 4],
+          'engine': ["thread", "async"]}
+
+# How long the server may take to finish the connections of a run after the client is done, in seconds.
+SERVER_WAIT = 5
+
+# Default baseline file, next to this script.
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+# Lists the configurations of the sweep, without duplicates, in a stable order.
+# Returns: A list of (name, config) tuples.
+def sweep_configs():
+    configs = {}
+    for parameter, values in SWEEPS.items():
+        for value in values:
+            config = dict(DEFAULT_CONFIG, **{parameter: value})
+            name = f"m={config['message_size']} buf={config['recv_buffer']} P={config['parallel']} {config['engine']}"
+            configs.setdefault(name, config)
+    return list(configs.items())
+
+
+# Runs one configuration: a simpleperf Server and a client in this process, through the library API, so nothing is
+# printed. The CPU time is that of the whole process, so it covers both sides of the transfer; it is read once the
+# server has finished every connection. A run in which a stream failed, or whose connections the server has not
+# finished SERVER_WAIT seconds after the client, has failed.
+# Arguments: config (dict) - The configuration, see DEFAULT_CONFIG.
+#            duration (int) - The duration of the test, in seconds.
+# Returns: A dict with the bytes per second and the CPU seconds per GB, or None if the run failed.
+def run_config(config, duration):
+    with simpleperf.Server(port=0, engine=config['engine'], recv_buffer=config['recv_buffer']) as server:
+        gc.collect()
+        cpu_start = time.process_time()
+        result = simpleperf.run_client(server_port=server.address[1], duration=duration, parallel=config['parallel'],
+                                       message_size=config['message_size'])
+        if result.failed:
+            return None
+        deadline = time.monotonic() + SERVER_WAIT
+        while server.connections < config['parallel']:
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.001)
+        cpu = time.process_time() - cpu_start
+
+    total_bytes = sum(result.bytes)
+    return {'bytes_per_second': result.bits_per_second / 8,
+            'cpu_seconds_per_gb': cpu / (total_bytes / 1e9) if total_bytes else float("inf")}
+
+
+# Runs every configuration of the sweep, each repeat times, and keeps the best run of each: the fastest throughput and
+# the lowest CPU cost, which are the least disturbed by other load on the machine. Failed runs are left out; a
+# configuration whose runs all failed has failed.
+# Arguments: duration (int) - The duration of each run, in seconds.
+#            repeat (int) - The number of runs per configuration.
+# Returns: A dict from configuration name to result, see run_config, or None for a failed configuration.
+def run_suite(duration, repeat):
+    results = {}
+    for name, config in sweep_configs():
+        runs = [run for run in (run_config(config, duration) for _ in range(repeat)) if run is not None]
+        if not runs:
+            results[name] = None
+            print(f"{name}: failed", flush=True)
+            continue
+        results[name] = {'bytes_per_second': max(run['bytes_per_second'] for run in runs),
+                         'cpu_seconds_per_gb': min(run['cpu_seconds_per_gb'] for run in runs)}
+        print(f"{name}: {results[name]['bytes_per_second'] / 1e6:.1f} MB/s, "
+              f"{results[name]['cpu_seconds_per_gb']:.3f} CPU s/GB", flush=True)
+    return results
+
+
+# Compares results with a baseline and prints a row per configuration.
+# Arguments: results (dict) - The results of run_suite.
+#            baseline (dict) - The baseline results, in the same form.
+#            tolerance (float) - The allowed relative loss of throughput or rise of CPU cost, e.g. 0.15 for 15%.
+# Returns: regressions (list) - The names of the configurations that regressed beyond the tolerance or failed.
+def compare(results, baseline, tolerance):
+    regressions = []
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if result is None:
+            rows.append([name, "-", "-", "-", "FAILED"])
+            regressions.append(name)
+            continue
+        if base is None:
+            rows.append([name, f"{result['bytes_per_second'] / 1e6:.1f}", "-", "-", "new"])
+            continue
+        speed = result['bytes_per_second'] / base['bytes_per_second'] - 1
+        cost = result['cpu_seconds_per_gb'] / base['cpu_seconds_per_gb'] - 1
+        status = "ok"
+        if speed < -tolerance or cost > tolerance:
+            status = "REGRESSION"
+            regressions.append(name)
+        rows.append([name, f"{result['bytes_per_second'] / 1e6:.1f}", f"{speed:+.1%}", f"{cost:+.1%}", status])
+    simpleperf.print_table(["Config", "MB/s", "Throughput", "CPU/GB", "Status"], rows)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loopback throughput and CPU cost benchmark of simpleperf")
+    parser.add_argument("-t", "--time", type=simpleperf.positive_int, default=1,
+                        help="duration of each run in seconds")
+    parser.add_argument("--repeat", type=simpleperf.positive_int, default=3,
+                        help="runs per configuration, the best one counts")
+    parser.add_argument("--baseline", type=str, default=BASELINE, help="baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed relative throughput loss or CPU cost rise before a configuration fails")
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    args = parser.parse_args()
+
+    results = run_suite(args.time, args.repeat)
+    failed = [name for name, result in results.items() if result is None]
+
+    if args.save:
+        # A failed configuration keeps no baseline, so the next comparison reports it as new
+        with open(args.baseline, "w") as file:
+            json.dump({name: result for name, result in results.items() if result is not None}, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        if failed:
+            sys.exit(1)
+    elif not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create one")
+        if failed:
+            sys.exit(1)
+    else:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
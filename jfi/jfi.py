@@ -1,21 +1,209 @@
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import sys
+
+# Computes Jain's fairness index of throughput values, and bulk-analyzes trees of test results (simpleperf tables
+# and json/csv records, iperf reports, ping logs and the hand-copied throughput lists in this directory).
+
+
 def jainsall(data):  # Function with "data" as parametre. In this case we intend to use a list from text file (the task)
-    N = len(liste)  # The amount of elements in the list
+    N = len(data)  # The amount of elements in the list
 
     # Decided that it would be easier to define the numerator and the denominator
 
-    numerator = sum(liste)  # Calculating the numerator of the JFI formula by summing the values in the list
+    numerator = sum(data)  # Calculating the numerator of the JFI formula by summing the values in the list
     denominator = sum(
-        x ** 2 for x in liste)  # Calculating the denominator by summing the squares of the values in the list
+        x ** 2 for x in data)  # Calculating the denominator by summing the squares of the values in the list
     jfi = (numerator ** 2) / (N * denominator)  # Using the formula for JFI, using the variables defined above
     return round(jfi, 4)  # Returning the result with 4 decimals
 
 
-liste = []  # empty list
+# Result parsing
+# Every pattern is compiled once and applied to a whole file at a time with findall, instead of looping over lines.
+
+# Multipliers from the units in result files to Mbit/s. simpleperf labels its bandwidth column "MBps", but the
+# values are megabits per second (transfer * 8 / time), so its units map like the bit units.
+RATE_UNITS = {'': 1e-6, 'B': 1e-6, 'K': 1e-3, 'KB': 1e-3, 'M': 1, 'MB': 1, 'G': 1e3, 'GB': 1e3}
+
+# A row of a simpleperf ID / Interval / Transfer / Bandwidth table. Reverse and bidir rows have an RX or TX suffix.
+SIMPLEPERF_ROW = re.compile(r"^(\S+(?: \[\d+\])?(?: [RT]X)?)\s+([\d.]+) - ([\d.]+)\s+[\d.]+ (?:B|KB|MB)\s+"
+                            r"([\d.]+) (B|KB|MB)ps", re.M)
+# A bandwidth in an iperf report, e.g. "26.2 Mbits/sec".
+IPERF_RATE = re.compile(r"([\d.]+) ([KMG]?)bits/sec")
+# A round-trip time in a ping log, e.g. "time=20.9 ms".
+PING_RTT = re.compile(r"time=([\d.]+) ms")
+# A line of a hand-copied throughput list, e.g. "8.21 Mbps".
+RATE_LINE = re.compile(r"^([\d.]+) ([KMG]?)bps\s*$", re.M)
+
+
+# Reads one result file.
+# Arguments: path (str) - The file.
+# Returns: (kind, values, summary) - kind is "throughput" (values in Mbit/s), "latency" (values in ms) or "flows"
+#          (one throughput per flow, for fairness); values are the interval samples; summary is the overall
+#          throughput of a throughput file (None otherwise). Returns None if the file holds no known results.
+def parse_results(path):
+    with open(path, errors="replace") as file:
+        text = file.read()
+
+    if text.lstrip().startswith("{"):
+        return parse_records([json.loads(line) for line in text.splitlines() if line.strip()])
+    if text.startswith("type,id,"):
+        return parse_records(list(csv.DictReader(text.splitlines())))
+
+    rows = SIMPLEPERF_ROW.findall(text)
+    if rows:
+        rows = [(stream_id, float(begin), float(end), float(rate) * RATE_UNITS[unit])
+                for stream_id, begin, end, rate, unit in rows]
+        return split_rows(rows)
+
+    rates = IPERF_RATE.findall(text)
+    if rates:
+        values = [float(rate) * RATE_UNITS[unit] for rate, unit in rates]
+        # The last bandwidth is the server report of the test
+        return "throughput", values, values[-1]
+
+    rtts = PING_RTT.findall(text)
+    if rtts:
+        return "latency", [float(rtt) for rtt in rtts], None
+
+    flows = RATE_LINE.findall(text)
+    if flows:
+        return "flows", [float(rate) * RATE_UNITS[unit] for rate, unit in flows], None
+    return None
+
+
+# Splits parsed simpleperf rows into interval samples and the overall throughput. Rows that cover the whole test
+# (starting at 0 and ending last) are the summary; the [SUM] row is preferred, otherwise the streams are added up.
+# Arguments: rows (list) - (id, begin, end, Mbit/s) tuples.
+# Returns: see parse_results.
+def split_rows(rows):
+    last = max(end for _, _, end, _ in rows)
+    summary_rows = [row for row in rows if row[1] == 0 and abs(row[2] - last) < 0.01]
+    totals = [rate for stream_id, _, _, rate in summary_rows if stream_id == "[SUM]"]
+    summary = totals[-1] if totals else sum(rate for stream_id, _, _, rate in summary_rows)
+    samples = [row[3] for row in rows if row not in summary_rows and row[0] != "[SUM]"]
+    return "throughput", samples or [summary], summary
+
+
+# Reads simpleperf json/csv records.
+# Arguments: records (list) - The records, as dicts.
+# Returns: see parse_results.
+def parse_records(records):
+    latencies = [float(r['p50_ms']) for r in records if r.get('type') == "latency_interval"]
+    if latencies:
+        return "latency", latencies, None
+    rows = [(r['id'], float(r['start']), float(r['end']), float(r['bits_per_second']) / 1e6)
+            for r in records if r.get('type') in ("interval", "summary", "udp_summary") and r.get('bits_per_second')]
+    if not rows:
+        return None
+    return split_rows(rows)
+
+
+# Result statistics
+
+# Returns the value at a percentile (0-100) of sorted values, using the nearest-rank method.
+def percentile(ordered, percent):
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+# Summarizes the values of one file.
+# Arguments: values (list) - The values.
+# Returns: A dict with the count, mean, min, p50, p90, p99 and max.
+def summarize(values):
+    ordered = sorted(values)
+    return {'samples': len(ordered), 'mean': sum(ordered) / len(ordered), 'min': ordered[0],
+            'p50': percentile(ordered, 50), 'p90': percentile(ordered, 90), 'p99': percentile(ordered, 99),
+            'max': ordered[-1]}
+
+
+# Columns of the summary written by analyze.
+SUMMARY_FIELDS = ("path", "kind", "unit", "samples", "mean", "min", "p50", "p90", "p99", "max", "throughput", "jfi")
+
+
+# Analyzes every result file under the given paths. Every file gets a row with its statistics. The throughput files
+# of one directory under one of the concurrent directories are flows that ran at the same time (as in testCase4/2), so
+# every such directory with more than one of them also gets a "fairness" row with Jain's fairness index of their
+# throughputs. Other directories hold runs one after the other (as in testCase1), which a fairness index would
+# compare as if they had competed, so they only get their per-file rows. Hand-copied flow lists get their own index.
+# Arguments: paths (list) - Files and directories to analyze.
+#            concurrent (list) - Directories whose throughput files, directory by directory, ran at the same time.
+# Returns: A list of rows (dicts with keys from SUMMARY_FIELDS).
+def analyze(paths, concurrent=()):
+    concurrent = [os.path.abspath(directory) for directory in concurrent]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, names in sorted(os.walk(path)):
+                files.extend(os.path.join(directory, name) for name in sorted(names) if not name.endswith(".py"))
+        else:
+            files.append(path)
+
+    rows = []
+    throughputs = {}
+    for path in files:
+        parsed = parse_results(path)
+        if parsed is None:
+            continue
+        kind, values, summary = parsed
+        row = {'path': path, 'kind': kind, 'unit': "ms" if kind == "latency" else "Mbit/s"}
+        row.update(summarize(values))
+        if kind == "flows":
+            row['jfi'] = jainsall(values)
+        if summary is not None:
+            row['throughput'] = summary
+            directory = os.path.dirname(path)
+            if any(os.path.commonpath([os.path.abspath(directory), c]) == c for c in concurrent):
+                throughputs.setdefault(directory, []).append(summary)
+        rows.append(row)
+
+    for directory, values in throughputs.items():
+        if len(values) > 1:
+            rows.append({'path': directory, 'kind': "fairness", 'unit': "Mbit/s", 'samples': len(values),
+                         'throughput': sum(values), 'jfi': jainsall(values)})
+    return rows
+
+
+# Writes analyze rows as CSV, with numbers rounded to 4 decimals.
+# Arguments: rows (list) - The rows.
+#            out (file) - The file to write to.
+# Returns: None.
+def write_summary(rows, out):
+    writer = csv.DictWriter(out, SUMMARY_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({key: round(value, 4) if isinstance(value, float) else value for key, value in row.items()})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Jain's fairness index and bulk analysis of simpleperf results")
+    parser.add_argument("paths", nargs="*", default=["tc5"],
+                        help="a throughput list to compute the fairness index of (default tc5), or with --analyze, "
+                             "result files and directories such as testCase1 testCase2")
+    parser.add_argument("--analyze", action="store_true",
+                        help="write a CSV summary of every result file under the given paths")
+    parser.add_argument("--concurrent", nargs="+", default=[], metavar="DIR",
+                        help="with --analyze, directories whose throughput files are flows that ran at the same time, "
+                             "such as testCase4 testCase5; only their directories get a fairness row")
+    parser.add_argument("-o", "--out", type=str, default=None, help="file for the --analyze summary (default stdout)")
+    args = parser.parse_args()
+
+    if args.analyze:
+        if args.out:
+            with open(args.out, "w", newline="") as out:
+                write_summary(analyze(args.paths, args.concurrent), out)
+        else:
+            write_summary(analyze(args.paths, args.concurrent), sys.stdout)
+    else:
+        liste = []  # empty list
 
-with open("tc5") as file:  # Open the file "task3.txt"
-    for line in file:
-        throughputs = line.split()  # Splitting the lines
-        print(throughputs)  # Printing the lines "elements" in the list for overview
-        liste.append(float(throughputs[0]))  # Adding the values as elements to the list
+        with open(args.paths[0]) as file:  # Open the throughput list, "tc5" by default
+            for line in file:
+                throughputs = line.split()  # Splitting the lines
+                print(throughputs)  # Printing the lines "elements" in the list for overview
+                liste.append(float(throughputs[0]))  # Adding the values as elements to the list
 
-print(jainsall(liste))  # Calling the jainsall function with the list of values as parametre
\ No newline at end of file
+        print(jainsall(liste))  # Calling the jainsall function with the list of values as parametre
@@ -1,9 +1,23 @@
-import argparse
+from array import array
+import collections
+import errno
+import mmap
+import os
 import sys
 import threading
 import time
 from socket import *
-import re
+import functools
+import io
+import itertools
+import math
+import selectors
+import signal
+import struct
+
+# argparse, csv, http.server, json, multiprocessing, random and re are imported by the functions that use them, so
+# that importing simpleperf as a library, and starting a client or server that does not need them, stays fast (json
+# imports re).
 
 # This is the main script for Simpleperf, a simplified version of iPerf for measuring network throughput.
 
@@ -13,6 +27,7 @@ import re
 # Arguments: num_str (string) - A string containing the number and its unit (e.g. '10MB')
 # Returns: num (int) - The integer value of the number in bytes.
 def parse_num_bytes(num_str):
+    import re
     units = {'B': 1, 'KB': 1000, 'MB': 1000 * 1000}
     match = re.match(r"([0-9]+)([a-z]+)", num_str, re.I)
     if match:
@@ -28,6 +43,18 @@ def parse_num_bytes(num_str):
     return num
 
 
+# Converts a rate string with an optional unit (K, M, G) to bits per second, e.g. '10M' is 10 000 000.
+# Arguments: rate_str (string) - A string containing the rate and its unit.
+# Returns: rate (int) - The rate in bits per second.
+def parse_bandwidth(rate_str):
+    import re
+    units = {'': 1, 'K': 1000, 'M': 1000 * 1000, 'G': 1000 * 1000 * 1000}
+    match = re.fullmatch(r"([0-9]+(?:\.[0-9]+)?)([a-z]?)", rate_str, re.I)
+    if not match or match.group(2).upper() not in units:
+        raise ValueError(f"Invalid rate '{rate_str}'. Use a number with an optional unit K, M or G, e.g. 10M")
+    return int(float(match.group(1)) * units[match.group(2).upper()])
+
+
 # Formats a summary line for printing, with the columns aligned based on the maximum width of each column.
 # Arguments: headers (list) - A list of strings containing the column headers.
 #            data (list) - A list of strings containing the data to be printed.
@@ -37,221 +64,3588 @@ def format_summary_line(headers, data):
     return " ".join((val.ljust(width) for val, width in zip(data, max_widths)))
 
 
+# Computes Jain's fairness index of throughput values: 1 when all values are equal, down to 1/n when one value takes
+# everything. The same formula as jainsall in jfi/jfi.py.
+# Arguments: values (list) - The throughputs.
+# Returns: The index (float), 1.0 if there are no values or all are zero.
+def jains_index(values):
+    denominator = len(values) * sum(value * value for value in values)
+    return sum(values) ** 2 / denominator if denominator else 1.0
+
+
+# Prints an informational message: the banners, separators and errors around the results. With machine-readable
+# output they go to stderr, so that stdout only holds result records; with the "none" output of the library API they
+# are not printed.
+# Arguments: message (string) - The message.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def print_info(message, format_unit):
+    if format_unit.get('output') == "none":
+        return
+    print(message, file=sys.stdout if format_unit.get('output', "text") == "text" else sys.stderr)
+
+
+# The fields of a result record in json and csv output. Every record has a type and an ID; the other fields are
+# filled in where they apply to the record type and left empty otherwise.
+RECORD_FIELDS = ("type", "id", "start", "end", "bytes", "bits_per_second", "requests", "min_ms", "p50_ms", "p90_ms",
+                 "p99_ms", "p99.9_ms", "max_ms", "jitter_ms", "lost", "total", "out_of_order", "duplicates", "jfi",
+                 "cwnd", "rtt_ms", "rttvar_ms", "retransmits", "pacing_bits_per_second", "disk_seconds",
+                 "connections", "connections_per_second")
+
+
+# Writes the column header of csv output. It is written once, before the test starts.
+# Arguments: format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def write_record_header(format_unit):
+    if format_unit.get('output') == "csv":
+        import csv
+        csv.writer(sys.stdout).writerow(RECORD_FIELDS)
+        sys.stdout.flush()
+
+
+# Writes one result record as a line of JSON or csv and flushes it, so that a reader sees every record as soon as
+# it is produced. With the "none" output, which run_matrix uses for the tests it collects the results of, nothing is
+# written.
+# Arguments: record (dict) - The record, with keys from RECORD_FIELDS.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def write_record(record, format_unit):
+    if format_unit['output'] == "none":
+        return
+    if format_unit['output'] == "json":
+        import json
+        line = json.dumps(record)
+    else:
+        import csv
+        out = io.StringIO()
+        csv.writer(out).writerow(record.get(field, "") for field in RECORD_FIELDS)
+        line = out.getvalue().rstrip("\r\n")
+    print(line, flush=True)
+
+
 # Server functions
 
-# Sets up a server listening on the given IP and port, and accepts incoming connections. For each connection, a new
-# thread is started to handle the client.
+# Default size of the buffer each server connection receives into.
+RECV_BUFFER = 256 * 1000
+
+# Largest receive buffer a client can ask for in a control session, see serve_session.
+MAX_RECV_BUFFER = 16 * 1000 * 1000
+
+
+# Sets up a server listening on the given IP and port, and accepts incoming connections. With the thread engine a new
+# thread is started to handle each client; with the async engine all clients are served by one event loop. With
+# workers > 1, that many processes accept on the same port (SO_REUSEPORT) and the kernel spreads the connections over
+# them.
 # Arguments: server_ip (string) - The IP address of the server.
 #            server_port (int) - The port number on which the server should listen.
 #            format_unit (dict) - A dictionary containing the format unit and its corresponding divisor.
+#            recv_buffer (int) - The size of the receive buffer of each connection, in bytes.
+#            engine (string) - "thread" or "async".
+#            backlog (int) - The length of the accept queue of the listening socket.
+#            workers (int) - The number of acceptor processes.
+#            interval (float or None) - Print the throughput of every active flow, their sum and Jain's fairness
+#                                       index per interval of this many seconds (see report_flows). With workers > 1
+#                                       every worker reports the flows it serves.
+#            socket_options (dict or None) - Options set on the listening socket, which the accepted connections
+#                                            inherit; see apply_socket_options.
+#            sink (str or None) - A file or directory the received data of stream tests is written to, see
+#                                 receive_file.
+#            series (TimeSeries or None) - A time series the bytes of every flow are recorded into, see
+#                                         record_series. Only with one worker.
 # Returns: None.
-def server(server_ip, server_port, format_unit):
+def server(server_ip, server_port, format_unit, recv_buffer=RECV_BUFFER, engine="thread", backlog=SOMAXCONN,
+           workers=1, interval=None, socket_options=None, sink=None, series=None):
     # Set up socket and listen for incoming connections
     try:
+        if workers > 1:
+            serve_processes(server_ip, server_port, format_unit, recv_buffer, engine, backlog, workers, interval,
+                            socket_options, sink)
+            return
+
         # Set up socket and listen for incoming connections
         with socket(AF_INET, SOCK_STREAM) as server_socket:
+            apply_socket_options(server_socket, socket_options)
+            tune_listener(server_socket)
             server_socket.bind((server_ip, server_port))
-            server_socket.listen(5)
+            server_socket.listen(backlog)
 
-            print(f"---------------------------------------------")
-            print(f"A simpleperf server is listening on port {server_port}")
-            print(f"---------------------------------------------")
+            print_info(f"---------------------------------------------", format_unit)
+            print_info(f"A simpleperf server is listening on port {server_port}", format_unit)
+            print_info(f"---------------------------------------------", format_unit)
+            write_record_header(format_unit)
 
-            # Accept incoming connections and receive data
-            while True:
-                connection, client_address = server_socket.accept()
-                # create a new thread to handle each client connection
-                client_thread = threading.Thread(target=handle_client, args=(connection, client_address, format_unit))
-                client_thread.start()
+            serve(server_socket, format_unit, recv_buffer, engine,
+                  registry=start_flow_reporter(interval, format_unit, series), sink=sink)
 
     except ConnectionError as e:
-        print(f"Failed to connect to server: {e}")
+        print_info(f"Failed to connect to server: {e}", format_unit)
+
+
+# Runs the selected server engine on a listening socket.
+# Arguments: server_socket (socket) - The listening socket.
+#            format_unit (dict) - A dictionary containing the format unit and its corresponding divisor.
+#            recv_buffer (int) - The size of the receive buffer of each connection, in bytes.
+#            engine (string) - "thread" or "async".
+#            totals (Array or None) - Shared [connections, bytes] counters of this process, see serve_processes.
+#            registry (FlowRegistry or None) - The registry the active flows are kept in for report_flows.
+#            sink (str or None) - The file or directory received stream data is written to, see server.
+#            stop (Event or None) - Set before the listening socket is shut down to end the engine, see Server.
+# Returns: None.
+def serve(server_socket, format_unit, recv_buffer, engine, totals=None, registry=None, sink=None, stop=None):
+    if engine == "async":
+        serve_async(server_socket, format_unit, recv_buffer, totals, registry, sink, stop)
+    else:
+        serve_threads(server_socket, format_unit, recv_buffer, totals, registry, sink, stop)
+
+
+# Binds one SO_REUSEPORT listening socket per worker on the same port and serves each from its own forked process.
+# Every process counts its finished connections and transferred bytes in its own shared array; on Ctrl-C the workers are
+# stopped and the counters are merged into one report.
+# Arguments: see server.
+# Returns: None.
+def serve_processes(server_ip, server_port, format_unit, recv_buffer, engine, backlog, workers, interval=None,
+                    socket_options=None, sink=None):
+    import multiprocessing
+    context = multiprocessing.get_context("fork")
+    processes = []
+    all_totals = []
+    for _ in range(workers):
+        # Bind in this process so that a port conflict is reported before anything is forked
+        server_socket = socket(AF_INET, SOCK_STREAM)
+        server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        apply_socket_options(server_socket, socket_options)
+        tune_listener(server_socket)
+        server_socket.bind((server_ip, server_port))
+        server_socket.listen(backlog)
+        totals = context.Array('Q', 2)
+        processes.append(context.Process(target=serve_worker,
+                                         args=(server_socket, format_unit, recv_buffer, engine, totals, interval,
+                                               sink)))
+        all_totals.append(totals)
+        # The child inherits the socket when it is forked, so the parent's copy can be closed right after
+        processes[-1].start()
+        server_socket.close()
+
+    print_info(f"---------------------------------------------", format_unit)
+    print_info(f"A simpleperf server is listening on port {server_port} ({workers} workers)", format_unit)
+    print_info(f"---------------------------------------------", format_unit)
+    write_record_header(format_unit)
+
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for p in processes:
+            p.terminate()
+            p.join()
+
+    connections = sum(totals[0] for totals in all_totals)
+    transferred_bytes = sum(totals[1] for totals in all_totals)
+    if format_unit.get('output', "text") != "text":
+        write_record({'type': "server_sum", 'id': "[SUM]", 'bytes': transferred_bytes, 'total': connections},
+                     format_unit)
+        return
+    transferred_data = transferred_bytes / format_unit['divisor']
+    print(f"[SUM] {connections} connections, transferred {transferred_data:.2f} {format_unit['unit']}")
+
+
+# Entry point of a server worker process. Ctrl-C is left to the parent, which stops the workers and prints the
+# merged report.
+# Arguments: see serve.
+# Returns: None.
+def serve_worker(server_socket, format_unit, recv_buffer, engine, totals, interval=None, sink=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    with server_socket:
+        serve(server_socket, format_unit, recv_buffer, engine, totals, start_flow_reporter(interval, format_unit),
+              sink)
+
+
+# Accepts incoming connections and starts a new thread running handle_client for each of them. Connections of crr
+# tests are served by accept_crr in this loop instead, when their request is already there.
+# Arguments: see serve.
+# Returns: None.
+def serve_threads(server_socket, format_unit, recv_buffer, totals=None, registry=None, sink=None, stop=None):
+    # Accept incoming connections and receive data
+    while True:
+        try:
+            connection, client_address = server_socket.accept()
+        except OSError:
+            if stop is not None and stop.is_set():
+                return
+            raise
+        if accept_crr(connection, client_address, time.time_ns(), totals, format_unit):
+            continue
+        # create a new thread to handle each client connection
+        client_thread = threading.Thread(target=handle_client,
+                                         args=(connection, client_address, format_unit, recv_buffer, totals, registry,
+                                               sink))
+        client_thread.start()
 
 
-# Receives data from the client, calculates the received data size and bandwidth, and prints a summary.
+# Reads the hello message of a client connection and runs the requested test with run_test.
 # Arguments: connection (socket) - The socket object representing the client connection.
 #            client_address (tuple) - A tuple containing the client's IP address and port number.
 #            format_unit (dict) - A dictionary containing the format unit and its corresponding divisor.
+#            recv_buffer (int) - The size of the receive buffer, in bytes.
+#            totals (Array or None) - Shared [connections, bytes] counters of this process, see serve_processes.
+#            registry (FlowRegistry or None) - The registry of active flows, see serve.
+#            sink (str or None) - The file or directory received stream data is written to, see server.
+# Returns: None.
+def handle_client(connection, client_address, format_unit, recv_buffer=RECV_BUFFER, totals=None, registry=None,
+                  sink=None):
+    try:
+        hello = recv_message(connection)
+    except (ConnectionError, ValueError) as e:
+        print_info(f"Connection with {client_address[0]}:{client_address[1]} lost: {e}", format_unit)
+        if isinstance(e, ValueError):
+            # Answer a peer that does not speak the protocol like an unsupported test
+            try:
+                send_message(connection, {'error': str(e)})
+            except OSError:
+                pass
+        connection.close()
+        return
+    run_test(connection, client_address, hello, format_unit, recv_buffer, totals, registry, sink)
+
+
+# Runs the test a client asked for in its hello message, prints a summary and closes the connection.
+# In "stream" mode the server receives data, or in reverse and bidir tests also sends (see send_test); in "latency"
+# mode it echoes every byte back to the client; in "udp" mode it opens a UDP socket for the test and receives
+# datagrams on it while the connection serves as control channel.
+# The client ends a test by shutting down its sending side, so the end of the stream is the end of the test and every
+# received byte is counted. The server then answers with a result message and closes the connection; in reverse and
+# bidir tests the end of the server's own stream takes the place of the result message.
+# While the test runs, the connection is a flow in the registry, and the loops keep its byte counters up to date.
+# With a sink, a stream test is received into a file with receive_file, and the result message also holds the time
+# the server spent on the disk.
+# Arguments: connection (socket) - The client connection, with the hello message already read.
+#            hello (dict) - The hello message.
+#            Other arguments: see handle_client.
 # Returns: None.
-def handle_client(connection, client_address, format_unit):
-    # Initialize variables to track received data and time elapsed
+def run_test(connection, client_address, hello, format_unit, recv_buffer=RECV_BUFFER, totals=None, registry=None,
+             sink=None):
+    flow_id = flow_name(client_address)
+    flow = None
+    with connection:
+        try:
+            error = hello_error(hello)
+            if error is not None:
+                send_message(connection, {'error': error})
+                return
+            mode = hello['mode']
+            direction = hello.get('direction', "send")
+            if mode == "session":
+                serve_session(connection, flow_id, format_unit, recv_buffer)
+                return
+            if mode == "crr":
+                # A crr request that accept_crr could not serve, answered the same way without the accept latency
+                request = recv_exact(connection, hello['size'])
+                connection.sendall(encode_message({'ready': True}) + request)
+                count_connection(totals, 2 * len(request))
+                return
+            if mode == "latency":
+                connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            ready = {'ready': True}
+            if mode == "udp":
+                udp_socket = open_udp_socket(connection)
+                ready['port'] = udp_socket.getsockname()[1]
+            send_message(connection, ready)
+
+            # Initialize variables to track received data and time elapsed
+            start_time = time.time()
+            buffer = bytearray(hello.get('recv_buffer') or recv_buffer)
+            udp_report = None
+            sent_bytes = 0
+            disk_seconds = None
+            if registry is not None:
+                flow = registry.add(flow_id)
+            if mode == "latency":
+                received_bytes = echo_stream(connection, buffer, flow)
+            elif mode == "udp":
+                stats = UdpStats()
+                with udp_socket:
+                    receive_datagrams(connection, udp_socket, buffer, stats, flow)
+                received_bytes = stats.bytes
+                udp_report = stats.report()
+            elif direction != "send":
+                sent_bytes, received_bytes = send_test(connection, buffer, hello, flow)
+            elif sink is not None:
+                try:
+                    received_bytes, disk_seconds = receive_file(connection, sink_path(sink, hello, client_address),
+                                                                hello, flow)
+                except ConnectionError:
+                    raise
+                except OSError as e:
+                    # A disk error, e.g. ENOSPC from the preallocation or EIO from fsync, fails the test: the rest of
+                    # the stream is read and dropped, and the result message reports the error to the client
+                    print_info(f"Sink of {flow_id} failed: {e}", format_unit)
+                    receive_stream(connection, buffer)
+                    send_message(connection, {'error': f"the server's sink failed: {e}"})
+                    return
+            else:
+                received_bytes = receive_stream(connection, buffer, flow)
+
+            # Get the time elapsed since the start of the test and report the result to the client
+            end_time = time.time()
+            if direction == "send":
+                result = {'bytes': received_bytes, 'seconds': end_time - start_time, 'udp': udp_report}
+                if disk_seconds is not None:
+                    result['disk_seconds'] = disk_seconds
+                send_message(connection, result)
+
+        except (ConnectionError, ValueError) as e:
+            print_info(f"Connection with {flow_id} lost: {e}", format_unit)
+            return
+        finally:
+            if flow is not None:
+                registry.remove(flow_id)
+
+    print_server_summary(received_bytes, end_time - start_time, format_unit, totals, udp_report, client_address,
+                         sent_bytes, disk_seconds)
+
+
+# Serves a control session: one connection over which a client runs many tests back to back (see run_matrix). The
+# server answers the session hello with its receive buffer size, then every test message with the parameters it
+# accepted for the test, and prints the name of each test so that its output is split up by test. The test
+# connections themselves are separate, and carry the accepted parameters in their hello messages. The session ends
+# when the client shuts down its side.
+# Arguments: connection (socket) - The session connection, with the hello message already read.
+#            flow_id (str) - The client's address, "ip:port".
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            recv_buffer (int) - The server's default receive buffer size, in bytes.
+# Returns: None.
+def serve_session(connection, flow_id, format_unit, recv_buffer):
+    send_message(connection, {'ready': True, 'recv_buffer': recv_buffer})
+    print_info(f"Control session with {flow_id}", format_unit)
+    while connection.recv(1, MSG_PEEK):
+        try:
+            message = recv_message(connection)
+        except ValueError as e:
+            # After a malformed frame the stream is out of step, so the session ends with the error
+            send_message(connection, {'error': str(e)})
+            raise
+        config = message.get('config', {}) if isinstance(message, dict) else None
+        if not isinstance(config, dict):
+            send_message(connection, {'error': "protocol error: a test message is a JSON object with a config object"})
+            continue
+        size = config.get('recv_buffer') or recv_buffer
+        if not isinstance(size, int) or size <= 0:
+            send_message(connection, {'error': f"invalid receive buffer size {size!r}"})
+            continue
+        print_info(f"Test {message.get('test')} from {flow_id}", format_unit)
+        send_message(connection, {'ready': True, 'recv_buffer': min(size, MAX_RECV_BUFFER)})
+    print_info(f"Control session with {flow_id} ended", format_unit)
+
+
+# Runs the server side of a reverse or bidir stream test. The server sends for the duration or number of bytes in
+# the hello message with the same send loop as the client, while a second thread receives what the client sends
+# (nothing in a reverse test). The server only ends its stream once the client has shut down its own, so the end of
+# the server's stream tells the client that both directions are done; it ends it with a STREAM_RESULT, which lets the
+# client tell a complete stream from one cut short by a server that went away.
+# Arguments: connection (socket) - The client connection.
+#            buffer (bytearray) - The receive buffer.
+#            hello (dict) - The hello message, with the duration, num_bytes, message_size and bandwidth of the test.
+#            flow (list or None) - The connection's [received, sent] byte counters in the FlowRegistry.
+# Returns: (sent_bytes, received_bytes) - The number of bytes sent and received. Raises ConnectionError if the
+#          client's stream broke off.
+def send_test(connection, buffer, hello, flow=None):
+    if flow is None:
+        flow = [0, 0]
+    payload = memoryview(b'0' * hello['message_size'])
+    outcome = []
+    receiver = threading.Thread(target=receive_outcome, args=(outcome, receive_stream, connection, buffer, flow, 0))
+    receiver.start()
+    sent_bytes = send_stream(connection, payload, hello['duration'], hello.get('num_bytes'),
+                             bandwidth=hello.get('bandwidth'), counter=flow, index=1)
+    receiver.join()
+    received_bytes, = outcome
+    if isinstance(received_bytes, OSError):
+        raise ConnectionError(received_bytes)
+    connection.sendall(STREAM_RESULT.pack(STREAM_RESULT_MAGIC, sent_bytes, received_bytes))
+    connection.shutdown(SHUT_WR)
+    return sent_bytes, received_bytes
+
+
+# Runs a receive loop in a thread of its own and keeps what it returns, or the OSError that ended it (e.g. a reset
+# connection), for the thread that joins it, so that a lost connection is reported by that thread and does not end
+# the receiving thread with a traceback.
+# Arguments: outcome (list) - The list the result or the error is appended to.
+#            receive (function) - The receive loop, e.g. receive_stream.
+#            args - The arguments of the receive loop.
+# Returns: None.
+def receive_outcome(outcome, receive, *args):
+    try:
+        outcome.append(receive(*args))
+    except OSError as e:
+        outcome.append(e)
+
+
+# Receives into one preallocated buffer until the other side half-closes the connection.
+# Arguments: connection (socket) - The connection.
+#            buffer (bytearray) - The receive buffer.
+#            counter (array or None) - If given, the number of bytes received so far is kept in counter[index], for
+#                                      the interval collector or for a caller running this in a thread.
+#            index (int) - The index in counter.
+# Returns: received_bytes (int) - The number of bytes received.
+def receive_stream(connection, buffer, counter=None, index=0):
     received_bytes = 0
-    start_time = time.time()
+    recv_into = connection.recv_into
+    while True:
+        received = recv_into(buffer)
+        if not received:
+            return received_bytes
+
+        # Add the length of the received data to the total number of received bytes
+        received_bytes += received
+        if counter is not None:
+            counter[index] = received_bytes
+
 
-    # Continuously receive data from the client until the BYE message is received
+# Receives the server's stream of a reverse or bidir test like receive_stream, and takes the STREAM_RESULT at its end
+# off the stream. Only the last STREAM_RESULT.size bytes are kept while receiving, so the loop stays as cheap as
+# receive_stream.
+# Arguments: see receive_stream.
+# Returns: (received_bytes, sent_bytes, server_received) - The bytes of the stream without the result, and the bytes
+#          the server sent and received by its result. Raises ConnectionError if the stream ended without a result.
+def receive_server_stream(connection, buffer, counter=None, index=0):
+    size = STREAM_RESULT.size
+    received_bytes = 0
+    tail = b""
+    recv_into = connection.recv_into
     while True:
-        data = connection.recv(1000)
-        if data == b"BYE":
-            # Send an acknowledgement message and break out of the loop
-            connection.sendall(b"ACK:BYE")
+        received = recv_into(buffer)
+        if not received:
             break
+        received_bytes += received
+        tail = bytes(buffer[received - size:received]) if received >= size else (tail + buffer[:received])[-size:]
+        if counter is not None:
+            counter[index] = received_bytes
+    received_bytes -= size
+    if len(tail) < size or received_bytes < 0:
+        raise ConnectionError("the server's stream ended without a result")
+    magic, sent_bytes, server_received = STREAM_RESULT.unpack(tail)
+    if magic != STREAM_RESULT_MAGIC:
+        raise ConnectionError("the server's stream ended without a result")
+    if counter is not None:
+        counter[index] = received_bytes
+    return received_bytes, sent_bytes, server_received
 
-        # Add the length of the received data to the total number of received bytes
-        received_bytes += len(data)
 
-    # Get the time elapsed since the start of the connection and close the socket
-    end_time = time.time()
-    connection.close()
+# Sends every received byte straight back to the client until the client half-closes the connection.
+# Arguments: connection (socket) - The client connection.
+#            buffer (bytearray) - The receive buffer.
+#            counter (list or None) - If given, the number of bytes echoed so far is kept in counter[0].
+# Returns: received_bytes (int) - The number of bytes echoed.
+def echo_stream(connection, buffer, counter=None):
+    received_bytes = 0
+    view = memoryview(buffer)
+    recv_into = connection.recv_into
+    sendall = connection.sendall
+    while True:
+        received = recv_into(buffer)
+        if not received:
+            return received_bytes
+        sendall(view[:received])
+        received_bytes += received
+        if counter is not None:
+            counter[0] = received_bytes
+
+
+# Opens the UDP socket of a udp test on the address the client connected to, on a port chosen by the kernel.
+# Arguments: connection (socket) - The control connection of the test.
+# Returns: udp_socket (socket) - The bound, non-blocking UDP socket.
+def open_udp_socket(connection):
+    udp_socket = socket(AF_INET, SOCK_DGRAM)
+    udp_socket.bind((connection.getsockname()[0], 0))
+    udp_socket.setblocking(False)
+    return udp_socket
+
+
+# Receives the datagrams of a udp test until the client half-closes the control connection. The datagrams that are
+# still queued on the UDP socket at that point are counted too.
+# Arguments: connection (socket) - The control connection of the test.
+#            udp_socket (socket) - The test's non-blocking UDP socket.
+#            buffer (bytearray) - The receive buffer.
+#            stats (UdpStats) - The statistics the datagrams are recorded in.
+#            counter (list or None) - If given, the number of bytes received so far is kept in counter[0].
+# Returns: None.
+def receive_datagrams(connection, udp_socket, buffer, stats, counter=None):
+    with selectors.DefaultSelector() as selector:
+        selector.register(connection, selectors.EVENT_READ)
+        selector.register(udp_socket, selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is udp_socket:
+                    drain_datagrams(udp_socket, buffer, stats)
+                    if counter is not None:
+                        counter[0] = stats.bytes
+                elif not connection.recv(1):
+                    drain_datagrams(udp_socket, buffer, stats)
+                    return
+
+
+# Reads every datagram queued on a non-blocking UDP socket into the same buffer and records it.
+# Python has no recvmmsg, so this is the batching: one wakeup, then recv_into until the queue is empty.
+# Arguments: udp_socket (socket) - A non-blocking UDP socket.
+#            buffer (bytearray) - The receive buffer, at least UDP_HEADER.size bytes.
+#            stats (UdpStats) - The statistics the datagrams are recorded in.
+# Returns: None.
+def drain_datagrams(udp_socket, buffer, stats):
+    recv_into = udp_socket.recv_into
+    unpack_from = UDP_HEADER.unpack_from
+    record = stats.record
+    clock = time.time_ns
+    while True:
+        try:
+            received = recv_into(buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        if received >= UDP_HEADER.size:
+            seq, sent_ns = unpack_from(buffer)
+            record(seq, sent_ns, received, clock())
+
+
+# Serves every client connection from a single selectors event loop (epoll on Linux) instead of one thread per
+# connection. The loop is the only reader, so all connections share one receive buffer. Each connection goes through
+# the same steps as in handle_client: read the hello message, receive or echo until the client half-closes, answer
+# with the result message and close. Outgoing data that does not fit in the socket buffer is queued, and the
+# connection is not read again until the queue is flushed.
+# Arguments: see serve.
+# Returns: None.
+def serve_async(server_socket, format_unit, recv_buffer, totals=None, registry=None, sink=None, stop=None):
+    selector = selectors.DefaultSelector()
+    server_socket.setblocking(False)
+    selector.register(server_socket, selectors.EVENT_READ)
+    buffer = bytearray(recv_buffer)
+    view = memoryview(buffer)
+
+    while True:
+        for key, events in selector.select():
+            if key.fileobj is server_socket:
+                # Accept every connection waiting in the accept queue, not just one per wakeup
+                while True:
+                    try:
+                        connection, client_address = server_socket.accept()
+                    except BlockingIOError:
+                        break
+                    except OSError:
+                        if stop is not None and stop.is_set():
+                            # Close the connections that are still open, nothing serves them after the loop
+                            for other in list(selector.get_map().values()):
+                                if other.fileobj is not server_socket:
+                                    other.fileobj.close()
+                            selector.close()
+                            return
+                        raise
+                    if accept_crr(connection, client_address, time.time_ns(), totals, format_unit):
+                        continue
+                    connection.setblocking(False)
+                    selector.register(connection, selectors.EVENT_READ,
+                                      {'address': client_address, 'mode': None, 'inbox': bytearray(), 'outbox': b"",
+                                       'received': 0, 'start_time': time.time(), 'closing': False, 'flow': None})
+                continue
+
+            connection, state = key.fileobj, key.data
+            if state.get('kind') == "udp":
+                drain_datagrams(connection, buffer, state['stats'])
+                if state['flow'] is not None:
+                    state['flow'][0] = state['stats'].bytes
+                continue
+            try:
+                if events & selectors.EVENT_WRITE:
+                    async_flush(selector, connection, state, format_unit, totals)
+                    continue
+                if state['mode'] is None:
+                    async_hello(selector, connection, state, format_unit, recv_buffer, totals, registry, sink)
+                    continue
+
+                received = connection.recv_into(buffer)
+                if not received:
+                    # The client half-closed the connection, report the result like handle_client does
+                    end_time = time.time()
+                    if state['mode'] == "udp":
+                        async_close_udp(selector, state, buffer)
+                    if state['flow'] is not None:
+                        registry.remove(flow_name(state['address']))
+                    state['end_time'] = end_time
+                    state['closing'] = True
+                    state['outbox'] += encode_message({'bytes': state['received'],
+                                                       'seconds': end_time - state['start_time'],
+                                                       'udp': state.get('udp_report')})
+                elif state['mode'] == "latency":
+                    state['received'] += received
+                    state['outbox'] += view[:received]
+                    if state['flow'] is not None:
+                        state['flow'][0] = state['received']
+                else:
+                    state['received'] += received
+                    if state['flow'] is not None:
+                        state['flow'][0] = state['received']
+                    continue
+                async_flush(selector, connection, state, format_unit, totals)
+
+            except BlockingIOError:
+                continue
+            except (ConnectionError, ValueError) as e:
+                print_info(f"Connection with {flow_name(state['address'])} lost: {e}", format_unit)
+                if 'udp_socket' in state:
+                    async_close_udp(selector, state, buffer)
+                if state['flow'] is not None and not state['closing']:
+                    registry.remove(flow_name(state['address']))
+                selector.unregister(connection)
+                connection.close()
+
+
+# Ends the UDP part of a udp test served by serve_async: counts the datagrams still queued, closes the UDP socket and
+# stores the statistics in the control connection's state.
+# Arguments: selector (DefaultSelector) - The event loop's selector.
+#            state (dict) - The control connection's state, see serve_async.
+#            buffer (bytearray) - The shared receive buffer.
+# Returns: None.
+def async_close_udp(selector, state, buffer):
+    udp_socket = state.pop('udp_socket')
+    stats = selector.unregister(udp_socket).data['stats']
+    drain_datagrams(udp_socket, buffer, stats)
+    udp_socket.close()
+    state['received'] = stats.bytes
+    state['udp_report'] = stats.report()
+
+
+# Reads the hello message of a connection served by serve_async and answers it with a ready or error message.
+# Reverse and bidir tests are handed to a thread running run_test, so that the server sends with the same blocking
+# send loop as the client instead of one send call per wakeup; so are control sessions, stream tests on a server
+# with a sink, which receive into a file with receive_file, stream tests with their own receive buffer size, and the
+# rare crr requests that accept_crr left because they had not fully arrived.
+# Arguments: selector (DefaultSelector) - The event loop's selector.
+#            connection (socket) - The client connection.
+#            state (dict) - The connection's state, see serve_async.
+#            format_unit (dict) - A dictionary containing the format unit and its corresponding divisor.
+#            recv_buffer (int) - The size of the receive buffer of a connection handed to run_test, in bytes.
+#            totals (Array or None) - Shared [connections, bytes] counters of this process, see serve_processes.
+#            registry (FlowRegistry or None) - The registry of active flows, see serve.
+#            sink (str or None) - The file or directory received stream data is written to, see server.
+# Returns: None.
+def async_hello(selector, connection, state, format_unit, recv_buffer, totals, registry=None, sink=None):
+    # Only read up to the end of the hello message, the client does not send more before it gets an answer
+    inbox = state['inbox']
+    try:
+        if len(inbox) < MESSAGE_HEADER.size:
+            need = MESSAGE_HEADER.size - len(inbox)
+        else:
+            need = MESSAGE_HEADER.size + message_length(inbox) - len(inbox)
+        chunk = connection.recv(need)
+        if not chunk:
+            raise ConnectionError("connection closed before the hello message was complete")
+        inbox += chunk
+        hello = decode_message(inbox)
+        if hello is None:
+            return
+        error = hello_error(hello)
+    except ValueError as e:
+        # Answer a peer that does not speak the protocol like an unsupported test
+        print_info(f"Connection with {flow_name(state['address'])} lost: {e}", format_unit)
+        error = str(e)
+    if error is not None:
+        state['closing'] = True
+        state['outbox'] = encode_message({'error': error})
+        async_flush(selector, connection, state, format_unit, totals)
+        return
+
+    mode = hello['mode']
+    if (hello.get('direction', "send") != "send" or mode == "session"
+            or mode == "crr" or (mode == "stream" and (sink is not None or 'recv_buffer' in hello))):
+        selector.unregister(connection)
+        connection.setblocking(True)
+        threading.Thread(target=run_test, args=(connection, state['address'], hello, format_unit, recv_buffer, totals,
+                                                registry, sink)).start()
+        return
+    else:
+        if mode == "latency":
+            connection.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        ready = {'ready': True}
+        if registry is not None:
+            state['flow'] = registry.add(flow_name(state['address']))
+        if mode == "udp":
+            udp_socket = state['udp_socket'] = open_udp_socket(connection)
+            selector.register(udp_socket, selectors.EVENT_READ,
+                              {'kind': "udp", 'stats': UdpStats(), 'flow': state['flow']})
+            ready['port'] = udp_socket.getsockname()[1]
+        state['mode'] = mode
+        state['start_time'] = time.time()
+        state['outbox'] = encode_message(ready)
+    async_flush(selector, connection, state, format_unit, totals)
+
+
+# Sends as much of a connection's queued output as the socket accepts. The connection only waits for writability
+# while output is queued. Once a closing connection is flushed, it is closed and its summary printed.
+# Arguments: see async_hello.
+# Returns: None.
+def async_flush(selector, connection, state, format_unit, totals):
+    outbox = state['outbox']
+    if outbox:
+        sent = connection.send(outbox)
+        outbox = state['outbox'] = outbox[sent:]
+    if outbox:
+        if selector.get_key(connection).events != selectors.EVENT_WRITE:
+            selector.modify(connection, selectors.EVENT_WRITE, state)
+        return
+    if state['closing']:
+        selector.unregister(connection)
+        connection.close()
+        if state['mode'] is not None:
+            print_server_summary(state['received'], state['end_time'] - state['start_time'], format_unit, totals,
+                                 state.get('udp_report'), state['address'])
+        return
+    if selector.get_key(connection).events != selectors.EVENT_READ:
+        selector.modify(connection, selectors.EVENT_READ, state)
+
+
+# Prints the summary of one client connection on the server. The bytes the server sent in a reverse or bidir test
+# are reported separately from the bytes it received.
+# Arguments: received_bytes (int) - The number of bytes received from the client.
+#            time_elapsed (float) - The duration of the connection, in seconds.
+#            format_unit (dict) - A dictionary containing the format unit and its corresponding divisor.
+#            totals (Array or None) - Shared [connections, bytes] counters the connection is added to.
+#            udp_report (dict or None) - The UdpStats report of a udp test.
+#            client_address (tuple or None) - The client's IP address and port number.
+#            sent_bytes (int) - The number of bytes sent to the client.
+#            disk_seconds (float or None) - The time spent writing the received data to the sink, see receive_file.
+# Returns: None.
+def print_server_summary(received_bytes, time_elapsed, format_unit, totals=None, udp_report=None,
+                         client_address=None, sent_bytes=0, disk_seconds=None):
+    count_connection(totals, received_bytes + sent_bytes)
+
+    # The directions of the connection: only the received one, unless the server sent
+    directions = [("Received", " RX", received_bytes)] if received_bytes or not sent_bytes else []
+    if sent_bytes:
+        directions.append(("Sent", " TX", sent_bytes))
 
-    # Calculate the amount of data received, bandwidth, and time elapsed
-    time_elapsed = end_time - start_time
-    received_data = received_bytes / format_unit['divisor']
-    bandwidth = received_data / time_elapsed
+    if format_unit.get('output', "text") != "text":
+        address = f"{client_address[0]}:{client_address[1]}" if client_address else ""
+        for _, suffix, num_bytes in directions:
+            record = {'type': "server", 'id': address + (suffix if sent_bytes else ""), 'start': 0.0,
+                      'end': time_elapsed, 'bytes': num_bytes,
+                      'bits_per_second': num_bytes * 8 / time_elapsed if time_elapsed else 0.0}
+            if udp_report is not None:
+                record.update((key, udp_report[key])
+                              for key in ("jitter_ms", "lost", "total", "out_of_order", "duplicates"))
+            if disk_seconds is not None:
+                record['disk_seconds'] = disk_seconds
+            write_record(record, format_unit)
+        return
 
-    # Modify the summary line to use format_unit
-    summary = f"Received {received_data:.2f} {format_unit['unit']} in {time_elapsed:.2f} seconds\n" \
-              f"Bandwidth: {bandwidth:.2f} {format_unit['unit']}ps"
+    # Calculate the amount of data transferred, bandwidth, and time elapsed, and modify the summary lines to use
+    # format_unit. The bandwidth is in bits per second like the client's tables and the server's interval rows.
+    lines = []
+    for label, _, num_bytes in directions:
+        data = num_bytes / format_unit['divisor']
+        bandwidth = data * 8 / time_elapsed if time_elapsed else 0.0
+        lines.append(f"{label} {data:.2f} {format_unit['unit']} in {time_elapsed:.2f} seconds\n"
+                     f"Bandwidth: {bandwidth:.2f} {format_unit['unit']}ps")
+    summary = "\n".join(lines)
+    if udp_report is not None:
+        summary += f"\nJitter: {udp_report['jitter_ms']:.3f} ms, Lost: {udp_report['lost']}/{udp_report['total']}, " \
+                   f"Out-of-order: {udp_report['out_of_order']}, Duplicates: {udp_report['duplicates']}"
+    if disk_seconds is not None:
+        summary += f"\nWritten to disk in {disk_seconds:.2f} seconds"
     # Print the summary line
     print(summary)
 
 
+# Adds a finished connection and the bytes it transferred to the shared totals of a server process.
+# Arguments: totals (Array or None) - Shared [connections, bytes] counters, see serve_processes; None counts nothing.
+#            num_bytes (int) - The number of bytes the connection received and sent.
+# Returns: None.
+def count_connection(totals, num_bytes):
+    if totals is not None:
+        with totals.get_lock():
+            totals[0] += 1
+            totals[1] += num_bytes
+
+
+# Flow registry
+
+# The active flows of a server, for the interval reports of report_flows. Every flow has its own [received, sent]
+# list of byte counters, which only the loops of its connection write to; the lock is only taken when a flow is added
+# or removed, and once per interval by the reporter, so the receive and send loops never wait for it. A removed flow
+# stays in the registry until the reporter has counted its last bytes.
+class FlowRegistry:
+    __slots__ = ('lock', 'flows', 'finished')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flows = {}
+        self.finished = []
+
+    # Adds a flow.
+    # Arguments: flow_id (str) - The ID of the flow, see flow_name.
+    # Returns: The flow's [received, sent] byte counters (list).
+    def add(self, flow_id):
+        counters = [0, 0]
+        with self.lock:
+            self.flows[flow_id] = counters
+        return counters
+
+    # Marks a flow as finished.
+    # Arguments: flow_id (str) - The ID of the flow.
+    # Returns: None.
+    def remove(self, flow_id):
+        with self.lock:
+            self.finished.append(flow_id)
+
+    # Reads the number of bytes every flow has transferred so far and drops the finished flows.
+    # Returns: A list of (flow_id, transferred_bytes) tuples.
+    def snapshot(self):
+        with self.lock:
+            flows = [(flow_id, counters[0] + counters[1]) for flow_id, counters in self.flows.items()]
+            for flow_id in self.finished:
+                self.flows.pop(flow_id, None)
+            self.finished.clear()
+        return flows
+
+    # Reads the number of bytes every flow has transferred so far, like snapshot, but leaves the finished flows to it.
+    # Returns: A list of (flow_id, transferred_bytes) tuples.
+    def sample(self):
+        with self.lock:
+            return [(flow_id, counters[0] + counters[1]) for flow_id, counters in self.flows.items()]
+
+
+# Returns the ID of a client connection's flow, "ip:port".
+def flow_name(client_address):
+    return f"{client_address[0]}:{client_address[1]}"
+
+
+# Starts report_flows in a daemon thread if an interval is given, and record_series if a time series is.
+# Arguments: interval (float or None) - The interval length, in seconds.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            series (TimeSeries or None) - The time series the bytes of every flow are recorded into.
+# Returns: registry (FlowRegistry or None) - The registry the server's connections add their flows to.
+def start_flow_reporter(interval, format_unit, series=None):
+    if not interval and series is None:
+        return None
+    registry = FlowRegistry()
+    if interval:
+        threading.Thread(target=report_flows, args=(registry, interval, format_unit), daemon=True).start()
+    if series is not None:
+        # Without report_flows, the recorder is the one that drops the finished flows
+        sample = registry.sample if interval else registry.snapshot
+        threading.Thread(target=record_series, args=(series, sample), daemon=True).start()
+    return registry
+
+
+# Prints, on every interval, the throughput of each flow that was active during the interval, their aggregate as a
+# [SUM] row, and Jain's fairness index of the flows' throughputs. Ticks are scheduled from the start time like in
+# collect_intervals; intervals without flows are not printed.
+# Arguments: registry (FlowRegistry) - The server's active flows.
+#            interval (float) - The interval length, in seconds.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def report_flows(registry, interval, format_unit):
+    start = time.monotonic()
+    previous = {}
+    tick = 1
+    while True:
+        time.sleep(max(0.0, start + tick * interval - time.monotonic()))
+        flows = registry.snapshot()
+        begin, end = (tick - 1) * interval, tick * interval
+        tick += 1
+        if not flows:
+            previous = {}
+            continue
+
+        deltas = [(flow_id, transferred - previous.get(flow_id, 0)) for flow_id, transferred in flows]
+        previous = dict(flows)
+        records = [transfer_record("server_interval", flow_id, begin, end, delta) for flow_id, delta in deltas]
+        fairness = jains_index([record['bits_per_second'] for record in records])
+        total = transfer_record("server_interval", "[SUM]", begin, end, sum(delta for _, delta in deltas))
+        total.update(total=len(records), jfi=fairness)
+        print_transfer_records(records + [total], format_unit)
+        if format_unit.get('output', "text") == "text":
+            print(f"Jain's fairness index: {fairness:.4f} ({len(records)} flows)")
+
+
+# UDP statistics
+
+# Header at the start of every udp test datagram: the sequence number and the send time in nanoseconds.
+UDP_HEADER = struct.Struct("!QQ")
+
+# Largest UDP payload over IPv4: 65535 bytes minus the IP and UDP headers.
+UDP_MAX_PAYLOAD = 65507
+
+# Default target rate of udp tests, in bits per second.
+UDP_BANDWIDTH = 1000 * 1000
+
+# Number of datagrams sent between two clock reads. Python has no sendmmsg, so this is the batching.
+UDP_BATCH = 64
+
+
+# Loss, reordering, duplicate and jitter statistics of one udp test, kept in a fixed amount of memory. The sequence
+# numbers seen in the last WINDOW positions below the highest one are kept as a bitmap; a datagram inside the window
+# is either a duplicate (its bit is set) or arrived out of order. Loss is the number of sequence numbers up to the
+# highest one that never arrived. Jitter is the RFC 3550 interarrival jitter.
+class UdpStats:
+    WINDOW = 1024
+    WINDOW_MASK = (1 << WINDOW) - 1
+
+    __slots__ = ('packets', 'bytes', 'max_seq', 'window', 'out_of_order', 'duplicates', 'jitter', 'transit')
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.max_seq = -1
+        self.window = 0
+        self.out_of_order = 0
+        self.duplicates = 0
+        self.jitter = 0.0
+        self.transit = None
+
+    # Records one datagram.
+    # Arguments: seq (int) - The sequence number of the datagram.
+    #            sent_ns (int) - The send time from the datagram header.
+    #            size (int) - The size of the datagram.
+    #            arrival_ns (int) - The arrival time, on the same kind of clock as sent_ns.
+    # Returns: None.
+    def record(self, seq, sent_ns, size, arrival_ns):
+        self.packets += 1
+        ahead = seq - self.max_seq
+        if ahead > 0:
+            self.window = ((self.window << ahead) | 1) & self.WINDOW_MASK if ahead < self.WINDOW else 1
+            self.max_seq = seq
+        elif -ahead >= self.WINDOW:
+            # Too old to tell whether it is a duplicate
+            self.out_of_order += 1
+        elif self.window >> -ahead & 1:
+            self.duplicates += 1
+            return
+        else:
+            self.window |= 1 << -ahead
+            self.out_of_order += 1
+        self.bytes += size
+
+        # RFC 3550: J += (|D(i-1, i)| - J) / 16, where D is the difference in transit time of consecutive datagrams
+        transit = arrival_ns - sent_ns
+        if self.transit is not None:
+            self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+        self.transit = transit
+
+    # Returns the statistics as a dict, as sent in the result message of a udp test.
+    def report(self):
+        total = self.max_seq + 1
+        return {'packets': self.packets, 'bytes': self.bytes, 'total': total,
+                'lost': max(0, total - (self.packets - self.duplicates)), 'out_of_order': self.out_of_order,
+                'duplicates': self.duplicates, 'jitter_ms': self.jitter / 1e6}
+
+
+# Control messages
+
+# Every test connection starts with a hello message from the client that names the test mode, which the server
+# answers with a ready or an error message. When the test is over the server sends a result message. Messages are
+# JSON objects prefixed with their length as a 4-byte integer.
+MESSAGE_HEADER = struct.Struct("!I")
+
+# Largest control message a peer may send. A length above it is a protocol error rather than a buffer to allocate, so
+# that a peer that does not speak the protocol (e.g. an old client sending data right away) cannot make the server
+# allocate up to 4 GB for one connection.
+MAX_MESSAGE = 64 * 1024
+
+# The result a server sends at the end of its stream in a reverse or bidir test, after the last data byte and before it
+# shuts down its sending side: a magic value, the bytes it sent and the bytes it received. The client cannot tell a
+# result message apart from the data of the stream, so this one has a fixed size and is taken from the end of the
+# stream; a stream that ends without it was cut short, see receive_server_stream.
+STREAM_RESULT = struct.Struct("!4sQQ")
+STREAM_RESULT_MAGIC = b"SPRS"
+
+# The test modes a server accepts in a hello message. A "session" connection runs no test itself, it is the control
+# session of a test matrix, see serve_session. A "crr" connection carries a single request, see crr_worker.
+TEST_MODES = ("stream", "latency", "udp", "session", "crr")
+
+# The directions of a stream test: the client sends, the server sends ("reverse"), or both send at once ("bidir").
+DIRECTIONS = ("send", "reverse", "bidir")
+
+
+# Checks that the server supports the test asked for in a hello message.
+# Arguments: hello - The decoded hello message, a dict unless the client sent some other JSON value.
+# Returns: An error message for the client (str), or None if the test is supported.
+def hello_error(hello):
+    if not isinstance(hello, dict):
+        return "protocol error: the hello message is not a JSON object"
+    mode = hello.get('mode')
+    if mode not in TEST_MODES:
+        return f"unsupported test mode {mode!r}"
+    direction = hello.get('direction', "send")
+    if direction not in DIRECTIONS or (direction != "send" and mode != "stream"):
+        return f"unsupported direction {direction!r} for {mode} tests"
+    if direction != "send":
+        # The parameters of the server's send loop, see send_test
+        for field, required in (("message_size", True), ("duration", True), ("num_bytes", False),
+                                 ("bandwidth", False)):
+            value = hello.get(field)
+            if value is None and not required:
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+                return f"invalid {field} {value!r} for a {direction} test"
+        if not isinstance(hello['message_size'], int) or hello['message_size'] > MAX_RECV_BUFFER:
+            return f"unsupported message size {hello['message_size']!r}"
+    recv_buffer = hello.get('recv_buffer')
+    if recv_buffer is not None and not (isinstance(recv_buffer, int) and 0 < recv_buffer <= MAX_RECV_BUFFER):
+        return f"unsupported receive buffer size {recv_buffer!r}"
+    # The part of a file a stream sends to a sink, see receive_file
+    part = [hello.get(key) for key in ("file_offset", "file_size", "file_total")]
+    if any(value is not None for value in part):
+        if not all(isinstance(value, int) and not isinstance(value, bool) and value >= 0 for value in part):
+            return f"invalid file part {part!r}"
+        if part[0] + part[1] > part[2]:
+            return f"file part {part[0]} + {part[1]} is beyond the end of the file ({part[2]} bytes)"
+    if not isinstance(hello.get('file_name', ""), str):
+        return f"invalid file name {hello['file_name']!r}"
+    size = hello.get('size')
+    if mode == "crr" and not (isinstance(size, int) and 0 <= size <= MAX_RECV_BUFFER):
+        return f"unsupported request size {size!r}"
+    return None
+
+
+# Encodes a control message.
+# Arguments: message (dict) - The message.
+# Returns: The length-prefixed message (bytes).
+def encode_message(message):
+    import json
+    body = json.dumps(message).encode()
+    return MESSAGE_HEADER.pack(len(body)) + body
+
+
+# Reads the body length from the header at the start of a buffer.
+# Arguments: data (bytearray) - At least MESSAGE_HEADER.size received bytes.
+# Returns: The length of the message body, in bytes. Raises ValueError if it is larger than MAX_MESSAGE.
+def message_length(data):
+    length = MESSAGE_HEADER.unpack_from(data)[0]
+    if length > MAX_MESSAGE:
+        raise ValueError(f"protocol error: control message of {length} bytes")
+    return length
+
+
+# Decodes a control message from the start of a buffer.
+# Arguments: data (bytearray) - The received bytes.
+# Returns: The message (dict), or None if the buffer does not hold a complete message yet. Raises ValueError if the
+#          buffer does not start with a valid message.
+def decode_message(data):
+    if len(data) < MESSAGE_HEADER.size:
+        return None
+    end = MESSAGE_HEADER.size + message_length(data)
+    if len(data) < end:
+        return None
+    import json
+    return json.loads(bytes(data[MESSAGE_HEADER.size:end]))
+
+
+# Sends a control message.
+# Arguments: sock (socket) - A connected socket.
+#            message (dict) - The message.
+# Returns: None.
+def send_message(sock, message):
+    sock.sendall(encode_message(message))
+
+
+# Receives one control message.
+# Arguments: sock (socket) - A connected socket.
+# Returns: The message (dict). Raises ValueError if the peer does not send a valid message.
+def recv_message(sock):
+    header = recv_exact(sock, MESSAGE_HEADER.size)
+    return decode_message(header + recv_exact(sock, message_length(header)))
+
+
+# Receives exactly size bytes.
+# Arguments: sock (socket) - A connected socket.
+#            size (int) - The number of bytes to receive.
+# Returns: The received bytes (bytearray).
+def recv_exact(sock, size):
+    data = bytearray(size)
+    recv_into_exact(sock, memoryview(data))
+    return data
+
+
+# Fills a buffer completely from a socket.
+# Arguments: sock (socket) - A connected socket.
+#            view (memoryview) - The buffer to fill.
+# Returns: None.
+def recv_into_exact(sock, view):
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            raise ConnectionError("connection closed by the peer")
+        view = view[received:]
+
+
 # Client functions
 # client(server_ip, server_port, duration, interval, parallel, num_bytes=None):
 # Starts the client, which creates the specified number of parallel connections to the server and sends data.
+# The streams run as threads; with workers > 1 they are spread over that many processes so that they are not limited
+# to one core by the GIL. The workers only update their stream's counters; a collector thread in this process prints
+# the interval statistics of all streams, and the results of all streams are printed together at the end.
 # Arguments:
 # - server_ip (string): IP address of the server.
 # - server_port (int): Port number on which the server is listening.
 # - duration (int): Total duration for which data should be generated.
-# - interval (int): Print statistics per z second.
+# - interval (float): Print statistics per z second.
 # - parallel (int): Number of parallel connections to the server.
 # - message_size (int): Number of bytes in each message sent by the client.
 # - format_unit (dict): A dictionary containing the format unit and its corresponding divisor.
 # - num_bytes (int or None): Number of bytes to transfer. If None, the transfer is indefinite.
-# Returns: None.
-def client(server_ip, server_port, duration, interval, parallel, message_size, format_unit, num_bytes=None):
-    if num_bytes is not None:
+# - zerocopy (bool): Send with MSG_ZEROCOPY instead of copying the payload into the kernel.
+# - workers (int): Number of processes the streams are spread over.
+# - latency (bool): Run latency_worker request/response streams instead of sending bulk data.
+# - rate (float): Requests per second of each latency stream, or 0 for back-to-back requests.
+# - udp (bool): Run udp_worker datagram streams instead of TCP streams.
+# - bandwidth (int or None): Target rate of each stream in bits per second. TCP streams are unpaced by default, udp
+#   streams default to UDP_BANDWIDTH.
+# - direction (str): Direction of TCP streams, see DIRECTIONS. In a bidir test every stream has a row per direction,
+#   and both directions count towards the [SUM] row.
+# - socket_options (dict or None): Options set on the socket of every TCP stream, see apply_socket_options.
+# - tcp_info (bool): Sample TCP_INFO of every TCP stream and print it with the interval statistics.
+# - file (str or None): Send this file instead of generated data. The streams each send a part of it (see file_range)
+#   after the file has been read once in a disk phase, and the disk and network phases are reported next to the
+#   streams (see print_file_summary).
+# - omit (float): Seconds at the start of a timed TCP stream test that are left out of the summary, so that slow
+#   start does not count. The streams run for omit + duration seconds.
+# - recv_buffer (int or None): Receive buffer size the server uses for the test's connections, see serve_session.
+# - crr (bool): Run crr_worker streams, which open a new connection for every request of message_size bytes, and
+#   report the connection rate and the connect, transaction and accept times (see print_crr_summary).
+# - series (TimeSeries or None): Record the counter of every stream into this time series while the test runs, see
+#   record_series; its unit is set to the bytes of the streams, or to the connections of crr streams.
+# A stream that fails prints why and is counted in the result; the other streams carry on. The control connection
+# failing before a test starts raises ConnectionError.
+# Returns: result (ClientResult) - The results of the streams.
+def client(server_ip, server_port, duration, interval, parallel, message_size, format_unit, num_bytes=None,
+           zerocopy=False, workers=1, latency=False, rate=0, udp=False, bandwidth=None, direction="send",
+           socket_options=None, tcp_info=False, file=None, omit=0, recv_buffer=None, crr=False, series=None):
+    if num_bytes is not None or file is not None:
         # Set the duration to a large number to ensure all bytes are sent
         duration = sys.maxsize
+    else:
+        duration += omit
+
+    # Per-stream counters, in shared memory if worker processes report back to this one. 'sent' holds the bytes
+    # transferred by each stream; in a bidir test the received bytes of stream i are in slot rx_offset + i. 'failed'
+    # marks the streams that lost their connection.
+    directions = 2 if direction == "bidir" else 1
+    shared = workers > 1 and parallel > 1
+    counters = {'sent': counter_array('Q', parallel * directions, shared),
+                'elapsed': counter_array('d', parallel * directions, shared),
+                'failed': counter_array('B', parallel, shared),
+                'rx_offset': parallel if direction == "bidir" else 0}
+    if tcp_info and interval:
+        # The latest TCP_INFO sample of each stream, see sample_streams, and the sockets of this process's streams
+        counters['tcp_info'] = counter_array('d', parallel * directions * len(TCP_INFO_FIELDS), shared)
+        counters['sockets'] = {}
+    if file is not None:
+        # The time the server spent writing each stream to its sink, see receive_file
+        counters['disk_write'] = counter_array('d', parallel, shared)
+    if interval and not latency and not crr:
+        # The interval ends and the bytes of every stream per interval, for the result, see collect_intervals
+        counters['samples'] = (array('d'), array('Q'))
+    if latency:
+        target = latency_worker
+        args = (server_ip, server_port, duration, interval, format_unit, message_size, rate)
+        counters['histograms'] = [counter_array('Q', LatencyHistogram.SLOTS, shared) for _ in range(parallel)]
+    elif crr:
+        target = crr_worker
+        args = (server_ip, server_port, duration, interval, format_unit, message_size, socket_options)
+        counters['connections'] = counter_array('Q', parallel, shared)
+        for _, key in CRR_TIMES:
+            counters[key] = [counter_array('Q', LatencyHistogram.SLOTS, shared) for _ in range(parallel)]
+    elif udp:
+        target = udp_worker
+        args = (server_ip, server_port, duration, interval, format_unit, message_size, num_bytes,
+                bandwidth or UDP_BANDWIDTH)
+        # The server's report of every stream, UDP_REPORT_FIELDS stream by stream, see udp_worker
+        counters['udp'] = counter_array('d', parallel * len(UDP_REPORT_FIELDS), shared)
+    else:
+        target = client_worker
+        args = (server_ip, server_port, duration, interval, format_unit, message_size, num_bytes, zerocopy, bandwidth,
+                direction, socket_options, file, recv_buffer)
+
+    write_record_header(format_unit)
+    start_time = time.monotonic()
+    if file is not None:
+        read_seconds = read_file(file)
+
+    # Latency streams print their own histograms, the others are sampled by the collector
+    stream_ids = [f"{server_ip}:{server_port}" + (f" [{i + 1}]" if parallel > 1 else "") for i in range(parallel)]
+    if direction == "reverse":
+        stream_ids = [stream_id + " RX" for stream_id in stream_ids]
+    elif direction == "bidir":
+        stream_ids = [stream_id + " TX" for stream_id in stream_ids] + [stream_id + " RX" for stream_id in stream_ids]
+    stop = threading.Event()
+    collector = None
+    if interval and not latency:
+        collector_args = (counters, stream_ids, interval, time.monotonic(), stop, format_unit)
+        if crr:
+            collector_args += ("connections", print_connection_interval)
+        collector = threading.Thread(target=collect_intervals, args=collector_args)
+        collector.start()
+    recorder = None
+    if series is not None:
+        series.unit = "connections" if crr else "bytes"
+        # zip reads the live counters on every sample
+        sample = functools.partial(zip, stream_ids, counters['connections' if crr else 'sent'])
+        recorder = threading.Thread(target=record_series, args=(series, sample, stop))
+        recorder.start()
+    if omit and target is client_worker:
+        counters['omitted'] = counter_array('Q', len(counters['sent']), shared)
+        threading.Thread(target=omit_counters, args=(counters, omit, stop), daemon=True).start()
+
     try:
-        threads = []
-        for _ in range(parallel):
-            # Start a new thread for each connection to the server
-            t = threading.Thread(target=client_worker, args=(
-                server_ip, server_port, duration, interval, format_unit, message_size, num_bytes))
+        if shared:
+            # Deal the streams out round-robin over the worker processes
+            import multiprocessing
+            context = multiprocessing.get_context("fork")
+            processes = [context.Process(target=client_process,
+                                         args=(target, range(w, parallel, workers), args, counters, interval))
+                         for w in range(min(workers, parallel))]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+        else:
+            client_process(target, range(parallel), args, counters, interval)
+    finally:
+        stop.set()
+        if collector is not None:
+            collector.join()
+        if recorder is not None:
+            recorder.join()
+
+    records = None
+    if latency:
+        records = [latency_record("latency_summary", stream_id, 0.0, elapsed, LatencyHistogram(counts))
+                   for stream_id, counts, elapsed in zip(stream_ids, counters['histograms'], counters['elapsed'])
+                   if elapsed]
+        if parallel > 1:
+            merged = LatencyHistogram()
+            for counts in counters['histograms']:
+                merged.merge(LatencyHistogram(counts))
+            print_latency_interval("[SUM]", 0, max(counters['elapsed']), merged, format_unit, summary=True)
+            records.append(latency_record("latency_summary", "[SUM]", 0.0, max(counters['elapsed']), merged))
+    elif crr:
+        records = print_crr_summary(counters, stream_ids, format_unit)
+    elif udp:
+        # Every stream has printed the server's report of it, which takes the place of the summary table
+        records = [udp_record(stream_id, elapsed, report)
+                   for stream_id, elapsed, report in zip(stream_ids, counters['elapsed'], udp_reports(counters))
+                   if report is not None]
+    else:
+        records = print_client_summary(counters, stream_ids, format_unit, omit if 'omitted' in counters else 0.0)
+    if file is not None:
+        print_file_summary(counters, os.path.getsize(file), read_seconds, time.monotonic() - start_time, format_unit)
+    return ClientResult(stream_ids, counters, records)
 
-            t.start()
-            threads.append(t)
 
-        # Wait for all threads to finish
-        for t in threads:
-            t.join()
+# Allocates a per-stream counter array of zeros: a plain array when all streams run in this process, or a RawArray
+# in shared memory that forked worker processes write to.
+# Arguments: typecode (str) - The array type code, e.g. 'Q' or 'd'.
+#            size (int) - The number of elements.
+#            shared (bool) - Whether the array is shared with worker processes.
+# Returns: The array.
+def counter_array(typecode, size, shared):
+    if shared:
+        import multiprocessing
+        return multiprocessing.RawArray(typecode, size)
+    return array(typecode, bytes(array(typecode).itemsize * size))
 
-    except ConnectionError as e:
-        # Handle connection error and exit with status code testCase3
-        print(f"Connection lost during transfer: {e}")
-        sys.exit(1)
 
+# The result of a client test, returned by client and run_client. The per-stream values are arrays in the order of
+# stream_ids. With -i, interval_ends holds the end of every interval in seconds since the start, and interval_bytes
+# the bytes of every stream in every interval, stream by stream: interval i of stream s is at
+# i * len(stream_ids) + s. No object is created per sample, so long tests with short intervals stay cheap. In a crr
+# test, connections holds the number of connections of every stream. In a latency test, histograms holds the
+# round-trip times of every stream (a LatencyHistogram each, see latency), and bytes the bytes of the requests sent;
+# in a crr test it holds the connect times. In a udp test, udp holds the server's report of every stream: a dict of
+# UDP_REPORT_FIELDS, or None for a stream that failed before it got one.
+class ClientResult:
+    __slots__ = ('stream_ids', 'bytes', 'seconds', 'failed', 'connections', 'interval_ends', 'interval_bytes',
+                 'records', 'histograms', 'udp')
+
+    # Arguments: stream_ids (list) - The ID of each stream.
+    #            counters (dict) - The per-stream counters of the test, see client.
+    #            records (list or None) - The summary records of the test, see print_client_summary.
+    def __init__(self, stream_ids, counters, records):
+        self.stream_ids = stream_ids
+        self.bytes = array('Q', counters['sent'])
+        self.seconds = array('d', counters['elapsed'])
+        self.failed = sum(counters['failed'])
+        self.connections = array('Q', counters.get('connections', ()))
+        self.interval_ends, self.interval_bytes = counters.get('samples') or (array('d'), array('Q'))
+        self.records = records or []
+        # Copied out of the counters, which may be shared memory
+        self.histograms = [LatencyHistogram(array('Q', counts)) for counts in counters.get('histograms', ())]
+        self.udp = udp_reports(counters) if 'udp' in counters else []
+
+    # The throughput of all streams together in bits per second, over the duration of the longest one.
+    @property
+    def bits_per_second(self):
+        seconds = max(self.seconds, default=0.0)
+        return sum(self.bytes) * 8 / seconds if seconds else 0.0
+
+    # The round-trip times of a latency test at the given percentiles (0-100), in milliseconds.
+    # Arguments: percents (tuple or None) - The percentiles, by default LATENCY_PERCENTILES.
+    #            stream (int or None) - The index of the stream in stream_ids, or None for all streams together.
+    # Returns: The times (list of float).
+    def latency(self, percents=None, stream=None):
+        if stream is not None:
+            histogram = self.histograms[stream]
+        else:
+            histogram = LatencyHistogram()
+            for h in self.histograms:
+                histogram.merge(h)
+        return [value / 1e6 for value in histogram.percentiles(percents or LATENCY_PERCENTILES)]
+
+    # Yields (begin, end, bytes) for every interval of one stream.
+    # Arguments: stream (int) - The index of the stream in stream_ids.
+    def intervals(self, stream):
+        count = len(self.stream_ids)
+        begin = 0.0
+        for i, end in enumerate(self.interval_ends):
+            yield begin, end, self.interval_bytes[i * count + stream]
+            begin = end
+
+
+# Runs the given streams as threads in the current process and waits for them to finish.
+# Arguments: target (function) - client_worker, latency_worker or udp_worker.
+#            streams (range) - The indexes of the streams to run.
+#            args (tuple) - The worker arguments shared by all streams.
+#            counters (dict) - The shared per-stream counters, see client.
+#            interval (float or None) - The interval length; with TCP_INFO sampling, sample_streams runs in this
+#                                       process while the streams run.
+# Returns: None.
+def client_process(target, streams, args, counters, interval=None):
+    stop = threading.Event()
+    if 'sockets' in counters:
+        threading.Thread(target=sample_streams, args=(counters, interval, stop), daemon=True).start()
+    threads = []
+    for stream in streams:
+        # Start a new thread for each connection to the server
+        t = threading.Thread(target=target, args=args, kwargs={'stream': stream, 'counters': counters})
+        t.start()
+        threads.append(t)
+
+    # Wait for all threads to finish
+    for t in threads:
+        t.join()
+    stop.set()
 
-# client_worker(server_ip, server_port, duration, interval, format_unit, message_size, num_bytes=None):
-# Connects to the server, sends data to it for the given duration, and prints statistics at specified intervals.
+
+# Samples the transferred byte counters of all streams on a fixed interval clock and prints a row per stream plus a
+# [SUM] row; with another key and printer, other counters, such as the connections of a crr test. Ticks are scheduled
+# from the start time (start + k * interval), so the intervals do not drift, and the streams never spend time on
+# formatting. When the streams are done, the last partial interval is printed.
+# Arguments: counters (dict) - The shared per-stream counters, see client.
+#            stream_ids (list) - The ID column of each stream.
+#            interval (float) - The interval length, in seconds.
+#            start (float) - The start of the test on the time.monotonic clock.
+#            stop (Event) - Set when all streams are done.
+#            format_unit (dict) - A dictionary containing the format unit and its corresponding divisor.
+#            key (str) - The counters to sample.
+#            printer (function or None) - Prints the rows of an interval, print_interval by default.
+# Returns: None.
+def collect_intervals(counters, stream_ids, interval, start, stop, format_unit, key="sent", printer=None):
+    printer = printer or print_interval
+    sent = counters[key]
+    previous = list(sent)
+    tcp_info = counters.get('tcp_info')
+    fields = len(TCP_INFO_FIELDS)
+    retransmits = [0.0] * len(stream_ids)
+    begin = 0.0
+    tick = 1
+    while True:
+        stopped = stop.wait(max(0.0, start + tick * interval - time.monotonic()))
+        end = time.monotonic() - start if stopped else tick * interval
+        current = list(sent)
+        deltas = [c - p for c, p in zip(current, previous)]
+        samples = None
+        if tcp_info is not None:
+            # The retransmit count of TCP_INFO is a total, the interval gets the retransmits since the last tick
+            samples = [tcp_info[i * fields:(i + 1) * fields] for i in range(len(stream_ids))]
+            for i, sample in enumerate(samples):
+                sample[3], retransmits[i] = sample[3] - retransmits[i], sample[3]
+        if not stopped or (end - begin > 1e-3 and any(deltas)):
+            printer(stream_ids, begin, end, deltas, format_unit, samples)
+            if 'samples' in counters:
+                counters['samples'][0].append(end)
+                counters['samples'][1].extend(deltas)
+        if stopped:
+            return
+        previous = current
+        begin = end
+        tick += 1
+
+
+# Prints the interval statistics of all streams as one table: a row per stream, and a [SUM] row if there is more than
+# one stream.
+# Arguments: stream_ids (list) - The ID column of each stream.
+#            begin (float) - The start of the interval, in seconds since the start of the test.
+#            end (float) - The end of the interval, in seconds since the start of the test.
+#            sent (list) - The number of bytes each stream sent during the interval.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            samples (list or None) - The TCP_INFO values of each stream (see TCP_INFO_FIELDS), with the retransmits
+#                                     of the interval; a stream without a sample has a cwnd of 0.
+# Returns: None.
+def print_interval(stream_ids, begin, end, sent, format_unit, samples=None):
+    records = [transfer_record("interval", stream_id, begin, end, sent_bytes)
+               for stream_id, sent_bytes in zip(stream_ids, sent)]
+    if samples is not None:
+        for record, sample in zip(records, samples):
+            if sample[0]:
+                record.update(zip(TCP_INFO_FIELDS, sample))
+                record['cwnd'] = int(record['cwnd'])
+                record['retransmits'] = int(record['retransmits'])
+    if len(records) > 1:
+        records.append(transfer_record("interval", "[SUM]", begin, end, sum(sent)))
+        if samples is not None:
+            records[-1]['retransmits'] = sum(record.get('retransmits', 0) for record in records)
+    print_transfer_records(records, format_unit)
+
+
+# Prints the final results: a row per stream over its own duration, and a [SUM] row if there is more than one stream.
+# With omitted seconds (see omit_counters), the rows start after them and leave out the bytes sent before.
+# Arguments: counters (dict) - The shared per-stream counters, see client.
+#            stream_ids (list) - The ID column of each stream.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            omit (float) - The number of omitted seconds at the start of the test.
+# Returns: records (list) - The printed records, see transfer_record.
+def print_client_summary(counters, stream_ids, format_unit, omit=0.0):
+    omitted = counters.get('omitted') or [0] * len(stream_ids)
+    records = [transfer_record("summary", stream_id, omit, elapsed, sent_bytes - skipped)
+               for stream_id, sent_bytes, skipped, elapsed in zip(stream_ids, counters['sent'], omitted,
+                                                                  counters['elapsed']) if elapsed]
+    if len(stream_ids) > 1:
+        records.append(transfer_record("summary", "[SUM]", omit, max(counters['elapsed']),
+                                       sum(counters['sent']) - sum(omitted)))
+    print_info("----------------------------------------------------", format_unit)
+    print_transfer_records(records, format_unit)
+    return records
+
+
+# Records the bytes every stream has sent when the omitted seconds at the start of a test are over, so that the
+# summary can leave them out. The interval rows of the omitted seconds are still printed.
+# Arguments: counters (dict) - The shared per-stream counters, see client.
+#            omit (float) - The number of seconds to omit.
+#            stop (Event) - Set when all streams are done; a test that ends earlier has nothing omitted.
+# Returns: None.
+def omit_counters(counters, omit, stop):
+    if not stop.wait(omit):
+        counters['omitted'][:] = counters['sent'][:]
+
+
+# Builds the result record of a number of bytes transferred during an interval.
+# Arguments: kind (str) - The record type, "interval" or "summary".
+#            stream_id (str) - The ID of the stream.
+#            begin (float) - The start of the interval, in seconds since the start of the test.
+#            end (float) - The end of the interval, in seconds since the start of the test.
+#            sent_bytes (int) - The number of bytes transferred during the interval.
+# Returns: The record (dict).
+def transfer_record(kind, stream_id, begin, end, sent_bytes):
+    return {'type': kind, 'id': stream_id, 'start': begin, 'end': end, 'bytes': sent_bytes,
+            'bits_per_second': sent_bytes * 8 / (end - begin) if end > begin else 0.0}
+
+
+# Prints transfer records as an ID / Interval / Transfer / Bandwidth table, or as json or csv records.
+# Arguments: records (list) - Records built by transfer_record.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def print_transfer_records(records, format_unit):
+    if format_unit.get('output', "text") != "text":
+        for record in records:
+            write_record(record, format_unit)
+        return
+    unit, divisor = format_unit['unit'], format_unit['divisor']
+    headers = ["ID", "Interval", "Transfer", "Bandwidth"]
+    rows = [[record['id'], f"{record['start']:.2f} - {record['end']:.2f}", f"{record['bytes'] / divisor:.2f} {unit}",
+             f"{record['bits_per_second'] / divisor:.2f} {unit}ps"] for record in records]
+    if any('retransmits' in record for record in records):
+        headers += ["Cwnd", "RTT", "RTTvar", "Retr", "Pacing"]
+        for row, record in zip(rows, records):
+            if 'cwnd' in record:
+                row += [str(record['cwnd']), f"{record['rtt_ms']:.2f} ms", f"{record['rttvar_ms']:.2f} ms",
+                        str(record['retransmits']), f"{record['pacing_bits_per_second'] / divisor:.2f} {unit}ps"]
+            else:
+                row += ["", "", "", str(record.get('retransmits', "")), ""]
+    print_table(headers, rows)
+
+
+# Prints a table with the columns aligned to the widest value of each column.
+# Arguments: headers (list) - The column headers.
+#            rows (list) - The rows, each a list of strings.
+# Returns: None.
+def print_table(headers, rows):
+    table = [headers] + rows
+    max_widths = [max(map(len, col)) for col in zip(*table)]
+    print("\n".join(" ".join(val.ljust(width) for val, width in zip(row, max_widths)) for row in table))
+
+
+# client_worker(server_ip, server_port, duration, interval, format_unit, message_size, num_bytes=None, zerocopy=False,
+#               bandwidth=None, direction="send", socket_options=None, file=None, recv_buffer=None, stream=0,
+#               counters=None):
+# Connects to the server and sends data to it for the given duration with send_stream, which updates the stream's
+# byte counter after every batch for the interval collector. In a reverse test the server sends instead and this
+# stream receives with receive_stream; in a bidir test a second thread receives while this one sends.
 # Arguments:
 # - server_ip (string): IP address of the server.
 # - server_port (int): Port number on which the server is listening.
 # - duration (int): Total duration for which data should be generated.
-# - interval (int): Print statistics per z second.
+# - interval (float): Unused, the intervals are printed by collect_intervals.
 # - format_unit (dict): A dictionary containing the format unit and its corresponding divisor.
 # - message_size (int): Number of bytes in each message sent by the client.
 # - num_bytes (int or None): Number of bytes to transfer. If None, the transfer is indefinite.
+# - zerocopy (bool): Send with MSG_ZEROCOPY instead of copying the payload into the kernel.
+# - bandwidth (int or None): Target rate in bits per second, enforced by a TokenBucket. None sends as fast as possible.
+# - direction (str): "send", "reverse" or "bidir", see DIRECTIONS. The server sends with the same duration, number of
+#   bytes, message size and bandwidth.
+# - socket_options (dict or None): Options set on the socket before it connects, see apply_socket_options.
+# - file (str or None): Send this stream's part of the file with send_file instead of generated data. The duration
+#   is then the time until the server confirmed the part, without the time its sink spent on the disk.
+# - recv_buffer (int or None): Receive buffer size the server uses for this connection, see serve_session.
+# - stream (int): Index of this stream in counters.
+# - counters (dict or None): Shared per-stream counters, see client.
 # Returns: None.
-def client_worker(server_ip, server_port, duration, interval, format_unit, message_size, num_bytes=None):
+def client_worker(server_ip, server_port, duration, interval, format_unit, message_size, num_bytes=None,
+                  zerocopy=False, bandwidth=None, direction="send", socket_options=None, file=None, recv_buffer=None,
+                  stream=0, counters=None):
+    if counters is None:
+        counters = {'sent': [0, 0], 'elapsed': [0.0, 0.0], 'rx_offset': 1 if direction == "bidir" else 0}
+        stream = 0
+    transferred = counters['sent']
+    rx_stream = stream + counters['rx_offset']
+    hello = {'mode': "stream", 'direction': direction}
+    if recv_buffer is not None:
+        hello['recv_buffer'] = recv_buffer
+    if direction != "send":
+        hello.update(duration=duration, num_bytes=num_bytes, message_size=message_size, bandwidth=bandwidth)
+    if file is not None:
+        file_total = os.path.getsize(file)
+        file_offset, file_size = file_range(file_total, len(transferred), stream)
+        hello.update(file_name=os.path.basename(file), file_offset=file_offset, file_size=file_size,
+                     file_total=file_total)
     try:
-        with socket(AF_INET, SOCK_STREAM) as client_socket:
-            # Connect to the server
-            client_socket.connect((server_ip, server_port))
+        # Connect to the server
+        client_socket, _ = connect_test(server_ip, server_port, hello, format_unit, socket_options)
+        with client_socket:
+            if zerocopy:
+                zerocopy = enable_zerocopy(client_socket, format_unit)
+            sockets = counters.get('sockets')
+            if sockets is not None:
+                # Let sample_streams read TCP_INFO of this stream
+                sockets[stream] = client_socket
+            start_time = time.time()
 
-            # Print connection details
-            print("---------------------------------------------")
-            print(f"A simpleperf client connecting to server {server_ip}, port {server_port}")
-            print("---------------------------------------------")
-            print(f"Client connected with {server_ip} port {server_port}")
+            receiver = None
+            if direction != "send":
+                outcome = []
+                receiver = threading.Thread(target=receive_outcome,
+                                            args=(outcome, receive_server_stream, client_socket,
+                                                  bytearray(RECV_BUFFER), transferred, rx_stream))
+                receiver.start()
 
-            # Initialize variables for tracking data transfer and time elapsed
             sent_bytes = 0
-            prev_sent_bytes = 0
-            start_time = time.time()
-            last_interval_time = start_time
+            if file is not None:
+                sent_bytes = send_file(client_socket, file, file_offset, file_size, transferred, stream)
+            elif direction != "reverse":
+                # One payload buffer per stream, reused for every message
+                sent_bytes = send_stream(client_socket, memoryview(b'0' * message_size), duration, num_bytes,
+                                         zerocopy, bandwidth, transferred, stream)
 
-            # Continuously send data to the server until the specified duration or number of bytes has been reached
-            while (time.time() - start_time < duration) and (num_bytes is None or sent_bytes < num_bytes):
-                data = b'0' * message_size
-                client_socket.sendall(data)
-                sent_bytes += len(data)
-
-                # Print statistics at specified intervals
-                if interval and time.time() - last_interval_time >= interval:
-                    print_interval(client_socket, start_time, sent_bytes, server_ip, server_port, interval, format_unit,
-                                   prev_sent_bytes)
-                    prev_sent_bytes = sent_bytes  # Update the prev_sent_bytes value
-                    last_interval_time = time.time()
-
-            # Print final statistics and send a BYE message to the server to signal the end of the connection
-            print_interval(client_socket, start_time, sent_bytes, server_ip, server_port,
-                           time.time() - last_interval_time, format_unit, prev_sent_bytes)
-
-            client_socket.sendall(b"BYE")
-            ack = client_socket.recv(1000)
-
-            # Print final statistics after receiving an acknowledgement message from the server
-            if ack == b"ACK:BYE":
-                end_time = time.time()
-                time_elapsed = end_time - start_time
-                print_interval(client_socket, start_time, sent_bytes, server_ip, server_port, time_elapsed, format_unit,
-                               summary=True)
+            # Shut down the sending side to signal the end of the test to the server
+            client_socket.shutdown(SHUT_WR)
+
+            if receiver is None:
+                # Record the duration after the server has reported that it received everything
+                result = recv_message(client_socket)
+                if 'error' in result:
+                    raise ConnectionError(f"server failed the test: {result['error']}")
+                if result.get('bytes') == sent_bytes:
+                    disk_seconds = result.get('disk_seconds') or 0.0
+                    counters['elapsed'][stream] = time.time() - start_time - disk_seconds
+                    if 'disk_write' in counters:
+                        counters['disk_write'][stream] = disk_seconds
+            else:
+                # The server ends its stream after it has received everything, so that is the end of both directions.
+                # Its result confirms that the stream is complete and that it received everything this stream sent.
+                receiver.join()
+                received, = outcome
+                if isinstance(received, OSError):
+                    raise ConnectionError(received)
+                received_bytes, server_sent, server_received = received
+                if server_sent != received_bytes or server_received != sent_bytes:
+                    raise ConnectionError(f"the server sent {server_sent} and received {server_received} bytes, "
+                                          f"this stream received {received_bytes} and sent {sent_bytes}")
+                counters['elapsed'][stream] = counters['elapsed'][rx_stream] = time.time() - start_time
+            if sockets is not None:
+                del sockets[stream]
 
     # Handle connection errors
-    except ConnectionError as e:
-        print(f"Connection lost during transfer: {e}")
-        sys.exit(1)
+    except (ConnectionError, ValueError) as e:
+        stream_failed(counters, stream, e, format_unit)
 
 
-# This function prints the statistics for a given interval, including bandwidth and the amount of data transferred.
+# Reports a stream whose connection was lost and marks it as failed in the counters. The thread of the stream then
+# ends normally, so the other streams and the process carry on.
+# Arguments: counters (dict or None) - The shared per-stream counters, see client.
+#            stream (int) - Index of the stream in counters.
+#            error (Exception) - The error.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def stream_failed(counters, stream, error, format_unit):
+    print_info(f"Connection lost during transfer: {error}", format_unit)
+    if counters is not None and 'failed' in counters:
+        counters['failed'][stream] = 1
+
+
+# Connects to the server, prints the connection details and sends the hello message of a test.
+# Arguments: server_ip (string) - IP address of the server.
+#            server_port (int) - Port number on which the server is listening.
+#            hello (dict) - The hello message, see TEST_MODES.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            socket_options (dict or None) - Options set on the socket before it connects, see apply_socket_options.
+# Returns: (client_socket, reply) - The connected socket, ready for the test, and the server's ready message.
+def connect_test(server_ip, server_port, hello, format_unit, socket_options=None):
+    client_socket = socket(AF_INET, SOCK_STREAM)
+    try:
+        apply_socket_options(client_socket, socket_options)
+        client_socket.connect((server_ip, server_port))
+
+        # Print connection details
+        print_info("---------------------------------------------", format_unit)
+        print_info(f"A simpleperf client connecting to server {server_ip}, port {server_port}", format_unit)
+        print_info("---------------------------------------------", format_unit)
+        print_info(f"Client connected with {server_ip} port {server_port}", format_unit)
+
+        if hello['mode'] == "latency":
+            client_socket.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        send_message(client_socket, hello)
+        reply = recv_message(client_socket)
+        if 'error' in reply:
+            raise ConnectionError(f"server refused the test: {reply['error']}")
+    except BaseException:
+        client_socket.close()
+        raise
+    return client_socket, reply
+
+
+# latency_worker(server_ip, server_port, duration, interval, format_unit, message_size, rate=0, stream=0,
+#                counters=None):
+# Connects to the server, sends request messages that the server echoes back for the given duration, and records
+# the round-trip time of every request in a LatencyHistogram. With a request rate, requests are sent on a fixed
+# schedule and the round-trip time is measured from the scheduled send time, so a stall also counts against the
+# requests that queued up behind it.
+# Arguments:
+# - server_ip (string): IP address of the server.
+# - server_port (int): Port number on which the server is listening.
+# - duration (int): Total duration of the test.
+# - interval (int): Print statistics per z second.
+# - format_unit (dict): A dictionary containing the format unit, its divisor and the output format.
+# - message_size (int): Number of bytes in each request.
+# - rate (float): Requests per second, or 0 to send the next request as soon as the previous one is answered.
+# - stream (int): Index of this stream in counters.
+# - counters (dict or None): Shared per-stream result arrays the final histogram and duration are written to.
+# Returns: None.
+def latency_worker(server_ip, server_port, duration, interval, format_unit, message_size, rate=0, stream=0,
+                   counters=None):
+    try:
+        client_socket, _ = connect_test(server_ip, server_port, {'mode': "latency"}, format_unit)
+        with client_socket:
+            payload = memoryview(b'0' * message_size)
+            response = memoryview(bytearray(message_size))
+            sendall = client_socket.sendall
+            clock = time.perf_counter_ns
+
+            total = LatencyHistogram(counters['histograms'][stream] if counters is not None else None)
+            current = LatencyHistogram()
+            period = int(1e9 / rate) if rate else 0
+            interval_ns = int(interval * 1e9) if interval else 0
+            start_time = clock()
+            deadline = start_time + int(min(duration, 1e9) * 1e9)
+            last_interval_time = start_time
+            next_send = start_time
+            now = start_time
+
+            while now < deadline:
+                if period:
+                    if next_send > now:
+                        time.sleep((next_send - now) / 1e9)
+                    sent_at = next_send
+                    next_send += period
+                else:
+                    sent_at = clock()
+                sendall(payload)
+                recv_into_exact(client_socket, response)
+                now = clock()
+                current.record(now - sent_at)
+
+                if interval_ns and now - last_interval_time >= interval_ns:
+                    print_latency_interval(f"{server_ip}:{server_port}", (last_interval_time - start_time) / 1e9,
+                                           (now - start_time) / 1e9, current, format_unit)
+                    total.merge(current)
+                    current.reset()
+                    last_interval_time = now
+
+            total.merge(current)
+            client_socket.shutdown(SHUT_WR)
+            recv_message(client_socket)
+            time_elapsed = (clock() - start_time) / 1e9
+            if counters is not None:
+                counters['elapsed'][stream] = time_elapsed
+                counters['sent'][stream] = total.count() * message_size
+            print_info("----------------------------------------------------", format_unit)
+            print_latency_interval(f"{server_ip}:{server_port}", 0, time_elapsed, total, format_unit, summary=True)
+
+    # Handle connection errors, and a server that does not answer with valid messages
+    except (ConnectionError, ValueError) as e:
+        stream_failed(counters, stream, e, format_unit)
+
+
+# udp_worker(server_ip, server_port, duration, interval, format_unit, message_size, num_bytes=None,
+#            bandwidth=UDP_BANDWIDTH, stream=0, counters=None):
+# Runs a udp test: sends datagrams of message_size bytes, each starting with a sequence number and a send timestamp
+# (UDP_HEADER), at the target bandwidth for the given duration. The server counts loss, reordering, duplicates and
+# jitter and sends them back over the control connection at the end.
 # Arguments:
-# - client_socket (socket): The socket object representing the client connection.
-# - start_time (float): The start time of the data transfer.
-# - sent_bytes (int): The number of bytes sent so far.
-# - server_ip (str): The IP address of the server.
-# - server_port (int): The port number of the server.
-# - interval (float): The interval for which the statistics are being printed.
+# - server_ip (string): IP address of the server.
+# - server_port (int): Port number on which the server is listening.
+# - duration (int): Total duration for which data should be generated.
+# - interval (float): Unused, the intervals are printed by collect_intervals.
 # - format_unit (dict): A dictionary containing the format unit and its corresponding divisor.
-# - prev_sent_bytes (int): The number of bytes sent in the previous interval.
-# - summary (bool): A flag indicating whether to print a summary line or not.
+# - message_size (int): Number of bytes in each datagram.
+# - num_bytes (int or None): Number of bytes to transfer. If None, the transfer is indefinite.
+# - bandwidth (int): Target rate in bits per second.
+# - stream (int): Index of this stream in counters.
+# - counters (dict or None): Shared per-stream counters, see client.
 # Returns: None.
-def print_interval(client_socket: socket, start_time: float, sent_bytes: int, server_ip: str, server_port: int,
-                   interval: float, format_unit: dict, prev_sent_bytes: int = 0, summary=False):
-    time_elapsed = time.time() - start_time
-    sent_data_interval = (sent_bytes - prev_sent_bytes) / format_unit['divisor']
-    bandwidth = sent_data_interval * 8 / interval
+def udp_worker(server_ip, server_port, duration, interval, format_unit, message_size, num_bytes=None,
+               bandwidth=UDP_BANDWIDTH, stream=0, counters=None):
+    if counters is None:
+        counters = {'sent': [0], 'elapsed': [0.0]}
+        stream = 0
+    sent_counter = counters['sent']
+    try:
+        control_socket, reply = connect_test(server_ip, server_port, {'mode': "udp"}, format_unit)
+        with control_socket, socket(AF_INET, SOCK_DGRAM) as udp_socket:
+            udp_socket.connect((server_ip, reply['port']))
+
+            # One datagram buffer per stream, only the header is rewritten for every datagram
+            packet = bytearray(b'0' * message_size)
+            send = udp_socket.send
+            pack_into = UDP_HEADER.pack_into
+            clock = time.time_ns
+            pacer = TokenBucket(bandwidth, message_size)
+
+            # Initialize variables for tracking data transfer and time elapsed
+            seq = 0
+            sent_bytes = 0
+            start_time = time.time()
+            now = start_time
+
+            while (now - start_time < duration) and (num_bytes is None or sent_bytes < num_bytes):
+                # Send as many datagrams as the pacer allows, at most UDP_BATCH before the next clock read
+                count = min(pacer.reserve(message_size) // message_size, UDP_BATCH)
+                if num_bytes is not None:
+                    count = min(count, -(-(num_bytes - sent_bytes) // message_size))
+                for _ in range(count):
+                    pack_into(packet, 0, seq, clock())
+                    send(packet)
+                    seq += 1
+                pacer.consume(count * message_size)
+                sent_bytes += count * message_size
+                sent_counter[stream] = sent_bytes
+                now = time.time()
+
+            # End the test on the control connection and print the server's report
+            control_socket.shutdown(SHUT_WR)
+            result = recv_message(control_socket)
+            time_elapsed = time.time() - start_time
+            counters['elapsed'][stream] = time_elapsed
+            if 'udp' in counters:
+                fields = len(UDP_REPORT_FIELDS)
+                counters['udp'][stream * fields:(stream + 1) * fields] = array('d', (result['udp'][key]
+                                                                                    for key in UDP_REPORT_FIELDS))
+            print_info("----------------------------------------------------", format_unit)
+            print_udp_report(f"{server_ip}:{server_port}", time_elapsed, result['udp'], format_unit)
+
+    # Handle connection errors, malformed control messages, and datagrams the socket refuses, e.g. larger than the path
+    # allows (EMSGSIZE) or too short for UDP_HEADER
+    except (OSError, ValueError, struct.error) as e:
+        stream_failed(counters, stream, e, format_unit)
+
+
+# The fields of the server's report of a udp test that a ClientResult keeps: the counts, then the jitter.
+UDP_REPORT_FIELDS = ("packets", "bytes", "total", "lost", "out_of_order", "duplicates", "jitter_ms")
+
+
+# Reads the server's reports of the streams of a udp test back out of the counters, see udp_worker.
+# Arguments: counters (dict) - The per-stream counters of the test, see client.
+# Returns: A list with the report of every stream (a dict of UDP_REPORT_FIELDS), or None for a failed stream.
+def udp_reports(counters):
+    fields = len(UDP_REPORT_FIELDS)
+    reports = []
+    for stream, failed in enumerate(counters['failed']):
+        report = dict(zip(UDP_REPORT_FIELDS, counters['udp'][stream * fields:(stream + 1) * fields]))
+        for key in UDP_REPORT_FIELDS[:-1]:
+            report[key] = int(report[key])
+        reports.append(None if failed else report)
+    return reports
+
+
+# Prints the server's report of a udp test: what arrived, the jitter, and the lost, reordered and duplicated datagrams.
+# Arguments: stream_id (str) - The ID column of the row.
+#            time_elapsed (float) - The duration of the test, in seconds.
+#            report (dict) - The UdpStats report sent by the server.
+#            format_unit (dict) - A dictionary containing the format unit and its corresponding divisor.
+# Returns: None.
+def print_udp_report(stream_id, time_elapsed, report, format_unit):
+    if format_unit.get('output', "text") != "text":
+        write_record(udp_record(stream_id, time_elapsed, report), format_unit)
+        return
+    received_data = report['bytes'] / format_unit['divisor']
+    bandwidth = received_data * 8 / time_elapsed if time_elapsed else 0.0
+    lost_percent = 100 * report['lost'] / report['total'] if report['total'] else 0.0
+    headers = ["ID", "Interval", "Transfer", "Bandwidth", "Jitter", "Lost/Total", "Out-of-order", "Duplicates"]
+    data = [stream_id, f"0.00 - {time_elapsed:.2f}", f"{received_data:.2f} {format_unit['unit']}",
+            f"{bandwidth:.2f} {format_unit['unit']}ps", f"{report['jitter_ms']:.3f} ms",
+            f"{report['lost']}/{report['total']} ({lost_percent:.2g}%)", str(report['out_of_order']),
+            str(report['duplicates'])]
+    print(format_summary_line(data, headers))
+    print(format_summary_line(headers, data))
+
+
+# Builds the result record of the server's report of a udp test.
+# Arguments: see print_udp_report.
+# Returns: The record (dict).
+def udp_record(stream_id, time_elapsed, report):
+    record = {'type': "udp_summary", 'id': stream_id, 'start': 0.0, 'end': time_elapsed, 'bytes': report['bytes'],
+              'bits_per_second': report['bytes'] * 8 / time_elapsed if time_elapsed else 0.0}
+    record.update((key, report[key]) for key in ("jitter_ms", "lost", "total", "out_of_order", "duplicates"))
+    return record
+
+
+# Prints one row of latency statistics: the number of requests and the min, p50, p90, p99, p99.9 and max round-trip
+# times in milliseconds.
+# Arguments: stream_id (str) - The ID column of the row.
+#            begin (float) - The start of the interval, in seconds since the start of the test.
+#            end (float) - The end of the interval, in seconds since the start of the test.
+#            histogram (LatencyHistogram) - The round-trip times recorded during the interval.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            summary (bool) - Whether this is the summary of the whole test rather than one interval.
+# Returns: None.
+def print_latency_interval(stream_id, begin, end, histogram, format_unit, summary=False):
+    if format_unit.get('output', "text") != "text":
+        write_record(latency_record("latency_summary" if summary else "latency_interval", stream_id, begin, end,
+                                    histogram), format_unit)
+        return
+    headers = ["ID", "Interval", "Requests", "Min", "P50", "P90", "P99", "P99.9", "Max"]
+    values = [histogram.min()] + histogram.percentiles(LATENCY_PERCENTILES) + [histogram.max()]
+    data = [stream_id, f"{begin:.2f} - {end:.2f}", str(histogram.count())] + [f"{v / 1e6:.3f} ms" for v in values]
+    print(format_summary_line(data, headers))
+    print(format_summary_line(headers, data))
+
+
+# Builds the result record of the round-trip times of an interval: the number of requests and the min, p50, p90, p99,
+# p99.9 and max times in milliseconds.
+# Arguments: kind (str) - The record type, "latency_interval" or "latency_summary".
+#            Other arguments: see print_latency_interval.
+# Returns: The record (dict).
+def latency_record(kind, stream_id, begin, end, histogram):
+    values = [histogram.min()] + histogram.percentiles(LATENCY_PERCENTILES) + [histogram.max()]
+    record = {'type': kind, 'id': stream_id, 'start': begin, 'end': end, 'requests': histogram.count()}
+    record.update(zip(("min_ms", "p50_ms", "p90_ms", "p99_ms", "p99.9_ms", "max_ms"), (v / 1e6 for v in values)))
+    return record
+
+
+# Connection rate tests
+
+# Largest crr request that accept_crr serves from the accept loop; larger ones are served like other tests, so that
+# the loop never waits for a response to leave the socket buffer.
+CRR_INLINE = 8 * 1024
+
+# Linux socket options that not every Python build defines.
+TCP_DEFER_ACCEPT = globals().get('TCP_DEFER_ACCEPT', 9)
+SO_TIMESTAMPNS = globals().get('SO_TIMESTAMPNS', 35)
+
+# The struct timespec of an SO_TIMESTAMPNS control message: seconds and nanoseconds.
+TIMESPEC = struct.Struct("@ll")
+
+# The times a crr test reports the distribution of, with the counters key of their per-stream histograms.
+CRR_TIMES = (("Connect", 'histograms'), ("Transaction", 'transactions'), ("Accept", 'accepts'))
+
+
+# Prepares a listening socket for connection rate tests. The server closes crr connections first, so a run leaves
+# thousands of connections in TIME_WAIT on the server's port; SO_REUSEADDR lets a restarted server bind the port
+# anyway (on Windows it would let another socket take over a bound port, so it is only set on POSIX systems).
+# TCP_DEFER_ACCEPT keeps a connection out of the accept queue until its first data has arrived, so that the accept
+# loop finds the hello message waiting (every simpleperf client speaks first), and SO_TIMESTAMPNS, which the accepted
+# connections inherit, stamps the arrival of that data for the accept latency of accept_crr. Both are Linux options;
+# elsewhere connections are served the same way without them.
+# Arguments: sock (socket) - The listening socket, before it binds.
+# Returns: None.
+def tune_listener(sock):
+    if os.name == "posix":
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if not sys.platform.startswith("linux"):
+        return
+    for level, option in ((IPPROTO_TCP, TCP_DEFER_ACCEPT), (SOL_SOCKET, SO_TIMESTAMPNS)):
+        try:
+            sock.setsockopt(level, option, 1)
+        except OSError:
+            pass
+
+
+# Serves a crr connection (see crr_worker) right in the accept loop of either engine when its whole request has
+# arrived with it, as it has behind TCP_DEFER_ACCEPT: the hello and the request are read, answered with a ready
+# message and the echoed request, and the connection is closed, without a thread or selector registration per
+# connection. The ready message holds the accept latency: how long the connection waited in the accept queue after
+# its data arrived. A hello that is not a JSON object is not a simpleperf client, and the connection is closed. Any
+# other connection, or a request that is still on its way, is left to the engine untouched.
+# Arguments: connection (socket) - A connection that was just accepted.
+#            client_address (tuple) - The client's IP address and port number.
+#            accepted (int) - The time of the accept, from time.time_ns.
+#            totals (Array or None) - Shared [connections, bytes] counters of this process, see serve_processes.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: True if the connection was served or rejected and is closed, False if it is left to the engine.
+def accept_crr(connection, client_address, accepted, totals, format_unit):
+    try:
+        data, ancillary, _, _ = connection.recvmsg(CRR_INLINE, CMSG_SPACE(TIMESPEC.size), MSG_PEEK | MSG_DONTWAIT)
+        hello = decode_message(data)
+    except (OSError, ValueError):
+        return False
+    if hello is not None and not isinstance(hello, dict):
+        print_info(f"Connection with {flow_name(client_address)} lost: the hello message is not a JSON object",
+                   format_unit)
+        connection.close()
+        return True
+    if hello is None or hello.get('mode') != "crr" or hello_error(hello) is not None:
+        return False
+    end = MESSAGE_HEADER.size + message_length(data)
+    size = hello['size']
+    if len(data) < end + size:
+        return False
+
+    ready = {'ready': True}
+    for level, kind, value in ancillary:
+        if level == SOL_SOCKET and kind == SO_TIMESTAMPNS:
+            seconds, nanoseconds = TIMESPEC.unpack_from(value)
+            ready['accept_ns'] = max(0, accepted - seconds * 1000000000 - nanoseconds)
+    with connection:
+        try:
+            # Take the peeked bytes off the socket, closing with unread data would reset the connection
+            connection.recv(end + size, MSG_DONTWAIT)
+            connection.sendall(encode_message(ready) + data[end:end + size])
+        except OSError as e:
+            print_info(f"Connection with {flow_name(client_address)} lost: {e}", format_unit)
+            return True
+    count_connection(totals, 2 * size)
+    return True
+
+
+# crr_worker(server_ip, server_port, duration, interval, format_unit, message_size, socket_options=None, stream=0,
+#            counters=None):
+# Runs a connection rate stream: for the given duration it opens a connection, sends the hello message of a crr test
+# together with a request of message_size bytes, reads the server's ready message and the echoed request, and closes
+# the connection, over and over. The server closes first, so the TIME_WAIT state stays on the server and the client
+# does not run out of ports. The time connect takes, the time from the request to the last byte of the response and
+# the accept latency the server reports (see accept_crr) go into the stream's histograms, see CRR_TIMES.
+# Arguments:
+# - server_ip (string): IP address of the server.
+# - server_port (int): Port number on which the server is listening.
+# - duration (int): Total duration of the test.
+# - interval (float): Unused, the intervals are printed by collect_intervals.
+# - format_unit (dict): A dictionary containing the format unit, its divisor and the output format.
+# - message_size (int): Number of bytes in each request.
+# - socket_options (dict or None): Options set on every socket before it connects, see apply_socket_options.
+# - stream (int): Index of this stream in counters.
+# - counters (dict or None): Shared per-stream counters, see client; 'connections' counts the connections of each
+#   stream. Without them the stream keeps its counts to itself.
+# Returns: None.
+def crr_worker(server_ip, server_port, duration, interval, format_unit, message_size, socket_options=None, stream=0,
+               counters=None):
+    if counters is None:
+        counters = {'connections': [0], 'elapsed': [0.0]}
+        counters.update((key, [LatencyHistogram().counts]) for _, key in CRR_TIMES)
+        stream = 0
+    address = (server_ip, server_port)
+    request = encode_message({'mode': "crr", 'size': message_size}) + b'0' * message_size
+    response = memoryview(bytearray(message_size))
+    histograms = [LatencyHistogram(counters[key][stream]) for _, key in CRR_TIMES]
+    connects, transactions, accepts = histograms
+    connections = counters['connections']
+    clock = time.perf_counter_ns
+
+    print_info("---------------------------------------------", format_unit)
+    print_info(f"A simpleperf client opening connections to server {server_ip}, port {server_port}", format_unit)
+    print_info("---------------------------------------------", format_unit)
+
+    start_time = clock()
+    deadline = start_time + int(min(duration, 1e9) * 1e9)
+    now = start_time
+    try:
+        while now < deadline:
+            with socket(AF_INET, SOCK_STREAM) as client_socket:
+                apply_socket_options(client_socket, socket_options)
+                begin = clock()
+                client_socket.connect(address)
+                connected = clock()
+                client_socket.sendall(request)
+                reply = recv_message(client_socket)
+                if 'error' in reply:
+                    raise ConnectionError(f"server refused the test: {reply['error']}")
+                recv_into_exact(client_socket, response)
+                now = clock()
+            connects.record(connected - begin)
+            transactions.record(now - connected)
+            if 'accept_ns' in reply:
+                accepts.record(reply['accept_ns'])
+            connections[stream] += 1
+
+    # Connect errors, such as running out of local ports, and malformed replies end the stream like a lost connection
+    except (OSError, ValueError) as e:
+        stream_failed(counters, stream, e, format_unit)
+    counters['elapsed'][stream] = (clock() - start_time) / 1e9
+
+
+# Builds the result record of a number of connections made during an interval.
+# Arguments: kind (str) - The record type, "crr_interval" or "crr_summary".
+#            stream_id (str) - The ID of the stream.
+#            begin (float) - The start of the interval, in seconds since the start of the test.
+#            end (float) - The end of the interval, in seconds since the start of the test.
+#            count (int) - The number of connections made during the interval.
+# Returns: The record (dict).
+def connection_record(kind, stream_id, begin, end, count):
+    return {'type': kind, 'id': stream_id, 'start': begin, 'end': end, 'connections': count,
+            'connections_per_second': count / (end - begin) if end > begin else 0.0}
+
+
+# Prints connection records as an ID / Interval / Connections / Rate table, or as json or csv records.
+# Arguments: records (list) - Records built by connection_record.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def print_connection_records(records, format_unit):
+    if format_unit.get('output', "text") != "text":
+        for record in records:
+            write_record(record, format_unit)
+        return
+    print_table(["ID", "Interval", "Connections", "Rate"],
+                [[record['id'], f"{record['start']:.2f} - {record['end']:.2f}", str(record['connections']),
+                  f"{record['connections_per_second']:.0f} conn/s"] for record in records])
+
+
+# Prints the connections of every crr stream during an interval, and a [SUM] row if there is more than one stream.
+# It takes the place of print_interval in collect_intervals.
+# Arguments: stream_ids (list) - The ID column of each stream.
+#            begin (float) - The start of the interval, in seconds since the start of the test.
+#            end (float) - The end of the interval, in seconds since the start of the test.
+#            counts (list) - The number of connections each stream made during the interval.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            samples (None) - Unused, crr streams have no TCP_INFO samples.
+# Returns: None.
+def print_connection_interval(stream_ids, begin, end, counts, format_unit, samples=None):
+    records = [connection_record("crr_interval", stream_id, begin, end, count)
+               for stream_id, count in zip(stream_ids, counts)]
+    if len(records) > 1:
+        records.append(connection_record("crr_interval", "[SUM]", begin, end, sum(counts)))
+    print_connection_records(records, format_unit)
+
+
+# Prints the results of a crr test: the connections and connection rate of every stream and their sum, and the
+# distribution of each of CRR_TIMES over all streams. The accept latencies are missing when the server cannot
+# timestamp the arrival of a connection's data (see tune_listener).
+# Arguments: counters (dict) - The shared per-stream counters, see client.
+#            stream_ids (list) - The ID column of each stream.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: records (list) - The printed connection records, see connection_record.
+def print_crr_summary(counters, stream_ids, format_unit):
+    end = max(counters['elapsed'])
+    records = [connection_record("crr_summary", stream_id, 0.0, elapsed, count)
+               for stream_id, count, elapsed in zip(stream_ids, counters['connections'], counters['elapsed'])
+               if elapsed]
+    if len(stream_ids) > 1:
+        records.append(connection_record("crr_summary", "[SUM]", 0.0, end, sum(counters['connections'])))
+    print_info("----------------------------------------------------", format_unit)
+    print_connection_records(records, format_unit)
+
+    rows = []
+    for name, key in CRR_TIMES:
+        merged = LatencyHistogram()
+        for counts in counters[key]:
+            merged.merge(LatencyHistogram(counts))
+        if not merged.count():
+            continue
+        if format_unit.get('output', "text") != "text":
+            print_latency_interval(name.lower(), 0.0, end, merged, format_unit, summary=True)
+            continue
+        values = [merged.min()] + merged.percentiles(LATENCY_PERCENTILES) + [merged.max()]
+        rows.append([name, str(merged.count())] + [f"{value / 1e6:.3f} ms" for value in values])
+    if rows:
+        print_table(["Time", "Count", "Min", "P50", "P90", "P99", "P99.9", "Max"], rows)
+    return records
+
+
+# Test matrix
+
+# The test parameters a matrix file can sweep. Every combination of their values is one test.
+MATRIX_PARAMETERS = ("message_size", "parallel", "time", "recv_buffer")
+
+
+# Loads a matrix file: a JSON object with a list of values (or a single value) for any of MATRIX_PARAMETERS, and
+# optionally "warmup" and "omit" in seconds. Parameters the file leaves out take the value given on the command line.
+# Message and receive buffer sizes can be numbers of bytes or strings such as "64KB". Every value is checked like its
+# command-line option before any test runs: the parameters are positive integers (a recv_buffer of None leaves the
+# size to the server), warmup and omit are at least 0. A file that breaks a rule raises ValueError.
+# Arguments: path (str) - The matrix file.
+#            defaults (dict) - The command-line value of every parameter, and of warmup and omit.
+# Returns: (tests, warmup, omit) - The tests, as dicts of parameter values in the order they run, and the warm-up
+#          and omitted seconds.
+def load_matrix(path, defaults):
+    with open(path) as file:
+        import json
+        matrix = json.load(file)
+    if not isinstance(matrix, dict):
+        raise ValueError("a matrix is a JSON object of parameter values")
+    unknown = set(matrix) - set(MATRIX_PARAMETERS) - {"warmup", "omit"}
+    if unknown:
+        raise ValueError(f"unknown matrix keys: {', '.join(sorted(unknown))}")
+    axes = []
+    for parameter in MATRIX_PARAMETERS:
+        values = matrix.get(parameter, defaults[parameter])
+        values = values if isinstance(values, list) else [values]
+        if not values:
+            raise ValueError(f"no values for {parameter}")
+        if parameter in ("message_size", "recv_buffer"):
+            values = [parse_num_bytes(value) if isinstance(value, str) else value for value in values]
+        for value in values:
+            if value is None and parameter == "recv_buffer":
+                continue
+            if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+                raise ValueError(f"{parameter} {value!r} is not a positive integer")
+        axes.append(values)
+    seconds = []
+    for key in ("warmup", "omit"):
+        value = matrix.get(key, defaults[key])
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"{key} {value!r} is not a number of seconds of at least 0")
+        seconds.append(value)
+    tests = [dict(zip(MATRIX_PARAMETERS, values)) for values in itertools.product(*axes)]
+    return tests, seconds[0], seconds[1]
+
+
+# Returns the name of a matrix test, e.g. "m=1000 P=4 t=10 buf=1000000".
+def test_name(test):
+    name = f"m={test['message_size']} P={test['parallel']} t={test['time']}"
+    return name + (f" buf={test['recv_buffer']}" if test['recv_buffer'] else "")
 
-    # Define column headers and data row for printing
-    headers = ["ID", "Interval", "Transfer", "Bandwidth"]
-    data_row = [
-        f"{server_ip}:{server_port}",
-        f"{time_elapsed - interval:.2f} - {time_elapsed:.2f}",
-        f"{sent_data_interval:.2f} {format_unit['unit']}",
-        f"{bandwidth:.2f} {format_unit['unit']}ps"
-    ]
-    # If a summary line is being printed, add a separator line before it
-    if summary:
-        print("----------------------------------------------------")
-
-    # Otherwise, print the interval data in a formatted table
-    else:
-        table_data = [headers, data_row]
-        max_widths = [max(map(len, col)) for col in zip(*table_data)]
 
-        for row in table_data:
-            print(" ".join((val.ljust(width) for val, width in zip(row, max_widths))))
+# Runs a test matrix over one control session: the tests run back to back in this process, without a new process or
+# a new server per test, and the server splits up its output by test (see serve_session). An optional warm-up test
+# with the first parameters runs first and is not recorded. The results are collected quietly and written together
+# at the end, one "matrix" record per test with the test's summary (its [SUM] row with parallel streams).
+# Arguments: server_ip (string) - IP address of the server.
+#            server_port (int) - Port number on which the server is listening.
+#            tests (list) - The tests, see load_matrix.
+#            warmup (float) - The duration of the warm-up test in seconds, or 0 for none.
+#            omit (float) - The seconds at the start of every test that are left out of its result, see client.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+#            socket_options (dict or None) - Options set on the socket of every stream, see apply_socket_options.
+# Returns: records (list) - The result of every test that completed.
+def run_matrix(server_ip, server_port, tests, warmup, omit, format_unit, socket_options=None):
+    quiet = dict(format_unit, output="none")
+    write_record_header(format_unit)
+    records = []
+    try:
+        session, _ = connect_test(server_ip, server_port, {'mode': "session"}, format_unit)
+        with session:
+            if warmup:
+                print_info(f"Warm-up: {warmup} seconds", format_unit)
+                run_session_test(session, server_ip, server_port, "warm-up", dict(tests[0], time=warmup), 0, quiet,
+                                 socket_options)
+            for number, test in enumerate(tests, 1):
+                name = test_name(test)
+                print_info(f"Test {number}/{len(tests)}: {name}", format_unit)
+                result = run_session_test(session, server_ip, server_port, name, test, omit, quiet, socket_options)
+                if result.failed or not result.records:
+                    print_info(f"Test {name} failed", format_unit)
+                    continue
+                records.append(dict(result.records[-1], type="matrix", id=name))
+            session.shutdown(SHUT_WR)
+    except (ConnectionError, ValueError) as e:
+        print_info(f"Control session lost: {e}", format_unit)
+
+    print_info("----------------------------------------------------", format_unit)
+    print_transfer_records(records, format_unit)
+    return records
+
+
+# Runs one test of a matrix: asks the server to accept its parameters over the control session, then runs it as a
+# client stream test.
+# Arguments: session (socket) - The control session.
+#            name (str) - The name of the test.
+#            test (dict) - The parameters of the test.
+#            Other arguments: see run_matrix.
+# Returns: result (ClientResult) - The result of the test.
+def run_session_test(session, server_ip, server_port, name, test, omit, format_unit, socket_options=None):
+    send_message(session, {'test': name, 'config': test})
+    reply = recv_message(session)
+    if 'error' in reply:
+        raise ConnectionError(f"server refused the test: {reply['error']}")
+    return client(server_ip, server_port, test['time'], None, test['parallel'], test['message_size'], format_unit,
+                  socket_options=socket_options, omit=omit, recv_buffer=reply['recv_buffer'])
+
+
+# Latency histogram
+
+# The percentiles reported by latency tests, besides min and max.
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+# A fixed-size histogram of nanosecond values with logarithmic buckets, in the style of HdrHistogram. Values below
+# 256 get a bucket each; above that, every power-of-two range is split into 128 buckets, so a value is reported with
+# a relative error below 1%. Values up to 2^40 ns (about 18 minutes) are kept apart; larger ones share the last bucket.
+# The counts live in one flat array, followed by the number of values, the exact min and the exact max, so that a
+# histogram can be placed in shared memory and merged across threads and processes.
+class LatencyHistogram:
+    SUB_BUCKETS = 128
+    BUCKETS = 2 * SUB_BUCKETS + 33 * SUB_BUCKETS
+    COUNT, MIN, MAX = BUCKETS, BUCKETS + 1, BUCKETS + 2
+    SLOTS = BUCKETS + 3
+
+    __slots__ = ('counts',)
+
+    # Arguments: counts (array or None) - Storage of SLOTS unsigned 64-bit integers to use, e.g. a RawArray.
+    def __init__(self, counts=None):
+        self.counts = counts if counts is not None else array('Q', bytes(8 * self.SLOTS))
+
+    # Records one value.
+    # Arguments: value (int) - The value, in nanoseconds.
+    # Returns: None.
+    def record(self, value):
+        counts = self.counts
+        if value < 2 * self.SUB_BUCKETS:
+            index = value
+        else:
+            shift = value.bit_length() - 8
+            index = min(shift * self.SUB_BUCKETS + (value >> shift), self.BUCKETS - 1)
+        counts[index] += 1
+        if not counts[self.COUNT] or value < counts[self.MIN]:
+            counts[self.MIN] = value
+        if value > counts[self.MAX]:
+            counts[self.MAX] = value
+        counts[self.COUNT] += 1
+
+    # Returns the highest value that falls in the same bucket as the values of the given bucket index.
+    def bucket_value(self, index):
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift, sub = divmod(index - self.SUB_BUCKETS, self.SUB_BUCKETS)
+        return ((sub + self.SUB_BUCKETS + 1) << shift) - 1
+
+    # Returns the values at the given percentiles (0-100) in one pass over the buckets, capped at the exact max.
+    def percentiles(self, percents):
+        counts = self.counts
+        total = counts[self.COUNT]
+        if not total:
+            return [0 for _ in percents]
+        targets = sorted((max(1, math.ceil(p / 100 * total)), i) for i, p in enumerate(percents))
+        values = [0] * len(percents)
+        seen = 0
+        t = 0
+        for index in range(self.BUCKETS):
+            seen += counts[index]
+            while t < len(targets) and seen >= targets[t][0]:
+                values[targets[t][1]] = min(self.bucket_value(index), counts[self.MAX])
+                t += 1
+            if t == len(targets):
+                break
+        return values
+
+    def count(self):
+        return self.counts[self.COUNT]
+
+    def min(self):
+        return self.counts[self.MIN]
+
+    def max(self):
+        return self.counts[self.MAX]
+
+    # Adds the values of another histogram to this one.
+    def merge(self, other):
+        counts, theirs = self.counts, other.counts
+        if not theirs[self.COUNT]:
+            return
+        if not counts[self.COUNT] or theirs[self.MIN] < counts[self.MIN]:
+            counts[self.MIN] = theirs[self.MIN]
+        counts[self.MAX] = max(counts[self.MAX], theirs[self.MAX])
+        for index in range(self.BUCKETS):
+            if theirs[index]:
+                counts[index] += theirs[index]
+        counts[self.COUNT] += theirs[self.COUNT]
+
+    # Removes all values.
+    def reset(self):
+        counts = self.counts
+        for index in range(self.SLOTS):
+            counts[index] = 0
+
+
+# Send engine
+
+# Target wall time of one batch of messages. The sending loop only reads the clock between batches, so this bounds
+# how late a stream can notice that its duration or interval has passed.
+BATCH_TIME = 0.005
+
+# Largest burst a paced sender may send at once after being idle, in seconds of traffic at the target rate.
+BURST_TIME = 0.01
+
+# Linux values, used when the socket module of this Python does not export them.
+SO_ZEROCOPY = globals().get('SO_ZEROCOPY', 60)
+MSG_ZEROCOPY = globals().get('MSG_ZEROCOPY', 0x4000000)
+
+
+# Sends messages from one preallocated payload buffer for the given duration, or until num_bytes are sent. The clock
+# is only read once per batch of messages (see send_batch), and after every batch the byte counter is updated.
+# This is the send loop of client streams, and of the server in reverse and bidir tests.
+# Arguments: sock (socket) - A connected socket.
+#            payload (memoryview) - The payload buffer, reused for every message.
+#            duration (float) - The duration of the test, in seconds.
+#            num_bytes (int or None) - The number of bytes to send, or None to send for the whole duration.
+#            zerocopy (bool) - Send with MSG_ZEROCOPY; SO_ZEROCOPY must be enabled on the socket.
+#            bandwidth (int or None) - Target rate in bits per second, enforced by a TokenBucket.
+#            counter (array or None) - If given, the number of bytes sent so far is kept in counter[index].
+#            index (int) - The index in counter.
+# Returns: sent_bytes (int) - The number of bytes sent.
+def send_stream(sock, payload, duration, num_bytes=None, zerocopy=False, bandwidth=None, counter=None, index=0):
+    message_size = len(payload)
+    send = send_batch_zerocopy if zerocopy else send_batch
+    pacer = TokenBucket(bandwidth, message_size) if bandwidth else None
+
+    # Initialize variables for tracking data transfer and time elapsed
+    sent_bytes = 0
+    batch_count = 1
+    start_time = time.time()
+    now = start_time
+
+    # Continuously send data until the specified duration or number of bytes has been reached
+    while (now - start_time < duration) and (num_bytes is None or sent_bytes < num_bytes):
+        remaining = None if num_bytes is None else num_bytes - sent_bytes
+        if pacer is None:
+            sent_bytes += send(sock, payload, batch_count, remaining)
+        else:
+            # Never send more than the pacer has tokens for; it sleeps until at least one message is allowed
+            count = min(batch_count, pacer.reserve(message_size) // message_size)
+            sent = send(sock, payload, count, remaining)
+            pacer.consume(sent)
+            sent_bytes += sent
+        if counter is not None:
+            counter[index] = sent_bytes
 
+        # Read the clock once per batch and resize the batch so that it lasts about BATCH_TIME seconds
+        batch_start, now = now, time.time()
+        batch_count = resize_batch(batch_count, now - batch_start)
+
+    if zerocopy:
+        drain_zerocopy(sock, wait=True)
+    return sent_bytes
+
+
+# Sends count messages from a preallocated payload buffer. If remaining is given, no more than remaining bytes are
+# sent, so the last message of a -n transfer is cut short instead of overshooting.
+# Arguments: sock (socket) - A connected socket.
+#            payload (memoryview) - The payload buffer, reused for every message.
+#            count (int) - The number of messages to send.
+#            remaining (int or None) - The number of bytes left to send, or None if unlimited.
+# Returns: sent (int) - The number of bytes sent.
+def send_batch(sock, payload, count, remaining=None):
+    sendall = sock.sendall
+    count, tail = split_batch(len(payload), count, remaining)
+    for _ in range(count):
+        sendall(payload)
+    if tail:
+        sendall(payload[:tail])
+    return len(payload) * count + tail
+
+
+# Same as send_batch, but sends with sendmsg(MSG_ZEROCOPY) so the kernel pins the payload pages instead of copying
+# them. The payload is never modified, so it can be reused before the kernel reports completion; the completion
+# notifications are drained from the error queue after every batch so they do not pile up.
+# Arguments: see send_batch.
+# Returns: sent (int) - The number of bytes sent.
+def send_batch_zerocopy(sock, payload, count, remaining=None):
+    count, tail = split_batch(len(payload), count, remaining)
+    for _ in range(count):
+        sendmsg_all(sock, payload)
+    if tail:
+        sendmsg_all(sock, payload[:tail])
+    drain_zerocopy(sock)
+    return len(payload) * count + tail
+
+
+# Splits a batch into whole messages and a final partial message so that no more than remaining bytes are sent.
+# Arguments: size (int) - The message size.
+#            count (int) - The number of messages in the batch.
+#            remaining (int or None) - The number of bytes left to send, or None if unlimited.
+# Returns: (count, tail) - The number of whole messages and the size of the partial message (0 if none).
+def split_batch(size, count, remaining):
+    if remaining is not None and remaining < size * count:
+        return divmod(remaining, size)
+    return count, 0
+
+
+# Sends a whole buffer with sendmsg(MSG_ZEROCOPY), retrying after partial sends.
+# Arguments: sock (socket) - A socket with SO_ZEROCOPY enabled.
+#            view (memoryview) - The data to send.
+# Returns: None.
+def sendmsg_all(sock, view):
+    while view:
+        view = view[sock.sendmsg((view,), (), MSG_ZEROCOPY):]
+
+
+# Turns on SO_ZEROCOPY for a socket.
+# Arguments: sock (socket) - The socket to configure.
+#            format_unit (dict) - A dictionary containing the format unit and the output format, for the fallback
+#                                 notice.
+# Returns: True if zero-copy sends are available, otherwise False (the caller falls back to regular sends).
+def enable_zerocopy(sock, format_unit):
+    try:
+        sock.setsockopt(SOL_SOCKET, SO_ZEROCOPY, 1)
+    except OSError as e:
+        print_info(f"MSG_ZEROCOPY is not available ({e}), falling back to regular sends", format_unit)
+        return False
+    return True
+
+
+# Reads the zero-copy completion notifications queued on the socket's error queue.
+# Arguments: sock (socket) - A socket with SO_ZEROCOPY enabled.
+#            wait (bool) - Keep polling until the error queue stays empty, used before the socket is closed.
+# Returns: None.
+def drain_zerocopy(sock, wait=False):
+    while True:
+        try:
+            sock.recvmsg(0, 1024, MSG_ERRQUEUE | MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            if not wait:
+                return
+            wait = False
+            time.sleep(BATCH_TIME)
+
+
+# Paces a sender to a target rate. Tokens (bytes) accumulate at the target rate on the time.monotonic_ns clock, up to
+# a burst of BURST_TIME seconds of traffic (and at least two messages), and every byte sent takes one token. When
+# there are too few tokens the sender sleeps for exactly as long as it takes to earn them, so it does not spin; the
+# time a sleep overshoots is paid back in tokens, which keeps the long-term rate on target. The bucket starts empty, so
+# the first message waits for its tokens like every other and a short test at a low rate is not a message ahead.
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    # Arguments: bandwidth (int) - The target rate in bits per second.
+    #            message_size (int) - The size of the sender's messages, in bytes.
+    def __init__(self, bandwidth, message_size):
+        self.rate = bandwidth / 8 / 1e9
+        self.burst = max(bandwidth / 8 * BURST_TIME, 2 * message_size)
+        self.tokens = 0.0
+        self.last = time.monotonic_ns()
+
+    # Waits until at least minimum bytes may be sent.
+    # Arguments: minimum (int) - The number of bytes the caller wants to send at least.
+    # Returns: The number of bytes that may be sent now (int).
+    def reserve(self, minimum):
+        now = time.monotonic_ns()
+        tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        if tokens < minimum:
+            time.sleep((minimum - tokens) / self.rate / 1e9)
+            later = time.monotonic_ns()
+            tokens = min(self.burst, tokens + (later - now) * self.rate)
+            now = later
+        self.tokens = tokens
+        self.last = now
+        return int(tokens)
+
+    # Takes the tokens for sent bytes.
+    # Arguments: sent (int) - The number of bytes sent.
+    # Returns: None.
+    def consume(self, sent):
+        self.tokens -= sent
+
+
+# Doubles or halves the number of messages per batch depending on how long the last batch took.
+# Arguments: count (int) - The current batch size.
+#            elapsed (float) - The time the last batch took, in seconds.
+# Returns: count (int) - The new batch size.
+def resize_batch(count, elapsed):
+    if elapsed < BATCH_TIME / 2:
+        return count * 2
+    if elapsed > BATCH_TIME * 2 and count > 1:
+        return count // 2
+    return count
+
+
+# Socket options
+
+# Linux values, used when the socket module of this Python does not export them.
+TCP_INFO = globals().get('TCP_INFO', 11)
+TCP_CONGESTION = globals().get('TCP_CONGESTION', 13)
+
+# The start of the Linux struct tcp_info up to tcpi_max_pacing_rate: 8 single-byte fields, 24 32-bit fields and two
+# 64-bit pacing rates, in native byte order. Compiled once; every sample is one getsockopt and one unpack.
+TCP_INFO_STRUCT = struct.Struct("=8B24I2Q")
+
+# The values of a TCP_INFO sample, in the order of sample_tcp_info, which are also the names of the record fields.
+TCP_INFO_FIELDS = ("cwnd", "rtt_ms", "rttvar_ms", "retransmits", "pacing_bits_per_second")
+
+
+# Sets the socket options given on the command line. The buffer sizes and the MSS are set before the socket connects
+# or listens, so that they are used for the window scale and the MSS announced in the handshake; the sockets a
+# listening socket accepts inherit its options.
+# Arguments: sock (socket) - A TCP socket that is not connected yet.
+#            options (dict or None) - The options: 'sndbuf' and 'rcvbuf' (bytes, SO_SNDBUF/SO_RCVBUF; Linux doubles
+#                                     the value and caps it at net.core.wmem_max/rmem_max), 'nodelay' (bool),
+#                                     'mss' (bytes, TCP_MAXSEG) and 'congestion' (name, TCP_CONGESTION). Options
+#                                     that are None or False keep the kernel default.
+# Returns: None.
+def apply_socket_options(sock, options):
+    if not options:
+        return
+    if options.get('sndbuf'):
+        sock.setsockopt(SOL_SOCKET, SO_SNDBUF, options['sndbuf'])
+    if options.get('rcvbuf'):
+        sock.setsockopt(SOL_SOCKET, SO_RCVBUF, options['rcvbuf'])
+    if options.get('nodelay'):
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+    if options.get('mss'):
+        sock.setsockopt(IPPROTO_TCP, TCP_MAXSEG, options['mss'])
+    if options.get('congestion'):
+        sock.setsockopt(IPPROTO_TCP, TCP_CONGESTION, options['congestion'].encode())
+
+
+# Reads TCP_INFO of a connected socket.
+# Arguments: sock (socket) - A TCP socket.
+# Returns: A tuple with the values of TCP_INFO_FIELDS: the congestion window in segments, the smoothed RTT and its
+#          variation in milliseconds, the total number of retransmitted segments, and the pacing rate in bits per
+#          second (0 if the socket is not paced).
+def sample_tcp_info(sock):
+    # Older kernels return a shorter struct, the missing fields read as 0
+    info = TCP_INFO_STRUCT.unpack(sock.getsockopt(IPPROTO_TCP, TCP_INFO, TCP_INFO_STRUCT.size)
+                                  .ljust(TCP_INFO_STRUCT.size, b"\0"))
+    # tcpi_snd_cwnd, tcpi_rtt, tcpi_rttvar, tcpi_total_retrans, tcpi_pacing_rate (~0 when unlimited)
+    pacing_rate = info[32] if info[32] != 2 ** 64 - 1 else 0
+    return info[26], info[23] / 1000, info[24] / 1000, info[31], pacing_rate * 8
+
+
+# Samples TCP_INFO of the streams running in this process four times per interval, so that the collector, which may
+# run in another process, always finds a recent sample in counters['tcp_info'].
+# Arguments: counters (dict) - The shared per-stream counters, see client. 'sockets' holds the sockets of the
+#                              streams of this process by stream index.
+#            interval (float) - The interval length, in seconds.
+#            stop (Event) - Set when the streams of this process are done.
+# Returns: None.
+def sample_streams(counters, interval, stop):
+    sockets = counters['sockets']
+    tcp_info = counters['tcp_info']
+    fields = len(TCP_INFO_FIELDS)
+    while not stop.wait(interval / 4):
+        for stream, sock in list(sockets.items()):
+            try:
+                # A plain array, which the counters are without worker processes, only takes an array as a slice
+                tcp_info[stream * fields:(stream + 1) * fields] = array('d', sample_tcp_info(sock))
+            except OSError:
+                # The stream closed its socket after the list was taken
+                continue
+
+
+# File transfer
+
+# Largest chunk of a file that is sent with one sendfile call, or read with one call in the disk phase, in bytes.
+# The stream's byte counter is updated after every chunk.
+FILE_CHUNK = 4 * 1024 * 1024
+
+# Size of the part of a sink file that is preallocated and mapped at a time, in bytes. A multiple of
+# mmap.ALLOCATIONGRANULARITY, so every window after the first one starts at a valid mmap offset.
+SINK_WINDOW = 64 * 1024 * 1024
+
+
+# Splits a file into the parts the parallel streams send. Parts start at multiples of mmap.ALLOCATIONGRANULARITY, so
+# that both the mmap fallback of send_file and the sink on the server can map them directly; the last part takes the
+# remainder.
+# Arguments: total (int) - The size of the file in bytes.
+#            parts (int) - The number of streams.
+#            index (int) - The index of the stream.
+# Returns: (offset, size) - The part of the file the stream sends.
+def file_range(total, parts, index):
+    granularity = mmap.ALLOCATIONGRANULARITY
+    step = (total // parts) // granularity * granularity
+    offset = min(index * step, total)
+    end = total if index == parts - 1 else min(offset + step, total)
+    return offset, end - offset
+
+
+# The disk phase of a file transfer: reads the whole file once into one reused buffer, so the read speed of the disk
+# is measured on its own and the network phase sends from the page cache. A file larger than the page cache is read
+# from disk again while it is sent.
+# Arguments: path (str) - The file.
+# Returns: The time the read took, in seconds (float).
+def read_file(path):
+    buffer = bytearray(FILE_CHUNK)
+    start_time = time.perf_counter()
+    with open(path, "rb", buffering=0) as file:
+        while file.readinto(buffer):
+            pass
+    return time.perf_counter() - start_time
+
+
+# Sends part of a file with os.sendfile, which copies from the page cache to the socket in the kernel, so the file
+# never passes through Python memory. Where sendfile is not available or the file system does not support it, the
+# part is mapped with mmap and sent in memoryview slices of the mapping instead.
+# Arguments: sock (socket) - A connected, blocking socket.
+#            path (str) - The file.
+#            offset (int) - The start of the part, a multiple of mmap.ALLOCATIONGRANULARITY (see file_range).
+#            count (int) - The size of the part in bytes.
+#            counter (array or None) - If given, the number of bytes sent so far is kept in counter[index].
+#            index (int) - The index in counter.
+# Returns: sent_bytes (int) - The number of bytes sent.
+def send_file(sock, path, offset, count, counter=None, index=0):
+    sent_bytes = 0
+    sendfile = getattr(os, "sendfile", None)
+    with open(path, "rb") as file:
+        while sendfile is not None and sent_bytes < count:
+            try:
+                sent = sendfile(sock.fileno(), file.fileno(), offset + sent_bytes, min(FILE_CHUNK, count - sent_bytes))
+            except OSError as e:
+                if sent_bytes or e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                sendfile = None
+                break
+            if not sent:
+                raise ValueError(f"{path} got shorter while it was sent")
+            sent_bytes += sent
+            if counter is not None:
+                counter[index] = sent_bytes
+
+        if sent_bytes < count:
+            with mmap.mmap(file.fileno(), count, offset=offset, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    while sent_bytes < count:
+                        sent_bytes += sock.send(view[sent_bytes:sent_bytes + FILE_CHUNK])
+                        if counter is not None:
+                            counter[index] = sent_bytes
+    return sent_bytes
+
+
+# Chooses the file a connection writes to on a server with a sink. A directory sink gets one file per connection:
+# the name of the file the client sends, or the client's address for a plain stream test.
+# Arguments: sink (str) - The sink path given to the server.
+#            hello (dict) - The hello message of the test.
+#            client_address (tuple) - The client's IP address and port number.
+# Returns: The path of the file (str).
+def sink_path(sink, hello, client_address):
+    if not os.path.isdir(sink):
+        return sink
+    name = hello.get('file_name') or f"{client_address[0]}_{client_address[1]}"
+    return os.path.join(sink, os.path.basename(name))
+
+
+# Receives a stream straight into a file: the file is preallocated and mapped SINK_WINDOW bytes at a time, and
+# recv_into fills the mapping, so the data is copied once, from the socket into the page cache, and never held in
+# Python memory. Preallocating means a full disk fails the allocation instead of a write to the mapping. The part of
+# a file that parallel streams send is written at its offset, so the streams of one file reassemble it. When the
+# stream ends, the file is flushed to disk with fsync; that and the allocations are the disk time of the test.
+# Arguments: connection (socket) - The client connection.
+#            path (str) - The file, see sink_path.
+#            hello (dict) - The hello message; a file transfer names the offset and size of the part and the size of
+#                           the whole file, a plain stream test is written from the start of the file.
+#            counter (list or None) - If given, the number of bytes received so far is kept in counter[0].
+# Returns: (received_bytes, disk_seconds) - The number of bytes received, and the time spent allocating and flushing.
+def receive_file(connection, path, hello, counter=None):
+    offset = hello.get('file_offset', 0)
+    size = hello.get('file_size')
+    granularity = mmap.ALLOCATIONGRANULARITY
+    received_bytes = 0
+    disk_seconds = 0.0
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if hello.get('file_total') is not None:
+            os.ftruncate(fd, hello['file_total'])
+        position = offset
+        while size is None or position < offset + size:
+            window = SINK_WINDOW if size is None else min(SINK_WINDOW, offset + size - position)
+            start_time = time.perf_counter()
+            allocate_file(fd, position, window)
+            disk_seconds += time.perf_counter() - start_time
+
+            # A part that does not start on the mmap granularity is mapped from the granularity before it
+            base = position - position % granularity
+            filled = 0
+            with mmap.mmap(fd, position + window - base, offset=base) as mapped:
+                with memoryview(mapped) as view:
+                    recv_into = connection.recv_into
+                    skip = position - base
+                    while filled < window:
+                        received = recv_into(view[skip + filled:])
+                        if not received:
+                            break
+                        filled += received
+                        if counter is not None:
+                            counter[0] = received_bytes + filled
+            received_bytes += filled
+            position += filled
+            if filled < window:
+                break
+
+        if size is None:
+            # Cut off the preallocated rest of the last window
+            os.ftruncate(fd, position)
+        elif connection.recv(1):
+            raise ValueError("the client sent more than the size of its file")
+
+        start_time = time.perf_counter()
+        os.fsync(fd)
+        disk_seconds += time.perf_counter() - start_time
+    finally:
+        os.close(fd)
+    return received_bytes, disk_seconds
+
+
+# Makes sure a range of a file is allocated on disk, with posix_fallocate where the platform and the file system
+# support it, or else by extending the file to the end of the range.
+# Arguments: fd (int) - The file descriptor.
+#            offset (int) - The start of the range.
+#            length (int) - The length of the range in bytes.
+# Returns: None.
+def allocate_file(fd, offset, length):
+    try:
+        os.posix_fallocate(fd, offset, length)
+        return
+    except AttributeError:
+        pass
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    if os.fstat(fd).st_size < offset + length:
+        os.ftruncate(fd, offset + length)
+
+
+# Prints the phases of a file transfer, as phase records in the form of transfer_record: reading the file from disk,
+# sending it (the slowest stream, without the server's disk time), writing it to disk on the server (the slowest
+# stream's sink, if the server has one, which ends with the transfer) and the whole transfer from the start of the
+# read to the last confirmation.
+# Arguments: counters (dict) - The shared per-stream counters, see client.
+#            file_size (int) - The size of the file in bytes.
+#            read_seconds (float) - The duration of the disk phase, see read_file.
+#            total_seconds (float) - The duration of the whole transfer.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def print_file_summary(counters, file_size, read_seconds, total_seconds, format_unit):
+    network_seconds = max(counters['elapsed'])
+    records = [transfer_record("phase", "disk read", 0.0, read_seconds, file_size),
+               transfer_record("phase", "network", read_seconds, read_seconds + network_seconds, file_size)]
+    write_seconds = max(counters['disk_write'])
+    if write_seconds:
+        records.append(transfer_record("phase", "disk write", total_seconds - write_seconds, total_seconds, file_size))
+    records.append(transfer_record("phase", "end-to-end", 0.0, total_seconds, file_size))
+    print_info("----------------------------------------------------", format_unit)
+    print_transfer_records(records, format_unit)
+
+
+# Link emulation relay
+
+# Size of the segments the relay moves through the emulated links: the Ethernet MTU. Queue limits in packets
+# (max_queue_size, as in Mininet) are converted to bytes with it.
+RELAY_SEGMENT = 1500
+
+# Queue limit of a link without max_queue_size, in packets: the default txqueuelen of Linux.
+RELAY_QUEUE = 1000
+
+# Largest read from a relayed socket, in bytes.
+RELAY_READ = 64 * 1024
+
+# Kernel buffer size of the relayed sockets, in bytes. Kept small so data waits in the emulated queues rather than in
+# socket buffers, which would hide the queueing delay and let senders run far ahead of the links.
+RELAY_BUFFER = 64 * 1024
+
+# Extra delay of a lost segment: the minimum retransmission timeout of Linux. The relay terminates TCP on both sides,
+# so a loss cannot be dropped from the byte stream; it is emulated as the retransmission delay instead, which also
+# holds back the segments behind it.
+RELAY_RTO = 0.2
+
+# Resolution of the relay's timer wheel in seconds, and its number of slots (the wheel turns once per TIMER_SLOTS
+# ticks; later timers wait in their slot for the right round).
+TIMER_TICK = 0.001
+TIMER_SLOTS = 1024
+
+# Default topology file, next to this script.
+TOPOLOGY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "portfolio_topology.json")
+
+
+# A hashed timer wheel: timers are put in the slot of their tick, so scheduling is O(1) and every tick only looks at
+# the timers of one slot, however many segments are in flight on the emulated links.
+class TimerWheel:
+    __slots__ = ('slots', 'current', 'pending')
+
+    def __init__(self):
+        self.slots = [[] for _ in range(TIMER_SLOTS)]
+        self.current = int(time.monotonic() / TIMER_TICK)
+        self.pending = 0
+
+    # Schedules a callback. It fires at the first tick at or after the given time, never before it, so an emulated
+    # delay is a lower bound; a time that has passed fires on the next advance.
+    # Arguments: when (float) - The time on the time.monotonic clock.
+    #            callback (function) - The function to call.
+    #            args - The arguments of the callback.
+    # Returns: None.
+    def schedule(self, when, callback, *args):
+        expiry = max(math.ceil(when / TIMER_TICK), self.current)
+        self.slots[expiry % TIMER_SLOTS].append((expiry, callback, args))
+        self.pending += 1
+
+    # Calls the callbacks of every tick up to now, in the order of their ticks.
+    # Arguments: now (float) - The current time on the time.monotonic clock.
+    # Returns: None.
+    def advance(self, now):
+        target = int(now / TIMER_TICK)
+        while self.pending and self.current <= target:
+            index = self.current % TIMER_SLOTS
+            fired = True
+            while fired:
+                # Callbacks can schedule timers for the current tick, they land in the new list of the slot
+                slot, self.slots[index] = self.slots[index], []
+                fired = False
+                for entry in slot:
+                    if entry[0] <= self.current:
+                        self.pending -= 1
+                        fired = True
+                        entry[1](*entry[2])
+                    else:
+                        self.slots[index].append(entry)
+            self.current += 1
+        self.current = max(self.current, target)
+
+
+# One direction of an emulated link, with the parameters of a Mininet TCLink: a FIFO queue of at most limit bytes,
+# drained at the link rate, followed by the propagation delay with optional jitter and loss. The queue is not stored;
+# its length follows from the time the link finishes sending the last queued segment (free_at).
+class EmulatedLink:
+    __slots__ = ('name', 'rate', 'delay', 'jitter', 'loss', 'limit', 'free_at', 'random')
+
+    # Arguments: name (str) - The name of the link, e.g. "L1".
+    #            bw (float or None) - The bandwidth in Mbit/s, or None for no limit.
+    #            delay (float) - The one-way delay in seconds.
+    #            jitter (float) - The largest random deviation of the delay in seconds.
+    #            loss (float) - The loss probability of a segment, in percent.
+    #            max_queue_size (int) - The queue limit in packets.
+    def __init__(self, name, bw=None, delay=0.0, jitter=0.0, loss=0.0, max_queue_size=RELAY_QUEUE):
+        self.name = name
+        self.rate = bw * 1e6 / 8 if bw else None
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss / 100
+        self.limit = max_queue_size * RELAY_SEGMENT
+        self.free_at = 0.0
+        import random
+        self.random = random.Random()
+
+    # Returns the time at which a segment of size bytes fits in the queue: now, or when enough of the queue has been
+    # sent. An empty queue always takes a segment.
+    def room_at(self, size, now):
+        if self.rate is None or self.free_at <= now:
+            return now
+        return max(now, self.free_at - (self.limit - size) / self.rate)
+
+    # Queues a segment.
+    # Arguments: size (int) - The size of the segment in bytes.
+    #            now (float) - The time the segment enters the queue.
+    # Returns: The time the segment arrives at the other end of the link (float).
+    def send(self, size, now):
+        departure = now
+        if self.rate is not None:
+            departure = self.free_at = max(now, self.free_at) + size / self.rate
+        arrival = departure + self.delay
+        if self.jitter:
+            arrival = max(departure, arrival + self.random.uniform(-self.jitter, self.jitter))
+        if self.loss and self.random.random() < self.loss:
+            arrival += max(RELAY_RTO, 2 * self.delay)
+        return arrival
+
+
+# One direction of a relayed connection: the bytes read from source go through the links of the route as segments and
+# are written to target. queues[i] holds the segments waiting to enter link i and queues[-1] the segments waiting to
+# be written. A link only takes segments while the queue behind it is empty, so a full link further on holds back
+# the links before it and in the end the reads from source, and TCP flow control slows down the sender.
+class RelayPipe:
+    __slots__ = ('source', 'target', 'links', 'queues', 'arrivals', 'waiting', 'reading', 'done', 'connection')
+
+    # Arguments: source (socket), target (socket) - The sockets the pipe reads from and writes to.
+    #            links (list) - The EmulatedLink of every hop, in order.
+    #            connection (list) - Both pipes of the relayed connection.
+    def __init__(self, source, target, links, connection):
+        self.source = source
+        self.target = target
+        self.links = links
+        self.queues = [collections.deque() for _ in range(len(links) + 1)]
+        self.arrivals = [0.0] * len(links)
+        self.waiting = [False] * len(links)
+        self.reading = True
+        self.done = False
+        self.connection = connection
+
+
+# Relays TCP connections between simpleperf clients and a server through emulated links. Every route listens on its
+# own port, and all connections of all routes share the link objects, so flows over the same link compete for its
+# bandwidth and queue like on the real network. One selectors event loop serves every connection, and the segments
+# in flight are timers in one TimerWheel.
+class Relay:
+    # Arguments: target (tuple) - The address of the simpleperf server.
+    #            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+    def __init__(self, target, format_unit):
+        self.target = target
+        self.format_unit = format_unit
+        self.selector = selectors.DefaultSelector()
+        self.wheel = TimerWheel()
+
+    # Listens for the connections of a route.
+    # Arguments: address (tuple) - The address to listen on.
+    #            forward (list) - The links from the client to the server.
+    #            backward (list) - The links from the server to the client.
+    # Returns: None.
+    def listen(self, address, forward, backward):
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        # Set before listening so the window of accepted connections is scaled to it
+        listener.setsockopt(SOL_SOCKET, SO_RCVBUF, RELAY_BUFFER)
+        listener.setsockopt(SOL_SOCKET, SO_SNDBUF, RELAY_BUFFER)
+        listener.bind(address)
+        listener.listen(SOMAXCONN)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, {'forward': forward, 'backward': backward})
+
+    # Runs the event loop.
+    # Returns: None.
+    def run(self):
+        while True:
+            for key, events in self.selector.select(TIMER_TICK if self.wheel.pending else None):
+                if 'forward' in key.data:
+                    self.accept(key.fileobj, key.data['forward'], key.data['backward'])
+                    continue
+                try:
+                    if events & selectors.EVENT_READ:
+                        self.read(key.data['reads'])
+                    if events & selectors.EVENT_WRITE:
+                        self.write(key.data['writes'])
+                except OSError as e:
+                    print_info(f"Relayed connection lost: {e}", self.format_unit)
+                    self.close(key.data['reads'].connection)
+            self.wheel.advance(time.monotonic())
+
+    # Accepts every waiting connection of a route and connects each to the server.
+    # Arguments: listener (socket) - The route's listening socket.
+    #            forward, backward (list) - The route's links, see listen.
+    # Returns: None.
+    def accept(self, listener, forward, backward):
+        while True:
+            try:
+                client_socket, _ = listener.accept()
+            except BlockingIOError:
+                return
+            try:
+                server_socket = socket(AF_INET, SOCK_STREAM)
+                server_socket.setsockopt(SOL_SOCKET, SO_RCVBUF, RELAY_BUFFER)
+                server_socket.setsockopt(SOL_SOCKET, SO_SNDBUF, RELAY_BUFFER)
+                server_socket.connect(self.target)
+            except OSError as e:
+                server_socket.close()
+                print_info(f"Relay could not connect to {self.target[0]}:{self.target[1]}: {e}", self.format_unit)
+                client_socket.close()
+                continue
+            connection = []
+            for sock in (client_socket, server_socket):
+                sock.setblocking(False)
+                sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+            connection += [RelayPipe(client_socket, server_socket, forward, connection),
+                           RelayPipe(server_socket, client_socket, backward, connection)]
+            for sock, reads, writes in ((client_socket, connection[0], connection[1]),
+                                        (server_socket, connection[1], connection[0])):
+                self.selector.register(sock, selectors.EVENT_READ, {'reads': reads, 'writes': writes})
+
+    # Reads from a pipe's source and puts the data in the queue of the first link, as segments. The end of the stream
+    # is an empty segment, which travels behind the data and shuts down the sending side of the target.
+    # Arguments: pipe (RelayPipe) - The pipe.
+    # Returns: None.
+    def read(self, pipe):
+        data = pipe.source.recv(RELAY_READ)
+        queue = pipe.queues[0]
+        if not data:
+            pipe.reading = False
+            queue.append(b"")
+        for start in range(0, len(data), RELAY_SEGMENT):
+            queue.append(data[start:start + RELAY_SEGMENT])
+        self.advance(pipe, 0, time.monotonic())
+        self.update(pipe)
+
+    # Moves the segments waiting in front of a link into it, as far as its queue and the queue behind it allow. If
+    # the link is full, a timer retries when it has room.
+    # Arguments: pipe (RelayPipe) - The pipe.
+    #            hop (int) - The index of the link; the index after the last link writes to the target.
+    #            now (float) - The current time, or the time the timer that called this was due.
+    # Returns: None.
+    def advance(self, pipe, hop, now):
+        if pipe.source.fileno() < 0:
+            return
+        if hop == len(pipe.links):
+            self.write(pipe)
+            return
+        queue, link = pipe.queues[hop], pipe.links[hop]
+        while queue and not pipe.queues[hop + 1]:
+            segment = queue[0]
+            ready = link.room_at(len(segment), now)
+            if ready > now:
+                if not pipe.waiting[hop]:
+                    pipe.waiting[hop] = True
+                    self.wheel.schedule(ready, self.retry, pipe, hop, ready)
+                break
+            queue.popleft()
+            # Jitter and loss must not reorder the byte stream
+            arrival = pipe.arrivals[hop] = max(link.send(len(segment), now), pipe.arrivals[hop])
+            self.wheel.schedule(arrival, self.deliver, pipe, hop + 1, segment, arrival)
+        if queue:
+            return
+        if hop == 0:
+            self.update(pipe)
+        else:
+            self.advance(pipe, hop - 1, now)
+
+    # Timer callback: a full link has room again.
+    def retry(self, pipe, hop, when):
+        pipe.waiting[hop] = False
+        self.advance(pipe, hop, when)
+
+    # Timer callback: a segment arrives at the end of a link.
+    def deliver(self, pipe, hop, segment, when):
+        pipe.queues[hop].append(segment)
+        self.advance(pipe, hop, when)
+
+    # Writes the segments that came through all links to the pipe's target, and shuts down its sending side when the
+    # end of the stream arrives. Once both directions are done the connection is closed.
+    # Arguments: pipe (RelayPipe) - The pipe.
+    # Returns: None.
+    def write(self, pipe):
+        out = pipe.queues[-1]
+        try:
+            while out:
+                segment = out[0]
+                if not segment:
+                    out.popleft()
+                    pipe.target.shutdown(SHUT_WR)
+                    pipe.done = True
+                    break
+                sent = pipe.target.send(segment)
+                if sent < len(segment):
+                    out[0] = segment[sent:]
+                    break
+                out.popleft()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print_info(f"Relayed connection lost: {e}", self.format_unit)
+            self.close(pipe.connection)
+            return
+        if all(p.done for p in pipe.connection):
+            self.close(pipe.connection)
+            return
+        if not out:
+            if pipe.links:
+                self.advance(pipe, len(pipe.links) - 1, time.monotonic())
+            else:
+                self.update(pipe)
+        self.update(pipe.connection[1] if pipe is pipe.connection[0] else pipe.connection[0])
+
+    # Registers the source socket of a pipe for the events it waits for: reading while the pipe's first queue is
+    # empty, writing while segments are waiting to be written to it. A socket that waits for nothing is unregistered.
+    # Arguments: pipe (RelayPipe) - The pipe.
+    # Returns: None.
+    def update(self, pipe):
+        sock = pipe.source
+        if sock.fileno() < 0:
+            return
+        writes = pipe.connection[1] if pipe is pipe.connection[0] else pipe.connection[0]
+        events = 0
+        if pipe.reading and not pipe.queues[0]:
+            events |= selectors.EVENT_READ
+        if writes.queues[-1]:
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self.selector.get_key(sock)
+        except KeyError:
+            if events:
+                self.selector.register(sock, events, {'reads': pipe, 'writes': writes})
+            return
+        if not events:
+            self.selector.unregister(sock)
+        elif events != key.events:
+            self.selector.modify(sock, events, key.data)
+
+    # Closes both sockets of a relayed connection. Timers of its segments that are still in the wheel find the
+    # sockets closed and do nothing.
+    # Arguments: connection (list) - Both pipes of the connection.
+    # Returns: None.
+    def close(self, connection):
+        for pipe in connection:
+            if pipe.source.fileno() >= 0:
+                try:
+                    self.selector.unregister(pipe.source)
+                except KeyError:
+                    pass
+                pipe.source.close()
+
+
+# Converts a Mininet delay string such as '10ms' to seconds.
+# Arguments: delay (str or number) - The delay, with the unit s, ms or us (a number is taken as milliseconds).
+# Returns: The delay in seconds (float).
+def parse_delay(delay):
+    if isinstance(delay, (int, float)):
+        return delay / 1000
+    import re
+    match = re.match(r"^\s*([\d.]+)\s*(s|ms|us)?\s*$", delay)
+    if not match:
+        raise ValueError(f"invalid delay: {delay}")
+    return float(match.group(1)) / {'s': 1, 'ms': 1000, 'us': 1e6}[match.group(2) or "ms"]
+
+
+# Loads a topology description: the router every host is attached to, and every shaped link between two routers
+# with the parameters of its Mininet TCLink (bw in Mbit/s, delay, jitter, loss in percent, max_queue_size in
+# packets). portfolio_topology.json describes PortfolioNetwork2410 of portfolio_topology.py.
+# Arguments: path (str) - The JSON file.
+# Returns: topology (dict) - The description, with an EmulatedLink per link and direction in 'emulated', keyed by
+#                            (link name, from router).
+def load_topology(path):
+    with open(path) as file:
+        import json
+        topology = json.load(file)
+    topology['emulated'] = {}
+    for name, link in topology['links'].items():
+        for end in link['ends']:
+            topology['emulated'][(name, end)] = EmulatedLink(name, link.get('bw'), parse_delay(link.get('delay', 0)),
+                                                             parse_delay(link.get('jitter', 0)), link.get('loss', 0),
+                                                             link.get('max_queue_size', RELAY_QUEUE))
+    return topology
+
+
+# Finds the links between two hosts, with a breadth-first search over the routers.
+# Arguments: topology (dict) - The topology, see load_topology.
+#            route (str) - The two hosts, e.g. "h1-h4".
+# Returns: (forward, backward) - The EmulatedLink objects from the first host to the second one, and back.
+def route_links(topology, route):
+    source, destination = route.split("-")
+    start, goal = topology['hosts'][source], topology['hosts'][destination]
+    paths = {start: []}
+    pending = [start]
+    while pending and goal not in paths:
+        router = pending.pop(0)
+        for name, link in topology['links'].items():
+            if router in link['ends']:
+                other = link['ends'][1] if link['ends'][0] == router else link['ends'][0]
+                if other not in paths:
+                    paths[other] = paths[router] + [(name, router, other)]
+                    pending.append(other)
+    if goal not in paths:
+        raise ValueError(f"no path between {source} and {destination}")
+    emulated = topology['emulated']
+    forward = [emulated[(name, start_router)] for name, start_router, _ in paths[goal]]
+    backward = [emulated[(name, end_router)] for name, _, end_router in reversed(paths[goal])]
+    return forward, backward
+
+
+# Starts the relay: listens on port, port + 1, ... for the routes in order and relays every connection to the server
+# over the links of its route.
+# Arguments: bind_ip (str) - The IP address to listen on.
+#            port (int) - The port of the first route.
+#            target (str) - The server address, "ip:port".
+#            routes (list) - The routes, e.g. ["h1-h4", "h2-h5"].
+#            topology (dict) - The topology, see load_topology.
+#            format_unit (dict) - A dictionary containing the format unit, its divisor and the output format.
+# Returns: None.
+def relay(bind_ip, port, target, routes, topology, format_unit):
+    host, _, target_port = target.rpartition(":")
+    emulator = Relay((host, int(target_port)), format_unit)
+    print_info("---------------------------------------------", format_unit)
+    print_info(f"A simpleperf relay to {target} emulating {topology.get('name', 'a topology')}", format_unit)
+    print_info("---------------------------------------------", format_unit)
+    for offset, route in enumerate(routes):
+        forward, backward = route_links(topology, route)
+        emulator.listen((bind_ip, port + offset), forward, backward)
+        hops = ", ".join(f"{link.name} ({link.rate * 8 / 1e6 if link.rate else 'unlimited'} Mbit/s, "
+                         f"{link.delay * 1000:g} ms, {link.limit // RELAY_SEGMENT} packets)" for link in forward)
+        print_info(f"{route}: port {port + offset} -> {hops or 'no shaped links'}", format_unit)
+    try:
+        emulator.run()
+    except KeyboardInterrupt:
+        pass
+
+
+# Time series
+
+# Default capacity of a TimeSeries in rows, shared by all streams: 20 MB, or almost three hours of one stream at the
+# default resolution (and a quarter of that with four streams).
+SERIES_ROWS = 1 << 20
+
+# Default time between two samples of a TimeSeries, in seconds.
+SERIES_RESOLUTION = 0.01
+
+# The header of a time series file: magic, version, resolution, number of streams and number of rows. It is followed
+# by the unit and the stream names, each prefixed with its length (SERIES_NAME), and then the time, stream and value
+# columns of the rows, oldest first. All numbers are little-endian.
+SERIES_HEADER = struct.Struct("<4sBdII")
+SERIES_NAME = struct.Struct("<H")
+SERIES_MAGIC = b"SPTS"
+
+
+# A bounded, array-backed ring buffer of per-stream counter samples, taken every resolution seconds by record_series.
+# Every row holds the wall-clock time of a sample, the index of a stream in names and the stream's counter at that
+# time: the bytes it transferred, or its connections in a crr test. Once the ring is full the oldest rows are
+# overwritten, so a long run uses the same memory as a short one. For serve_metrics every stream also keeps its latest
+# sample, its rate over that sample and its highest and lowest rate since the metrics were last read, so that a burst
+# or a stall between two scrapes still shows. A stream that has left the samples (a finished flow on a server) is
+# dropped once the ring has overwritten its last row, and a new stream takes its index, so a server that sees new
+# flows all the time keeps as many streams as have rows in the ring, not every flow it has ever served.
+class TimeSeries:
+    __slots__ = ('resolution', 'unit', 'names', 'index', 'times', 'streams', 'values', 'head', 'count', 'latest',
+                 'active', 'lock', 'written', 'last', 'free', 'pruned')
+
+    # Arguments: resolution (float) - The time between two samples, in seconds.
+    #            rows (int) - The capacity of the ring, in rows of all streams together: every sample of n streams
+    #                         takes n rows.
+    #            unit (str) - What the counters count, "bytes" or "connections".
+    def __init__(self, resolution=SERIES_RESOLUTION, rows=SERIES_ROWS, unit="bytes"):
+        self.resolution = resolution
+        self.unit = unit
+        self.names = []
+        self.index = {}
+        self.times = array('d', bytes(8 * rows))
+        self.streams = array('I', bytes(4 * rows))
+        self.values = array('Q', bytes(8 * rows))
+        self.head = 0
+        self.count = 0
+        # Per stream: [time, value, rate, peak rate, low rate] of its latest sample; the rates are None until the
+        # stream has two samples
+        self.latest = []
+        # The streams of the latest sample, the ones serve_metrics reports
+        self.active = []
+        self.lock = threading.Lock()
+        # The number of rows ever written, the number of the last row of every stream, the indexes of dropped streams
+        # (their names are empty) and the number of rows written when dropped streams were last looked for
+        self.written = 0
+        self.last = []
+        self.free = []
+        self.pruned = 0
+
+    # Appends one sample of every stream.
+    # Arguments: when (float) - The time of the sample, from time.time.
+    #            samples (iterable) - (name, value) pairs, one per stream.
+    # Returns: None.
+    def record(self, when, samples):
+        capacity = len(self.times)
+        active = []
+        with self.lock:
+            for name, value in samples:
+                stream = self.index.get(name)
+                if stream is None:
+                    if self.free:
+                        stream = self.free.pop()
+                        self.names[stream] = name
+                        self.latest[stream] = [when, value, None, None, None]
+                    else:
+                        stream = len(self.names)
+                        self.names.append(name)
+                        self.latest.append([when, value, None, None, None])
+                        self.last.append(0)
+                    self.index[name] = stream
+                row = self.head
+                self.times[row] = when
+                self.streams[row] = stream
+                self.values[row] = value
+                self.head = (row + 1) % capacity
+                self.last[stream] = self.written
+                self.written += 1
+                active.append(stream)
+
+                latest = self.latest[stream]
+                if when > latest[0]:
+                    # A flow ID that is reused by a new connection starts over, which is not a negative rate
+                    rate = max(0, value - latest[1]) / (when - latest[0])
+                    peak, low = latest[3], latest[4]
+                    latest[:] = [when, value, rate, rate if peak is None else max(peak, rate),
+                                 rate if low is None else min(low, rate)]
+            self.count = min(self.count + len(active), capacity)
+            self.active = active
+            if self.written - self.pruned >= capacity:
+                self.prune()
+
+    # Drops the streams that are not in the latest sample and have no rows left in the ring. Called with the lock
+    # held, once per capacity rows, so a dropped stream's name is kept for at most two turns of the ring.
+    # Returns: None.
+    def prune(self):
+        self.pruned = self.written
+        active = set(self.active)
+        for stream, name in enumerate(self.names):
+            if name and stream not in active and self.written - self.last[stream] > len(self.times):
+                del self.index[name]
+                self.names[stream] = ""
+                self.latest[stream] = [0.0, 0, None, None, None]
+                self.free.append(stream)
+
+    # Returns: (times, streams, values) - Copies of the columns of the rows held, oldest first.
+    def rows(self):
+        with self.lock:
+            start = (self.head - self.count) % len(self.times)
+            end = start + self.count
+            if end <= len(self.times):
+                return self.times[start:end], self.streams[start:end], self.values[start:end]
+            return (self.times[start:] + self.times[:self.head], self.streams[start:] + self.streams[:self.head],
+                    self.values[start:] + self.values[:self.head])
+
+    # Formats the streams of the latest sample in the Prometheus text format: the counter of every stream, its rate
+    # over the latest sample, and its highest and lowest rate since the previous call, which starts the next window.
+    # Rates of byte counters are in bits per second.
+    # Returns: The metrics (str).
+    def metrics(self):
+        rate_unit, scale = ("bits", 8) if self.unit == "bytes" else (self.unit, 1)
+        with self.lock:
+            streams = [(self.names[stream], list(self.latest[stream])) for stream in self.active]
+            for stream in self.active:
+                latest = self.latest[stream]
+                latest[3] = latest[4] = latest[2]
+        metrics = ((f"simpleperf_{self.unit}_total", "counter", f"{self.unit.capitalize()} of each stream so far.", 1,
+                    1),
+                   (f"simpleperf_{rate_unit}_per_second", "gauge", "Rate of each stream over its latest sample.", 2,
+                    scale),
+                   (f"simpleperf_peak_{rate_unit}_per_second", "gauge",
+                    "Highest rate of each stream over one sample since the previous scrape.", 3, scale),
+                   (f"simpleperf_low_{rate_unit}_per_second", "gauge",
+                    "Lowest rate of each stream over one sample since the previous scrape.", 4, scale))
+        lines = []
+        for name, kind, description, field, factor in metrics:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{stream="{stream}"}} {latest[field] * factor}'
+                      for stream, latest in streams if latest[field] is not None]
+        lines += ["# HELP simpleperf_resolution_seconds Time between two samples.",
+                  "# TYPE simpleperf_resolution_seconds gauge", f"simpleperf_resolution_seconds {self.resolution}"]
+        return "\n".join(lines) + "\n"
+
+    # Writes the rows held to a file, see SERIES_HEADER; load_series reads it back. Dropped streams keep their index
+    # with an empty name.
+    # Arguments: path (str) - The file.
+    # Returns: None.
+    def dump(self, path):
+        columns = self.rows()
+        with open(path, "wb") as file:
+            file.write(SERIES_HEADER.pack(SERIES_MAGIC, 1, self.resolution, len(self.names), len(columns[0])))
+            for name in [self.unit] + self.names:
+                encoded = name.encode()
+                file.write(SERIES_NAME.pack(len(encoded)) + encoded)
+            for column in columns:
+                if sys.byteorder == "big":
+                    column.byteswap()
+                column.tofile(file)
+
+
+# Reads a time series file written by TimeSeries.dump.
+# Arguments: path (str) - The file.
+# Returns: series (TimeSeries) - The series, with exactly the rows of the file; rows() returns them in order.
+def load_series(path):
+    with open(path, "rb") as file:
+        magic, version, resolution, streams, rows = SERIES_HEADER.unpack(file.read(SERIES_HEADER.size))
+        if magic != SERIES_MAGIC or version != 1:
+            raise ValueError(f"{path} is not a simpleperf time series")
+        unit, *names = [file.read(SERIES_NAME.unpack(file.read(SERIES_NAME.size))[0]).decode()
+                        for _ in range(streams + 1)]
+        series = TimeSeries(resolution, 1, unit)
+        for column, typecode in (('times', 'd'), ('streams', 'I'), ('values', 'Q')):
+            data = array(typecode)
+            data.fromfile(file, rows)
+            if sys.byteorder == "big":
+                data.byteswap()
+            setattr(series, column, data)
+    series.names = names
+    series.index = {name: stream for stream, name in enumerate(names) if name}
+    series.latest = [[0.0, 0, None, None, None] for _ in names]
+    series.last = [rows - 1] * len(names)
+    series.free = [stream for stream, name in enumerate(names) if not name]
+    series.count = series.written = series.pruned = rows
+    return series
+
+
+# Samples counters into a TimeSeries on a fixed clock of series.resolution seconds, like collect_intervals, and takes
+# a last sample when stopped. Ticks missed while the process was busy are skipped, not sampled back to back.
+# Arguments: series (TimeSeries) - The series to record into.
+#            sample (function) - Returns the (name, value) pairs of the current counters.
+#            stop (Event or None) - Set to end the recording; without it, it runs as long as the process.
+# Returns: None.
+def record_series(series, sample, stop=None):
+    stop = stop or threading.Event()
+    start = time.monotonic()
+    tick = 1
+    while True:
+        stopped = stop.wait(max(0.0, start + tick * series.resolution - time.monotonic()))
+        series.record(time.time(), sample())
+        if stopped:
+            return
+        tick = max(tick + 1, int((time.monotonic() - start) / series.resolution) + 1)
+
+
+# Serves the metrics of a TimeSeries (see TimeSeries.metrics) in the Prometheus text format at
+# http://bind:port/metrics, from daemon threads. The full series is in the file written by TimeSeries.dump.
+# Arguments: series (TimeSeries) - The series.
+#            port (int) - The port of the endpoint.
+#            bind (str) - The IP address of the endpoint, the local host by default.
+# Returns: httpd (ThreadingHTTPServer) - The HTTP server; shutdown() stops it.
+def serve_metrics(series, port, bind="127.0.0.1"):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # Defined here because http.server is only imported when metrics are served
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = series.metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes are not logged
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((bind, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+# Library API
+
+# Runs a client test from Python and returns its result, without the command line. By default nothing is printed;
+# the results are in the returned ClientResult.
+# Arguments: server_ip (str) - IP address of the server.
+#            server_port (int) - Port number on which the server is listening.
+#            duration (float) - Duration of the test in seconds.
+#            parallel (int) - Number of parallel streams.
+#            message_size (int) - Number of bytes in each message.
+#            interval (float or None) - Interval length, for the per-interval samples of the result.
+#            output (str) - "none", or "text", "json" or "csv" to also print the results like the command line.
+#            unit (str) - The unit of printed results, B, KB or MB.
+#            options - Other keyword arguments of client, e.g. num_bytes, direction, bandwidth, latency or workers.
+# Returns: result (ClientResult) - The results of the streams.
+def run_client(server_ip="127.0.0.1", server_port=8080, duration=10, parallel=1, message_size=1000, interval=None,
+               output="none", unit="MB", **options):
+    return client(server_ip, server_port, duration, interval, parallel, message_size, parse_format_unit(unit, output),
+                  **options)
+
+
+# A server that runs in the current process, for use as a library: start listens and serves from a daemon thread,
+# stop stops accepting and waits for the engine to end. With the async engine, stop also closes the connections that
+# are still running; with the thread engine they finish in their own threads. The finished connections and the bytes
+# they transferred are counted in connections and bytes. It can be used as a context manager:
+#     with Server(port=0) as server:
+#         result = run_client(server_port=server.address[1], duration=1)
+class Server:
+    # Arguments: bind (str) - The IP address to listen on.
+    #            port (int) - The port number, or 0 for a free port (see address).
+    #            engine (str) - "thread" or "async".
+    #            recv_buffer (int) - The size of the receive buffer of each connection, in bytes.
+    #            backlog (int) - The length of the accept queue.
+    #            interval (float or None) - Report the active flows on every interval, see report_flows.
+    #            socket_options (dict or None) - Options set on the listening socket, see apply_socket_options.
+    #            sink (str or None) - A file or directory the received data is written to, see receive_file.
+    #            series (TimeSeries or None) - A time series the bytes of every flow are recorded into.
+    #            output (str) - "none", or "text", "json" or "csv" to print like the command line.
+    #            unit (str) - The unit of printed results, B, KB or MB.
+    def __init__(self, bind="127.0.0.1", port=8080, engine="thread", recv_buffer=RECV_BUFFER, backlog=SOMAXCONN,
+                 interval=None, socket_options=None, sink=None, series=None, output="none", unit="MB"):
+        self.bind = bind
+        self.port = port
+        self.engine = engine
+        self.recv_buffer = recv_buffer
+        self.backlog = backlog
+        self.interval = interval
+        self.socket_options = socket_options
+        self.sink = sink
+        self.series = series
+        self.format_unit = parse_format_unit(unit, output)
+        self.socket = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.totals = None
+
+    # Listens and starts serving. Errors such as a port in use are raised here.
+    # Returns: The server (Server).
+    def start(self):
+        import multiprocessing
+        self.totals = multiprocessing.Array('Q', 2)
+        self.socket = socket(AF_INET, SOCK_STREAM)
+        try:
+            apply_socket_options(self.socket, self.socket_options)
+            tune_listener(self.socket)
+            self.socket.bind((self.bind, self.port))
+            self.socket.listen(self.backlog)
+        except OSError:
+            self.socket.close()
+            raise
+        write_record_header(self.format_unit)
+        self.thread = threading.Thread(target=serve, args=(self.socket, self.format_unit, self.recv_buffer, self.engine,
+                                                           self.totals,
+                                                           start_flow_reporter(self.interval, self.format_unit,
+                                                                               self.series),
+                                                           self.sink, self.stopping), daemon=True)
+        self.thread.start()
+        return self
+
+    # Stops accepting connections and waits for the engine to end.
+    # Returns: None.
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        # Wakes up the engine's accept, which then sees that the server is stopping
+        self.socket.shutdown(SHUT_RDWR)
+        self.thread.join()
+        self.socket.close()
+        self.thread = None
+
+    # The (ip, port) the server listens on.
+    @property
+    def address(self):
+        return self.socket.getsockname()
+
+    # The number of connections that have finished.
+    @property
+    def connections(self):
+        return self.totals[0] if self.totals is not None else 0
+
+    # The number of bytes the finished connections transferred.
+    @property
+    def bytes(self):
+        return self.totals[1] if self.totals is not None else 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
 
 
 # This function parses the format unit string and returns a dictionary with the unit and its corresponding divisor.
+# The dictionary also carries the output format of the results: "text" tables, or one "json" or "csv" record per
+# interval and summary.
 # Arguments:
 # - format_unit (str): The format unit string.
+# - output (str): The output format.
 # Returns:
-# - A dictionary containing the unit and its corresponding divisor.
-def parse_format_unit(format_unit):
+# - A dictionary containing the unit, its corresponding divisor and the output format.
+def parse_format_unit(format_unit, output="text"):
     units = {'B': 1, 'KB': 1000, 'MB': 1000 * 1000}
-    return {'unit': format_unit, 'divisor': units[format_unit]}
+    return {'unit': format_unit, 'divisor': units[format_unit], 'output': output}
 
 
 # Function that validates that the argparse argument is a positive integer.
@@ -259,13 +3653,40 @@ def parse_format_unit(format_unit):
 # - Error message if the argument is a negative integer
 # - The integer value if the argument is implemented correctly
 def positive_int(value):
+    import argparse
     ivalue = int(value)
     if ivalue <= 0:
         raise argparse.ArgumentTypeError("%s is an invalid positive int value" % value)
     return ivalue
 
 
+# Function that validates that the argparse argument is a positive number, e.g. a fractional interval.
+# Returns:
+# - Error message if the argument is not a positive number
+# - The float value if the argument is implemented correctly
+def positive_float(value):
+    import argparse
+    fvalue = float(value)
+    if fvalue <= 0:
+        raise argparse.ArgumentTypeError("%s is an invalid positive value" % value)
+    return fvalue
+
+
+# Function that validates that the argparse argument is a number of bytes, with an optional unit (see
+# parse_num_bytes), e.g. 64KB.
+# Returns:
+# - Error message if the argument is not a number of bytes
+# - The number of bytes if the argument is implemented correctly
+def byte_size(value):
+    import argparse
+    try:
+        return parse_num_bytes(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is an invalid size, e.g. 1000, 64KB or 1MB" % value)
+
+
 if __name__ == "__main__":
+    import argparse
     parser = argparse.ArgumentParser(description="A simpleperf tool")
 
     # Parse command line arguments
@@ -276,33 +3697,190 @@ if __name__ == "__main__":
                         help="port number on which the server should listen")
     parser.add_argument("-f", "--format", type=str, choices=["B", "KB", "MB"], default="MB",
                         help="format of summary of results")
+    parser.add_argument("--output", type=str, choices=["text", "json", "csv"], default="text",
+                        help="print results as tables, or as one JSON Lines or CSV record per interval and summary")
     parser.add_argument("-I", "--server_ip", type=str, default="127.0.0.1", help="IP address of the server")
     parser.add_argument("-t", "--time", type=positive_int, default=25,
                         help="Total duration for which data should be generated")
-    parser.add_argument("-i", "--interval", type=positive_int, default=None, help="print statistics per z second")
+    parser.add_argument("-i", "--interval", type=positive_float, default=None,
+                        help="print statistics per z second, fractions like 0.1 are allowed; on the server, "
+                             "print every active flow, their sum and Jain's fairness index")
     parser.add_argument("-n", "--num", type=str, help="Number of bytes")
-    parser.add_argument("-P", "--parallel", type=positive_int, choices=range(1, 6), default=1,
+    parser.add_argument("--engine", type=str, choices=["thread", "async"], default="thread",
+                        help="server engine: a thread per connection, or one event loop for all connections")
+    parser.add_argument("--backlog", type=positive_int, default=SOMAXCONN,
+                        help="length of the server's accept queue")
+    parser.add_argument("--recv-buffer", type=str, default=f"{RECV_BUFFER // 1000}KB",
+                        help="size of the buffer each server connection receives into (e.g. 256KB)")
+    parser.add_argument("-P", "--parallel", type=positive_int, default=1,
                         help="creates parallel connections to connect to the server and send data")
-    parser.add_argument("-m", "--message_size", type=int, default=1000,
-                        help="Number of bytes in each message sent by the client")
+    parser.add_argument("--workers", type=positive_int, default=1,
+                        help="number of processes the client streams or the server acceptors are spread over")
+    parser.add_argument("-m", "--message_size", type=byte_size, default=1000,
+                        help="Number of bytes in each message sent by the client, with an optional unit B, KB or MB "
+                             "(e.g. 64KB)")
+    parser.add_argument("--latency", action="store_true",
+                        help="measure request/response round-trip times instead of throughput, -m sets the request size")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="requests per second of each latency stream (default: back-to-back)")
+    parser.add_argument("--crr", action="store_true",
+                        help="open a new connection for every request/response of -m bytes and report connections "
+                             "per second, connect times and the server's accept latency")
+    parser.add_argument("-u", "--udp", action="store_true",
+                        help="send sequence-numbered UDP datagrams of -m bytes and report loss, reordering and jitter")
+    parser.add_argument("--bandwidth", type=str, default=None,
+                        help="target rate of each stream in bits per second, with unit K, M or G "
+                             "(default: unlimited for TCP, 1M for UDP)")
+    parser.add_argument("-R", "--reverse", action="store_true",
+                        help="the server sends and the client receives")
+    parser.add_argument("--bidir", action="store_true",
+                        help="the client and the server send at the same time, each direction is reported separately")
+    parser.add_argument("--sndbuf", type=str, default=None, help="socket send buffer size (SO_SNDBUF), e.g. 4MB")
+    parser.add_argument("--rcvbuf", type=str, default=None, help="socket receive buffer size (SO_RCVBUF), e.g. 4MB")
+    parser.add_argument("--nodelay", action="store_true", help="disable Nagle's algorithm (TCP_NODELAY)")
+    parser.add_argument("--mss", type=positive_int, default=None, help="maximum segment size in bytes (TCP_MAXSEG)")
+    parser.add_argument("--congestion", type=str, default=None,
+                        help="congestion control algorithm (TCP_CONGESTION), e.g. cubic or bbr")
+    parser.add_argument("--tcp-info", action="store_true",
+                        help="sample TCP_INFO (cwnd, RTT, retransmits, pacing rate) of every stream on every -i "
+                             "interval and print it next to the bandwidth (Linux)")
+    parser.add_argument("--zerocopy", action="store_true",
+                        help="send with MSG_ZEROCOPY instead of copying each message into the kernel (Linux)")
+    parser.add_argument("--file", type=str, default=None,
+                        help="send this file with sendfile instead of generated data, split over the -P streams, and "
+                             "report the disk and network phases")
+    parser.add_argument("-O", "--omit", type=float, default=0,
+                        help="leave the first seconds of a TCP stream test out of the summary (they run in addition to "
+                             "-t)")
+    parser.add_argument("--matrix", type=str, default=None,
+                        help="run every test of a JSON matrix file (message_size, parallel, time and recv_buffer "
+                             "lists, warmup and omit seconds) over one control session")
+    parser.add_argument("--warmup", type=float, default=0,
+                        help="with --matrix, seconds of an unrecorded test before the matrix")
+    parser.add_argument("--sink", type=str, default=None,
+                        help="on the server, write received stream data to this file, or to a file per transfer in "
+                             "this directory")
+    parser.add_argument("--series", type=str, default=None,
+                        help="record the counter of every stream every --resolution seconds into a ring buffer and "
+                             "write it to this file at the end of the run (on the server: on Ctrl-C)")
+    parser.add_argument("--resolution", type=positive_float, default=SERIES_RESOLUTION,
+                        help="seconds between two samples of --series and --metrics-port, e.g. 0.01")
+    parser.add_argument("--series-rows", type=positive_int, default=SERIES_ROWS,
+                        help="capacity of the time series ring buffer in samples, shared by all streams (each "
+                             "sample of N streams takes N); older ones are overwritten")
+    parser.add_argument("--metrics-port", type=positive_int, default=None,
+                        help="serve the time series in the Prometheus text format at http://127.0.0.1:PORT/metrics "
+                             "while the test runs")
+    parser.add_argument("--relay", type=str, default=None, metavar="IP:PORT",
+                        help="relay connections to the server at IP:PORT through emulated links, on -b and -p")
+    parser.add_argument("--route", type=str, action="append", default=None,
+                        help="hosts of a relayed route, e.g. h1-h4; repeat for more routes on the following ports")
+    parser.add_argument("--topology", type=str, default=TOPOLOGY,
+                        help="JSON description of the emulated network (default: portfolio_topology.json)")
 
     # Parse command-line arguments
     args = parser.parse_args()
+    if args.reverse and args.bidir:
+        parser.error("-R and --bidir cannot be combined")
+    if (args.reverse or args.bidir) and (args.latency or args.udp):
+        parser.error("-R and --bidir only apply to TCP stream tests")
+    if args.tcp_info and (args.latency or args.udp or not args.interval):
+        parser.error("--tcp-info needs -i and applies to TCP stream tests")
+    if args.file and (args.reverse or args.bidir or args.latency or args.udp or args.num or args.bandwidth
+                      or args.zerocopy):
+        parser.error("--file sends the whole file unpaced from the client and cannot be combined with -R, --bidir, "
+                     "--latency, -u, -n, --bandwidth or --zerocopy")
+    if args.crr and (args.reverse or args.bidir or args.latency or args.udp or args.num or args.bandwidth
+                     or args.zerocopy or args.file or args.tcp_info):
+        parser.error("--crr is a timed request/response test and cannot be combined with -R, --bidir, --latency, -u, "
+                     "-n, --bandwidth, --zerocopy, --file or --tcp-info")
+    if args.udp and not UDP_HEADER.size <= args.message_size <= UDP_MAX_PAYLOAD:
+        parser.error(f"-u datagrams are {UDP_HEADER.size} to {UDP_MAX_PAYLOAD} bytes")
+    if args.crr and not 0 <= args.message_size <= MAX_RECV_BUFFER:
+        parser.error(f"--crr requests are 0 to {MAX_RECV_BUFFER} bytes")
+    if not args.crr and args.message_size <= 0:
+        parser.error("-m must be a positive number of bytes")
+    if args.omit < 0 or args.warmup < 0:
+        parser.error("-O and --warmup cannot be negative")
+    if args.omit and (args.latency or args.udp or args.num or args.file or args.crr):
+        parser.error("-O applies to timed TCP stream tests")
+    if (args.series or args.metrics_port) and (args.latency or args.matrix or args.relay
+                                               or (args.server and args.workers > 1)):
+        parser.error("--series and --metrics-port record stream, udp and crr tests of a client, or a server with one "
+                     "worker")
+    if args.file and not os.path.isfile(args.file):
+        parser.error(f"--file: {args.file} is not a file")
+    socket_options = {'sndbuf': parse_num_bytes(args.sndbuf) if args.sndbuf else None,
+                      'rcvbuf': parse_num_bytes(args.rcvbuf) if args.rcvbuf else None,
+                      'nodelay': args.nodelay, 'mss': args.mss, 'congestion': args.congestion}
+    try:
+        # Fail before the test starts if the kernel rejects an option, e.g. an unknown congestion control
+        with socket(AF_INET, SOCK_STREAM) as probe:
+            apply_socket_options(probe, socket_options)
+    except OSError as e:
+        parser.error(f"invalid socket option: {e}")
+    series = None
+    if args.series or args.metrics_port:
+        series = TimeSeries(args.resolution, args.series_rows)
+    if args.metrics_port:
+        try:
+            serve_metrics(series, args.metrics_port)
+        except OSError as e:
+            parser.error(f"--metrics-port: {e}")
 
-    if args.server:
+    if args.relay:
+        # Start the link emulation relay
+        try:
+            topology = load_topology(args.topology)
+            for route in args.route or ["h1-h4"]:
+                route_links(topology, route)
+        except (OSError, KeyError, ValueError) as e:
+            parser.error(f"invalid topology or route: {e}")
+        relay(args.bind, args.port, args.relay, args.route or ["h1-h4"], topology,
+              parse_format_unit(args.format, args.output))
+    elif args.server:
         # Start the server
-        format_unit = parse_format_unit(args.format)
-        server(args.bind, args.port, format_unit)
+        format_unit = parse_format_unit(args.format, args.output)
+        try:
+            server(args.bind, args.port, format_unit, parse_num_bytes(args.recv_buffer), args.engine, args.backlog,
+                   args.workers, args.interval, socket_options, args.sink, series)
+        except KeyboardInterrupt:
+            # Ctrl-C ends the run of a recording server, whose time series is written below
+            if not args.series:
+                raise
+        if args.series:
+            series.dump(args.series)
+            print_info(f"Time series written to {args.series}", format_unit)
+    elif args.client and args.matrix:
+        # Run a test matrix over one control session
+        try:
+            # Without recv_buffer in the matrix, the tests use the server's receive buffer size
+            tests, warmup, omit = load_matrix(args.matrix, {'message_size': args.message_size,
+                                                            'parallel': args.parallel, 'time': args.time,
+                                                            'recv_buffer': None, 'warmup': args.warmup,
+                                                            'omit': args.omit})
+        except (OSError, KeyError, ValueError) as e:
+            parser.error(f"invalid matrix file: {e}")
+        run_matrix(args.server_ip, args.port, tests, warmup, omit, parse_format_unit(args.format, args.output),
+                   socket_options)
     elif args.client:
         if args.num:
             # Parse number of bytes if specified
             num_bytes = parse_num_bytes(args.num)
         else:
             num_bytes = None
-        format_unit = parse_format_unit(args.format)
-        # Start the client
-        client(args.server_ip, args.port, args.time, args.interval, args.parallel, args.message_size, format_unit,
-               num_bytes)
+        format_unit = parse_format_unit(args.format, args.output)
+        # Start the client, and exit with status 1 if a stream lost its connection
+        result = client(args.server_ip, args.port, args.time, args.interval, args.parallel, args.message_size,
+                        format_unit, num_bytes, args.zerocopy, args.workers, args.latency, args.rate, args.udp,
+                        parse_bandwidth(args.bandwidth) if args.bandwidth else None,
+                        "reverse" if args.reverse else "bidir" if args.bidir else "send", socket_options,
+                        args.tcp_info, args.file, args.omit, crr=args.crr, series=series)
+        if args.series:
+            series.dump(args.series)
+            print_info(f"Time series written to {args.series}", format_unit)
+        if result.failed:
+            sys.exit(1)
 
     else:
         print("Please specify server mode with -s or --server")
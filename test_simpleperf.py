@@ -0,0 +1,331 @@
+import math
+import random
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+import simpleperf
+
+# Tests of simpleperf over loopback. Run with: python -m pytest -q
+
+linux_only = pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux socket options")
+
+
+# TCP_INFO samples are written into a plain array when the streams run in this process (no --workers), and into a
+# RawArray otherwise; both must hold the sample.
+@linux_only
+@pytest.mark.parametrize("shared", [False, True])
+def test_sample_streams(shared):
+    fields = len(simpleperf.TCP_INFO_FIELDS)
+    with socket.create_server(("127.0.0.1", 0)) as listener, \
+            socket.create_connection(listener.getsockname()) as sock:
+        counters = {'tcp_info': simpleperf.counter_array('d', fields, shared), 'sockets': {0: sock}}
+        stop = threading.Event()
+        sampler = threading.Thread(target=simpleperf.sample_streams, args=(counters, 0.02, stop))
+        sampler.start()
+        threading.Event().wait(0.05)
+        stop.set()
+        sampler.join()
+    # The congestion window of a connected socket is never 0
+    assert counters['tcp_info'][0] > 0
+
+
+# The server's send loop of a reverse or bidir test only runs with valid parameters from the hello message.
+@pytest.mark.parametrize("hello", [
+    {'mode': "stream", 'direction': "reverse", 'duration': 1},
+    {'mode': "stream", 'direction': "reverse", 'duration': 1, 'message_size': 0},
+    {'mode': "stream", 'direction': "bidir", 'duration': 1, 'message_size': 1.5},
+    {'mode': "stream", 'direction': "bidir", 'duration': 1, 'message_size': "1000"},
+    {'mode': "stream", 'direction': "reverse", 'duration': 1, 'message_size': 10 ** 9},
+    {'mode': "stream", 'direction': "reverse", 'message_size': 1000},
+    {'mode': "stream", 'direction': "reverse", 'duration': -1, 'message_size': 1000},
+    {'mode': "stream", 'direction': "reverse", 'duration': 1, 'message_size': 1000, 'num_bytes': 0},
+    {'mode': "stream", 'direction': "reverse", 'duration': 1, 'message_size': 1000, 'bandwidth': True},
+])
+def test_hello_error_rejects_invalid_send_parameters(hello):
+    assert simpleperf.hello_error(hello) is not None
+
+
+def test_hello_error_accepts_reverse_test():
+    assert simpleperf.hello_error({'mode': "stream", 'direction': "reverse", 'duration': 1, 'message_size': 1000,
+                                   'num_bytes': None, 'bandwidth': 1e6}) is None
+
+
+# A paced sender holds a rate of a few Kbps to within 1%, counting the time from the start to the last message sent.
+@pytest.mark.parametrize("bandwidth, message_size", [(8000, 100), (20000, 250), (50000, 1000)])
+def test_token_bucket_low_rate(bandwidth, message_size):
+    pacer = simpleperf.TokenBucket(bandwidth, message_size)
+    start = time.monotonic()
+    sent = 0
+    while time.monotonic() - start < 1:
+        count = pacer.reserve(message_size) // message_size
+        pacer.consume(count * message_size)
+        sent += count * message_size
+    assert sent * 8 / (time.monotonic() - start) == pytest.approx(bandwidth, rel=0.01)
+
+
+# A latency test reports the round-trip times of its streams, and a udp test the server's report of its datagrams.
+def test_client_result_latency():
+    with simpleperf.Server(port=0) as server:
+        result = simpleperf.run_client(server_port=server.address[1], duration=0.5, parallel=2, message_size=100,
+                                       latency=True)
+    assert not result.failed
+    assert all(result.bytes) and len(result.histograms) == 2
+    assert all(histogram.count() * 100 == sent for histogram, sent in zip(result.histograms, result.bytes))
+    p50, p90, p99, p999 = result.latency()
+    assert 0 < p50 <= p90 <= p99 <= p999
+    assert [record['id'] for record in result.records][-1] == "[SUM]"
+    assert result.records[-1]['requests'] == sum(histogram.count() for histogram in result.histograms)
+
+
+def test_client_result_udp():
+    with simpleperf.Server(port=0) as server:
+        result = simpleperf.run_client(server_port=server.address[1], duration=0.5, message_size=1000, udp=True,
+                                       bandwidth=800000)
+    assert not result.failed
+    report, = result.udp
+    assert report['total'] == report['packets'] + report['lost'] - report['duplicates']
+    assert 0 < report['bytes'] <= result.bytes[0]
+    assert report['jitter_ms'] >= 0
+    # The server's report is the summary, there is no second throughput table
+    assert [record['type'] for record in result.records] == ["udp_summary"]
+
+
+# A matrix file is rejected as a whole when any of its values would not be accepted on the command line.
+MATRIX_DEFAULTS = {'message_size': 1000, 'parallel': 1, 'time': 1, 'recv_buffer': None, 'warmup': 0, 'omit': 0}
+
+
+@pytest.mark.parametrize("matrix", [
+    '{"message_size": [1000, 0]}',
+    '{"message_size": -1}',
+    '{"parallel": [0]}',
+    '{"parallel": []}',
+    '{"time": 1.5}',
+    '{"recv_buffer": ["0KB"]}',
+    '{"parallel": true}',
+    '{"omit": -1}',
+    '[1000]',
+])
+def test_load_matrix_rejects_invalid_values(tmp_path, matrix):
+    path = tmp_path / "matrix.json"
+    path.write_text(matrix)
+    with pytest.raises(ValueError):
+        simpleperf.load_matrix(path, MATRIX_DEFAULTS)
+
+
+def test_load_matrix(tmp_path):
+    path = tmp_path / "matrix.json"
+    path.write_text('{"message_size": [1000, "8KB"], "recv_buffer": "1MB", "warmup": 0.5}')
+    tests, warmup, omit = simpleperf.load_matrix(path, MATRIX_DEFAULTS)
+    assert [test['message_size'] for test in tests] == [1000, 8000]
+    assert tests[0]['recv_buffer'] == 1000000 and (warmup, omit) == (0.5, 0)
+
+
+# The client only accepts the server's stream of a reverse test when it ends with the server's result.
+@pytest.mark.parametrize("complete", [True, False])
+def test_receive_server_stream(complete):
+    server, client = socket.socketpair()
+    with server, client:
+        server.sendall(b'0' * 5000)
+        if complete:
+            server.sendall(simpleperf.STREAM_RESULT.pack(simpleperf.STREAM_RESULT_MAGIC, 5000, 0))
+        server.shutdown(socket.SHUT_WR)
+        if complete:
+            assert simpleperf.receive_server_stream(client, bytearray(1024)) == (5000, 5000, 0)
+        else:
+            with pytest.raises(ConnectionError):
+                simpleperf.receive_server_stream(client, bytearray(1024))
+
+
+# A receive loop in a thread that fails keeps the error for the joining thread instead of raising a traceback.
+def test_receive_outcome_keeps_error():
+    server, client = socket.socketpair()
+    server.close()
+    client.close()
+    outcome = []
+    simpleperf.receive_outcome(outcome, simpleperf.receive_stream, client, bytearray(16))
+    assert isinstance(outcome[0], OSError)
+
+
+# The part of a file a stream sends to a sink must lie within the file.
+@pytest.mark.parametrize("part", [
+    {'file_offset': "x", 'file_size': 10, 'file_total': 10},
+    {'file_offset': -1, 'file_size': 10, 'file_total': 10},
+    {'file_offset': 0, 'file_size': 10, 'file_total': -1},
+    {'file_offset': 5, 'file_size': 10, 'file_total': 10},
+    {'file_offset': 0, 'file_size': 10},
+    {'file_offset': 0, 'file_size': 10, 'file_total': 10, 'file_name': 1},
+])
+def test_hello_error_rejects_invalid_file_parts(part):
+    assert simpleperf.hello_error(dict(part, mode="stream")) is not None
+
+
+# A sink that fails on the disk fails the test on the client instead of ending the server's handler.
+def test_sink_error_fails_stream(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(b'x' * 100000)
+    with simpleperf.Server(port=0, sink=str(tmp_path / "missing" / "data")) as server:
+        result = simpleperf.run_client(server_port=server.address[1], file=str(path))
+    assert result.failed == 1
+
+
+# A control session answers a test message that is not a JSON object with an error and carries on.
+def test_session_rejects_invalid_messages():
+    with simpleperf.Server(port=0) as server:
+        session, reply = simpleperf.connect_test("127.0.0.1", server.address[1], {'mode': "session"},
+                                                 {'output': "none"})
+        with session:
+            for message in ([1, 2], "test", {'config': [1]}):
+                session.sendall(simpleperf.encode_message(message))
+                assert 'error' in simpleperf.recv_message(session)
+            simpleperf.send_message(session, {'test': "ok", 'config': {}})
+            assert simpleperf.recv_message(session) == {'ready': True, 'recv_buffer': reply['recv_buffer']}
+            # A malformed frame ends the session with an error
+            session.sendall(b'\x00\x00\x00\x03abc')
+            assert 'error' in simpleperf.recv_message(session)
+
+
+# A timer never fires before its time, and at most a tick (plus the step of the clock here) after it.
+def test_timer_wheel_expiry():
+    wheel = simpleperf.TimerWheel()
+    start = wheel.current * simpleperf.TIMER_TICK
+    fired = {}
+    now = [start]
+    delays = [0.0, 0.0004, 0.0105, 0.06, 0.0799, 0.08, 0.5, 1.5]
+    for delay in delays:
+        wheel.schedule(start + delay, lambda delay=delay: fired.setdefault(delay, now[0]))
+    step = 0.0001
+    while wheel.pending:
+        now[0] += step
+        wheel.advance(now[0])
+    for delay in delays:
+        assert start + delay <= fired[delay] < start + delay + simpleperf.TIMER_TICK + 2 * step
+
+
+# A time series drops finished streams once their rows are overwritten and reuses their indexes, so recording a new
+# stream every sample does not grow it.
+def test_time_series_drops_finished_streams():
+    series = simpleperf.TimeSeries(rows=8)
+    for i in range(1000):
+        series.record(i * 0.01, [("long", i), (f"flow {i}", i)])
+    assert len(series.names) <= 10 and len(series.index) <= 10
+    times, streams, values = series.rows()
+    assert len(times) == 8
+    assert all(series.names[stream] for stream in streams)
+    assert series.names[series.index["long"]] == "long"
+
+
+# Serves one connection with a server that answers the hello with a message length beyond MAX_MESSAGE.
+def serve_malformed_reply(listener):
+    connection, _ = listener.accept()
+    with connection:
+        simpleperf.recv_message(connection)
+        connection.sendall(b'\xff\xff\xff\xff')
+        connection.shutdown(socket.SHUT_WR)
+        connection.recv(65536)
+
+
+# A malformed message from the server fails the stream instead of ending the worker with a traceback.
+@pytest.mark.parametrize("worker", ["latency_worker", "crr_worker", "udp_worker"])
+def test_worker_fails_on_malformed_message(worker):
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        server = threading.Thread(target=serve_malformed_reply, args=(listener,))
+        server.start()
+        counters = {'sent': [0], 'elapsed': [0.0], 'failed': [0], 'connections': [0]}
+        for _, key in simpleperf.CRR_TIMES:
+            counters[key] = [simpleperf.LatencyHistogram().counts]
+        getattr(simpleperf, worker)("127.0.0.1", listener.getsockname()[1], 5, None, {'output': "none"}, 100,
+                                    counters=counters)
+        server.join()
+    assert counters['failed'] == [1]
+
+
+# A crr stream runs without the counters of client, as a library call.
+def test_crr_worker_without_counters():
+    with simpleperf.Server(port=0) as server:
+        simpleperf.crr_worker("127.0.0.1", server.address[1], 0.2, None, {'output': "none"}, 100)
+        assert server.connections > 0
+
+
+# A histogram reports every value with less than 1% relative error (values below 256 exactly), its percentiles
+# by the nearest-rank method, and the exact count, min and max.
+def test_latency_histogram_error_bounds():
+    rng = random.Random(1)
+    values = [rng.randrange(256)] + [int(10 ** rng.uniform(0, 12)) for _ in range(20000)]
+    histogram = simpleperf.LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+    ordered = sorted(values)
+    assert (histogram.count(), histogram.min(), histogram.max()) == (len(values), ordered[0], ordered[-1])
+    percents = [1, 25, 50, 90, 99, 99.9, 100]
+    for percent, reported in zip(percents, histogram.percentiles(percents)):
+        exact = ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+        assert exact <= reported <= exact * 1.01
+    for value in range(256):
+        single = simpleperf.LatencyHistogram()
+        single.record(value)
+        assert single.percentiles([50]) == [value]
+
+
+def test_latency_histogram_merge():
+    first, second, both = simpleperf.LatencyHistogram(), simpleperf.LatencyHistogram(), simpleperf.LatencyHistogram()
+    for value in range(1, 5000, 7):
+        (first if value % 2 else second).record(value * 1000)
+        both.record(value * 1000)
+    first.merge(second)
+    assert list(first.counts) == list(both.counts)
+    first.reset()
+    assert first.count() == 0 and first.percentiles([50]) == [0]
+
+
+# The server's udp accounting: lost datagrams are the gaps below the highest sequence number, a datagram that arrives
+# after a higher one is out of order, and one that arrives twice is a duplicate whose bytes do not count.
+def test_udp_stats_accounting():
+    stats = simpleperf.UdpStats()
+    for seq in [0, 1, 3, 2, 2, 6, 5, 0]:
+        stats.record(seq, 0, 100, 0)
+    report = stats.report()
+    assert report['total'] == 7 and report['packets'] == 8
+    assert report['duplicates'] == 2 and report['out_of_order'] == 2
+    assert report['lost'] == 1 and report['bytes'] == 600
+
+
+# Jitter follows RFC 3550: it converges to the mean difference between the transit times of consecutive datagrams.
+def test_udp_stats_jitter():
+    stats = simpleperf.UdpStats()
+    for seq in range(1000):
+        stats.record(seq, seq * 1000000, 100, seq * 1000000 + (2000000 if seq % 2 else 0))
+    assert stats.report()['jitter_ms'] == pytest.approx(2.0, rel=1e-3)
+    steady = simpleperf.UdpStats()
+    for seq in range(100):
+        steady.record(seq, seq * 1000000, 100, seq * 1000000 + 5000000)
+    assert steady.report()['jitter_ms'] == 0
+
+
+# A dumped series loads back with the same rows, oldest first, the same stream names, unit and resolution, also after
+# the ring has wrapped around.
+@pytest.mark.parametrize("samples", [3, 10])
+def test_time_series_dump_and_load(tmp_path, samples):
+    series = simpleperf.TimeSeries(resolution=0.05, rows=12, unit="connections")
+    for i in range(samples):
+        series.record(1000.0 + i, [("a", i), ("b", 10 * i)])
+    path = tmp_path / "series.spts"
+    series.dump(path)
+    loaded = simpleperf.load_series(path)
+    assert (loaded.resolution, loaded.unit, loaded.names) == (0.05, "connections", ["a", "b"])
+    assert [list(column) for column in loaded.rows()] == [list(column) for column in series.rows()]
+    times, streams, values = loaded.rows()
+    assert len(times) == min(2 * samples, 12) and list(times) == sorted(times)
+    assert values[-1] == 10 * (samples - 1) and loaded.names[streams[-1]] == "b"
+
+
+def test_load_series_rejects_other_files(tmp_path):
+    path = tmp_path / "other"
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        simpleperf.load_series(path)